@@ -1,4 +1,5 @@
 from flask import jsonify, request
+from PIL import UnidentifiedImageError
 from main import db, app
 from db.models import AppReport, User
 from services.aws_service import register_image
@@ -33,7 +34,10 @@ def create_app_report():
         image_mimetype = image.mimetype
         image_filename = image.filename
         if image_mimetype in ["image/jpeg", "image/png"]:
-            media.append(register_image(image.read(), user_id, des="app_report")[0])
+            try:
+                media.append(register_image(image.read(), user_id, des="app_report")[0])
+            except UnidentifiedImageError:
+                return jsonify({"message": f"Invalid image found: {image_filename}"}), 400
         elif image_mimetype == "":
             pass
         else:
@@ -2,6 +2,7 @@ from flask import jsonify, request
 from main import db, app
 from db.models import PackageGroup
 from utils.auth import validate_token
+from utils.chat_config import invalidate_chat_config
 from utils.exceptions import ItemNotFoundError
 
 
@@ -42,6 +43,7 @@ def update_package_group(package_group_id):
     data = request.get_json()
     package_group.update_fields(**data)
     db.session.commit()
+    invalidate_chat_config()
 
     return jsonify({'message': 'Package group updated successfully.'})
 
@@ -55,5 +57,6 @@ def delete_package_group(package_group_id):
 
     package_group.soft_delete()
     db.session.commit()
+    invalidate_chat_config()
 
     return jsonify({'message': 'Package group deleted successfully.'})
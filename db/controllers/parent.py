@@ -1,4 +1,5 @@
 from flask import jsonify, request
+from PIL import UnidentifiedImageError
 from sqlalchemy import or_
 
 from db.models import LinkRequest, Parent, User
@@ -6,7 +7,9 @@ from main import db, app
 from services.aws_service import register_image, cognito_disable_user, get_image_generation_counter
 from services.notification_service import generate_notification
 from utils.auth import validate_token
+from utils.chat_config import invalidate_chat_config
 from utils.enum.language import language_mapper
+from utils.enum.role import AppRole
 from utils.exceptions import NotificationGenerationError, ItemNotFoundError, ValidationError
 
 
@@ -93,6 +96,7 @@ def update_parent(parent_id):
     data = request.get_json()
     parent.update_fields(**data)
     db.session.commit()
+    invalidate_chat_config(AppRole.PARENT, parent_id)
 
     return jsonify({'message': 'Parent updated successfully.'})
 
@@ -109,6 +113,7 @@ def delete_parent(parent_id):
 
     parent.soft_delete()
     db.session.commit()
+    invalidate_chat_config(AppRole.PARENT, parent_id)
 
     return jsonify({'message': 'Parent deleted successfully.'})
 
@@ -200,6 +205,7 @@ def parent_set_chat_languages():
 
     parent.chat_languages = languages
     db.session.commit()
+    invalidate_chat_config(AppRole.PARENT, parent_id)
     return jsonify({'message': 'Set chat languages successfully'})
 
 
@@ -277,7 +283,10 @@ def parent_upload_avatar():
     if not parent:
         raise ItemNotFoundError("User not found")
 
-    image_url, _ = register_image(image_data=image.read(), id=parent_id, des="parent_avatar")
+    try:
+        image_url, _ = register_image(image_data=image.read(), id=parent_id, des="parent_avatar")
+    except UnidentifiedImageError:
+        raise ValidationError("The image cannot be read")
     parent.avatar_url = image_url
     db.session.commit()
     return jsonify({"message": "Upload avatar successfully"})
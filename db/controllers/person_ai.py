@@ -5,6 +5,7 @@ from db.models.category_ai import CategoryAI
 from db.models.person_ai import PersonAIs
 from db.models.person_ai_skill import PersonAISkills
 from db.models.skills import Skills
+from services.chat import invalidate_cached_answers
 from utils.auth import validate_token, prohibit_access
 
 
@@ -70,6 +71,8 @@ def update_person_ai(person_ai_id):
 
     person_ai.update_fields(**data)
     db.session.commit()
+    # The voice or the persona may have changed
+    invalidate_cached_answers(person_ai_id)
 
     return jsonify({'message': 'PersonAI updated successfully.'})
 
@@ -83,6 +86,7 @@ def delete_person_ai(person_ai_id):
 
     person_ai.soft_delete()
     db.session.commit()
+    invalidate_cached_answers(person_ai_id)
 
     return jsonify({'message': 'PersonAI deleted successfully.'})
 
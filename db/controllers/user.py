@@ -1,4 +1,5 @@
 from flask import jsonify, request
+from PIL import UnidentifiedImageError
 from sqlalchemy import or_
 
 from db.models import Parent, LinkRequest, Mail
@@ -8,6 +9,7 @@ from services.aws_service import register_image, send_approve_request_email, cog
     get_text_to_text_counter, get_image_generation_counter
 from services.notification_service import generate_notification
 from utils.auth import validate_token
+from utils.chat_config import invalidate_chat_config
 from utils.email import validate_email
 
 from utils.enum.language import language_mapper
@@ -118,6 +120,7 @@ def create_user():
         user.package_group_id = Parent.get_active_package(user.parent_id)
 
     db.session.commit()
+    invalidate_chat_config(AppRole.USER, user.id)
     try:
         generate_notification(event_code="CHILD_WELCOME_MESSAGE", receive_user_id=user.id)
         if parent_id is not None:
@@ -137,6 +140,7 @@ def update_user(user_id):
     data = request.get_json()
     user.update_fields(**data)
     db.session.commit()
+    invalidate_chat_config(AppRole.USER, user_id)
 
     return jsonify({'message': 'User updated successfully.'})
 
@@ -153,6 +157,7 @@ def delete_user(user_id):
 
     user.soft_delete()
     db.session.commit()
+    invalidate_chat_config(AppRole.USER, user_id)
 
     return jsonify({'message': 'User deleted successfully.'})
 
@@ -181,6 +186,7 @@ def set_chat_languages():
 
     user.chat_languages = languages
     db.session.commit()
+    invalidate_chat_config(AppRole.USER, user_id)
     return jsonify({'message': 'Set chat languages successfully'})
 
 
@@ -208,6 +214,7 @@ def child_set_chat_languages():
 
     user.chat_languages = languages
     db.session.commit()
+    invalidate_chat_config(AppRole.USER, user_id)
     return jsonify({'message': 'Set chat languages successfully'})
 
 
@@ -315,7 +322,10 @@ def child_upload_avatar():
     if not user:
         raise ItemNotFoundError("User not found")
 
-    image_url, _ = register_image(image_data=image.read(), id=user_id, des="user_avatar")
+    try:
+        image_url, _ = register_image(image_data=image.read(), id=user_id, des="user_avatar")
+    except UnidentifiedImageError:
+        raise ValidationError("The image cannot be read")
     user.avatar_url = image_url
     db.session.commit()
     return jsonify({"message": "Upload avatar successfully"})
@@ -1,13 +1,14 @@
-import io
+import os
 
 from db.extension import db
 from db.models import User, Parent
 
 from main import app
 
-from flask import request, jsonify, send_file
+from flask import request, jsonify, send_file, redirect
 
-from services.aws_service import get_image_from_s3, cognito_disable_user, cognito_delete_user, cognito_set_password
+from services.aws_service import get_image_url, get_cached_image, cognito_disable_user, cognito_delete_user, \
+    cognito_set_password, IMAGE_SERVE_MODE
 
 from utils.auth import validate_token, testing_purpose
 from utils.exceptions import ItemNotFoundError, ValidationError
@@ -61,16 +62,28 @@ def check_parent_can_create_link():
 @validate_token
 def get_image_from_chat_history():
     image_key = request.args.get('image_key')
+    if not image_key:
+        return jsonify({"message": "Missing image_key field"}), 400
+
     try:
-        image_data = get_image_from_s3(image_key)
+        if IMAGE_SERVE_MODE == "redirect":
+            image_url, max_age = get_image_url(image_key)
+            response = redirect(image_url, code=302)
+            response.cache_control.private = True
+            response.cache_control.max_age = int(max_age)
+            return response
+        image = get_cached_image(image_key)
     except ConnectionError as e:
         return jsonify({"message": str(e)}), 510
 
+    # Streamed from the cache file, with ETag, Range and 304 responses
     return send_file(
-        io.BytesIO(image_data),
-        mimetype='image/jpeg',
+        image.path,
+        mimetype=image.metadata.get("content_type") or 'image/jpeg',
         as_attachment=False,
-        download_name='image.jpg'
+        download_name=os.path.basename(image_key.split("?")[0]) or 'image.jpg',
+        conditional=True,
+        etag=image.metadata.get("etag") or True,
     )
 
 
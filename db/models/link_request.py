@@ -177,6 +177,12 @@ class LinkRequest(BaseTable):
             active_link_request.status = "CANCELLED"
         db.session.commit()
 
+        # The package group of both chatters may have changed. Imported here, the chat config depends on the models.
+        from utils.chat_config import invalidate_chat_config
+        from utils.enum.role import AppRole
+        invalidate_chat_config(AppRole.USER, user.id)
+        invalidate_chat_config(AppRole.PARENT, parent.id)
+
         acceptor_object = user if acceptor == "user" else parent
         return link_request, acceptor_object
 
@@ -4,6 +4,7 @@ import time
 
 import PIL
 import boto3.exceptions
+import click
 import flask_socketio
 import openai
 
@@ -17,9 +18,15 @@ from flask_migrate import Migrate
 from flask_socketio import SocketIO, emit, join_room
 
 from db.extension import db
+from services.admission import create_admission_controller, TEXT_TO_SPEECH
 from services.chat import reformat_chat, ChatFactory
-from services.elevenlabs import voice_stream
+from services.elevenlabs import SentenceSpeechStream
+from services.message_index import reindex_message_history
 from services.openai_services import generate_text
+from services.pipeline import Pipeline
+from services.resilience import Deadline
+from services.room_registry import InMemoryRoomRegistry, create_room_registry
+from services.socket_manager import create_client_manager
 from services import pickle, openai_services, api_service, aws_service
 
 from PIL import Image
@@ -31,7 +38,7 @@ from services.aws_service import invoke_progress_tracking, register_image
 from dotenv import load_dotenv, find_dotenv
 
 from utils.auth import validate_token
-from utils.chat_config import generate_config_object
+from utils.chat_config import get_chat_config
 from utils.enum.action import Action
 from utils.enum.role import ChatRole, AppRole
 from utils.exceptions import (
@@ -47,14 +54,23 @@ from utils.exceptions import (
     get_default_language_incompatible_message,
     InvalidImageInput,
     get_default_small_image_message,
+    ServiceOverloadedError,
+    UpstreamUnavailableError,
 )
-from utils.image import resize_image
+from utils.image import ImageEngine
 from utils.template_responses import get_welcome_message
 from utils.encoder import CustomJSONEncoder
 
 load_dotenv(find_dotenv())
 
 AWS_BUCKET_NAME = os.getenv("AWS_BUCKET_NAME")
+STREAM_TEXT_RESPONSE = os.getenv("STREAM_TEXT_RESPONSE", "true").lower() == "true"
+# Seconds a message may take, the calls to OpenAI, Stability AI and ElevenLabs fail fast once it has passed
+MESSAGE_DEADLINE = float(os.getenv("MESSAGE_DEADLINE", 120))
+# Message queue relaying the Socket.IO events between workers and nodes (e.g. redis://host:6379/0)
+SOCKETIO_MESSAGE_QUEUE = os.getenv("SOCKETIO_MESSAGE_QUEUE")
+ROOM_REGISTRY_URL = os.getenv("ROOM_REGISTRY_URL", SOCKETIO_MESSAGE_QUEUE)
+ROOM_REGISTRY_TTL = int(os.getenv("ROOM_REGISTRY_TTL", 86400))
 
 
 def create_app():
@@ -67,6 +83,10 @@ cors = CORS(app, origins="*")
 app.config["CORS_HEADERS"] = "Content-Type"
 migrate = Migrate(app, db)
 chat_factory = ChatFactory()
+# Bounded concurrency and queue of each chat action
+admission_controller = create_admission_controller()
+# Worker processes resizing the uploaded images outside of the event loop
+image_engine = ImageEngine()
 
 # Configure the SQLite database, relative to the app instance folder
 app.config["SPEC_FORMAT"] = "yaml"
@@ -167,8 +187,14 @@ def get_chat_history():
 
 
 # Websocket functionalities
-socketio = SocketIO(app, cors_allowed_origins="*", async_mode="gevent")
-client_room_count = {}
+socketio = SocketIO(
+    app, cors_allowed_origins="*", async_mode="gevent", client_manager=create_client_manager(SOCKETIO_MESSAGE_QUEUE)
+)
+# Connections of each chat room, shared by the nodes when `ROOM_REGISTRY_URL` is set
+room_registry = create_room_registry(ROOM_REGISTRY_URL, ROOM_REGISTRY_TTL)
+if aws_service.GUNICORN_WORKERS > 1 and isinstance(room_registry, InMemoryRoomRegistry):
+    # The last participant of a room may leave from another worker
+    raise RuntimeError("More than one worker requires ROOM_REGISTRY_URL (or SOCKETIO_MESSAGE_QUEUE) to be a Redis URL")
 
 
 @socketio.on("connect")
@@ -181,11 +207,12 @@ def handle_disconnect():
     # The only string in rooms is the request.sid, others are the history_message_id corresponding to the chat room
     rooms = [room for room in flask_socketio.rooms(request.sid) if isinstance(room, int)]
     for room in rooms:
-        client_room_count[room]["count"] -= 1
-        if client_room_count[room]["role"] == AppRole.USER and client_room_count[room]["count"] == 0:
+        # Only the last connection to leave the room, on any node, gets its occupancy
+        occupancy = room_registry.leave(room)
+        if occupancy and occupancy["role"] == AppRole.USER:
             invoke_progress_tracking(
                 history_message_id=room,
-                start_time=client_room_count[room]["start_time"],
+                start_time=occupancy["start_time"],
             )
 
 
@@ -261,20 +288,15 @@ def handle_user_join(chatter_id, person_ai_id, role="user"):
         join_room(history_message_id, request.sid)
 
         # Add 1 to room count
-        if history_message_id in client_room_count:
-            if client_room_count[history_message_id]["count"] == 0:
-                client_room_count[history_message_id]["start_time"] = datetime.utcnow().isoformat()
-            client_room_count[history_message_id]["count"] += 1
-        else:
-            client_room_count[history_message_id] = {
-                "start_time": datetime.utcnow().isoformat(),
-                "count": 1,
-                "role": role,
-            }
+        room_registry.join(history_message_id, role)
 
         # TODO: Limit is hard-coded
         limit = 20
         message_history = aws_service.get_message_record_from_dynamo_db(history_message.id, limit, None)
+        # The next turns of the conversation read their context from the window
+        aws_service.context_store.seed(
+            history_message_id, message_history["data"], complete=message_history["last_timestamp"] is None
+        )
         message_history.update({"message_id": history_message_id})
         emit("message_history", message_history)
 
@@ -298,11 +320,9 @@ def handle_message(
 ):
     try:
         role = AppRole.get_role(role)
-        (
-            history_message,
-            message_id,
-        ) = HistoryMessage.get_message_history_id_by_user_or_parent(person_ai_id, id, role)
-        configs = generate_config_object(id, message_id, person_ai_id, role, uuid_request)
+        configs = get_chat_config(id, person_ai_id, role, uuid_request)
+        configs.set_deadline(Deadline(MESSAGE_DEADLINE))
+        message_id = configs.message_id
 
     except Exception as e:
         emit("error", str(e))
@@ -314,81 +334,123 @@ def handle_message(
         emit("chat", error_message)
         raise e
 
+    ticket = None
     try:
         # Retrieve the agent base on action
         chat_service = chat_factory.get_chat_service(action)
 
+        # Reject the request before doing any work if its action is over capacity
+        lanes = [action, TEXT_TO_SPEECH] if action == Action.TEXT_TO_TEXT else [action]
+        ticket = admission_controller.admit((role, id), *lanes)
+
         # Send the client message back (last in message history)
         user_message_str = last_message["content"]
         user_message = reformat_chat(role=ChatRole.USER, content=user_message_str, uuid_request=uuid_request)
         emit("chat", user_message, to=message_id)
-        aws_service.save_message_record(message_id, **user_message)
-
-        # Validate quote from user
-        chat_service.validate(last_message, configs)
-
-        # If image is in last_message payload, resize and emit the image
-        if "image" in last_message:
-            user_image_data = resize_image(last_message.get("image"))
-            user_image_url, user_image_size = register_image(user_image_data, message_id)
-            user_image_message = reformat_chat(
-                role=ChatRole.USER_IMAGE,
-                content=user_image_url,
-                uuid_request=uuid_request,
-            )
-            emit("chat", user_image_message, to=message_id)
-            item = aws_service.save_message_record(message_id, **user_image_message)
-            timestamp = item["timestamp"]["S"]
-            history_message.append_media(user_image_url, timestamp, user_image_size)
-            last_message["image"] = user_image_data
+        last_message["timestamp"] = user_message["timestamp"]
 
-        # Ask for the response
-        assistant_response, metadata = chat_service.run(last_message, configs)
+        # The quota reserved by `validate` is given back if the request fails before the answer is produced
+        try:
+            # Save the user message, validate quota from user and load the data required by the agent concurrently
+            pipeline = Pipeline("message-v2")
+            pipeline.add_stage("save_user_message", aws_service.save_message_record, message_id, **user_message)
+            pipeline.add_stage("validate", chat_service.validate, last_message, configs)
+            context_loaders = chat_service.prepare(last_message, configs)
+            for name, loader in context_loaders.items():
+                pipeline.add_stage(name, loader)
+            pipeline_results = pipeline.run()
+            context = {name: pipeline_results[name] for name in context_loaders}
+
+            # If image is in last_message payload, resize and emit the image
+            if "image" in last_message:
+                user_image_data = image_engine.resize_image(last_message.get("image"))
+                # The image is uploaded while the conversation goes on, the chatter is warned if the upload fails
+                user_image_url, user_image_size = register_image(
+                    user_image_data,
+                    message_id,
+                    wait=False,
+                    on_error=lambda key, error: socketio.emit("warning", "Fail to upload the image", to=message_id),
+                )
+                user_image_message = reformat_chat(
+                    role=ChatRole.USER_IMAGE,
+                    content=user_image_url,
+                    uuid_request=uuid_request,
+                )
+                emit("chat", user_image_message, to=message_id)
+                item = aws_service.save_message_record(message_id, **user_image_message)
+                timestamp = item["timestamp"]["S"]
+                history_message = db.session.get(HistoryMessage, message_id)
+                history_message.append_media(user_image_url, timestamp, user_image_size)
+                last_message["image"] = user_image_data
+
+            # The first question of a conversation may be answered from the answers shared by the agent
+            answer_cache_key = chat_service.get_answer_cache_key(last_message, configs, context)
+            cached_answer = chat_service.get_cached_answer(answer_cache_key)
+
+            # Speech is synthesized sentence by sentence while the answer is generated
+            speech = None
+            audio_payloads = []
+            if action == Action.TEXT_TO_TEXT and cached_answer is None:
+                def on_audio(chunk, count):
+                    emit("audio", {"uuid": uuid_request, "chunk": chunk, "count": count}, to=message_id)
+                    if answer_cache_key is not None:
+                        audio_payloads.append(chunk)
+
+                speech = SentenceSpeechStream(configs.person_ai.voice, on_audio, deadline=configs.deadline)
+
+            # Ask for the response, partial answers are sent on `chat_delta` when streaming is enabled, and the
+            # progress of an image generation on `generating`
+            on_delta = None
+            if action != Action.TEXT_TO_TEXT:
+                def on_delta(payload):
+                    emit("generating", payload, to=message_id)
+            elif STREAM_TEXT_RESPONSE and cached_answer is None:
+                def on_delta(payload):
+                    emit("chat_delta", payload, to=message_id)
+                    if speech is not None and "content" in payload:
+                        speech.feed(payload["content"])
+
+            try:
+                if cached_answer is not None:
+                    assistant_response, metadata = cached_answer.to_response(uuid_request), None
+                else:
+                    assistant_response, metadata = chat_service.run(last_message, configs, context, on_delta)
+            except Exception:
+                if speech is not None:
+                    speech.abort()
+                raise
+        except Exception:
+            try:
+                chat_service.refund_quota(configs)
+            except Exception:
+                # The original error is the one reported to the chatter
+                logger.exception("Fail to refund the quota of message {}".format(message_id))
+            raise
 
         # Emit audio streaming
         if assistant_response.get("role") == ChatRole.IMAGE:
             emit("chat", assistant_response, to=message_id)
             item = aws_service.save_message_record(message_id, **assistant_response)
             timestamp = item["timestamp"]["S"]
+            history_message = db.session.get(HistoryMessage, message_id)
             history_message.append_media(
                 assistant_response["content"], timestamp, metadata
             )  # Content here stores the image_url
         elif assistant_response.get("role") == ChatRole.ASSISTANT:
-            stream = voice_stream(assistant_response.get("content"), configs.person_ai.voice)
-            count = 0
-            chunks = []
-            concatenated_chunk = None
+            emit("chat", assistant_response, to=message_id)
             start_time = time.time()
-            for chunk in stream:
-                if chunk:
-                    if count == 0 and len(chunks) == 0:
-                        emit("chat", assistant_response, to=message_id)
-
-                    chunks.append(chunk)
-                    if len(chunks) >= 10:
-                        concatenated_chunk = b"".join(chunks)
-                        chunks = []
-                    else:
-                        continue
-                    audio_payload = {
-                        "uuid": uuid_request,
-                        "chunk": concatenated_chunk,
-                        "count": count,
-                    }
-                    emit("audio", audio_payload, to=message_id)
-                    count += 1
-
-                    concatenated_chunk = None
-
-            if len(chunks) > 0:
-                concatenated_chunk = b"".join(chunks)
-                audio_payload = {
-                    "uuid": uuid_request,
-                    "chunk": concatenated_chunk,
-                    "count": count,
-                }
-                emit("audio", audio_payload, to=message_id)
-                count += 1
+            if cached_answer is not None:
+                for count, chunk in enumerate(cached_answer.audio):
+                    emit("audio", {"uuid": uuid_request, "chunk": chunk, "count": count}, to=message_id)
+            else:
+                if not STREAM_TEXT_RESPONSE:
+                    speech.feed(assistant_response.get("content"))
+                speech.close()
+                if speech.error is None:
+                    chat_service.cache_answer(answer_cache_key, configs, assistant_response, audio_payloads)
+                else:
+                    # The answer has been sent already, it is saved without its (incomplete) audio
+                    emit("speech_error", {"uuid_request": uuid_request, "error": str(speech.error)}, to=message_id)
 
             # Send stop message
             audio_final = {"uuid": uuid_request, "chunk": None, "count": -1}
@@ -403,13 +465,8 @@ def handle_message(
             emit("chat", assistant_response, to=message_id)
             aws_service.save_message_record(message_id, **assistant_response)
 
-        # Update message count
-        try:
-            chat_service.check_quota(configs)
-        except Exception as e:
-            raise e
-        finally:
-            chat_service.update_counter(configs)
+        # Warn about the quota from the count reserved by `validate`
+        chat_service.check_quota(configs)
 
     # Exception handling
     except ConversationNotFoundError as e:
@@ -452,6 +509,18 @@ def handle_message(
         emit("chat", error_message)
         raise e
 
+    except UpstreamUnavailableError as e:
+        emit("error", str(e))
+        if e.upstream == "openai":
+            content = get_default_openai_error_message(configs.chatter.display_language)
+        elif e.upstream == "stability":
+            content = get_default_stability_ai_error_message(configs.chatter.display_language)
+        else:
+            content = get_default_error_message(configs.chatter.display_language)
+        error_message = reformat_chat(role=ChatRole.ASSISTANT, content=content, uuid_request=uuid_request)
+        emit("chat", error_message)
+        raise e
+
     except PIL.UnidentifiedImageError as e:
         emit("error", f"Error during reading file/image: {e.__class__} - {e}")
         error_message = reformat_chat(
@@ -462,6 +531,11 @@ def handle_message(
         emit("chat", error_message)
         raise e
 
+    except ServiceOverloadedError:
+        dump_message = reformat_chat(role=ChatRole.SUBSCRIPTION_WARNING, content=None, uuid_request=uuid_request)
+        emit("chat", dump_message)
+        emit("warning", "Too many requests at the moment, please try again in a few seconds.")
+
     except OutOfQuotaError:
         dump_message = reformat_chat(role=ChatRole.SUBSCRIPTION_WARNING, content=None, uuid_request=uuid_request)
         emit("chat", dump_message)
@@ -502,6 +576,27 @@ def handle_message(
         emit("chat", error_message)
         raise e
 
+    finally:
+        if ticket is not None:
+            ticket.release()
+
+
+@app.cli.command("reindex-messages")
+@click.option("--segments", default=4, show_default=True, help="Number of DynamoDB Scan segments read in parallel")
+@click.option("--page-size", default=500, show_default=True, help="Number of records per bulk request")
+@click.option("--checkpoint", default="reindex_checkpoint.json", show_default=True,
+              help="Progress file, an existing one is resumed")
+def reindex_messages(segments, page_size, checkpoint):
+    """Backfill the shared OpenSearch index of the message history from DynamoDB"""
+    start = time.time()
+
+    def on_progress(segment, count):
+        click.echo("Segment {} - {} records indexed ({:.0f}/s)".format(
+            segment, count, count / max(time.time() - start, 1e-3)))
+
+    count = reindex_message_history(segments, page_size, checkpoint, on_progress)
+    click.echo("Reindex done, {} records indexed".format(count))
+
 
 # Import API (should be refactored in later versions)
 from db.controllers import *
@@ -0,0 +1,23 @@
+"""
+Cost of creating a boto3 client per call, as before the shared clients of `aws_service.get_client`, against looking
+the shared client up. No request is sent, but the AWS settings of the `.env` are required to import `aws_service`.
+
+Usage: python -m scripts.bench_aws_clients
+"""
+from services import aws_service
+from scripts.bench_utils import mean_time
+
+SERVICES = ("dynamodb", "s3", "comprehend")
+
+
+def main():
+    for service_name in SERVICES:
+        created = mean_time(lambda: aws_service.session.client(service_name, config=aws_service.client_config), 20)
+        aws_service.get_client(service_name)
+        shared = mean_time(lambda: aws_service.get_client(service_name), 100000)
+        print("{:<12} new client: {:6.2f} ms   shared client: {:5.2f} us".format(
+            service_name, created * 1e3, shared * 1e6))
+
+
+if __name__ == "__main__":
+    main()
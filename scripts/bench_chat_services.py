@@ -0,0 +1,48 @@
+"""
+Per-message cost of the chat services, created by `ChatFactory` for every message before they were shared with
+their schemas built once. The previous `services/chat.py` is loaded from git to build the services the old way. The
+app settings of the `.env` are required to import `services.chat`.
+
+Usage: python -m scripts.bench_chat_services <revision>
+
+`revision` is any git revision whose `services/chat.py` still creates the services for every message, e.g. the
+parent of the commit that shared them.
+"""
+import sys
+import tracemalloc
+
+from scripts.bench_utils import load_module_at, mean_time
+from services.chat import ChatFactory
+from utils.enum.action import Action
+
+
+def allocated(func, number: int = 1000) -> float:
+    """Mean number of bytes allocated by a call of `func` and kept alive by its result"""
+    tracemalloc.start()
+    start = tracemalloc.get_traced_memory()[0]
+    results = [func() for _ in range(number)]
+    size = tracemalloc.get_traced_memory()[0] - start
+    tracemalloc.stop()
+    del results
+    # Each result takes a pointer in the list
+    return size / number - 8
+
+
+def main():
+    if len(sys.argv) < 2:
+        sys.exit(__doc__.strip())
+    revision = sys.argv[1]
+    old_chat = load_module_at(revision, "services/chat.py", "old_chat")
+    old_factory = old_chat.ChatFactory()
+    factory = ChatFactory()
+    for action in (Action.TEXT_TO_TEXT, Action.TEXT_TO_IMAGE, Action.IMAGE_TO_IMAGE):
+        factory.get_chat_service(action)
+        before = mean_time(lambda: old_factory.get_chat_service(action), 20000)
+        after = mean_time(lambda: factory.get_chat_service(action), 200000)
+        print("{:<16} per message: {:6.2f} us, {:6.0f} bytes   shared: {:5.2f} us, {:4.0f} bytes".format(
+            action.value, before * 1e6, allocated(lambda: old_factory.get_chat_service(action)),
+            after * 1e6, allocated(lambda: factory.get_chat_service(action))))
+
+
+if __name__ == "__main__":
+    main()
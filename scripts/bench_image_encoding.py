@@ -0,0 +1,36 @@
+"""
+Size and encoding time of an upload resized for Stability AI, in each format of `ImageEncoding`. Compression depends
+on the content, so the script takes real photos.
+
+Usage: python -m scripts.bench_image_encoding photo.jpg [photo.png ...]
+"""
+import os
+import sys
+
+from PIL import Image
+
+from scripts.bench_utils import mean_time
+from utils.image import ImageEncoding, crop_and_resize_image, image_to_bytes
+
+ENCODINGS = (
+    ("PNG", ImageEncoding("PNG")),
+    ("JPEG q85 progressive", ImageEncoding("JPEG", 85, True)),
+    ("JPEG q92", ImageEncoding("JPEG", 92)),
+    ("WEBP q80", ImageEncoding("WEBP", 80)),
+)
+
+
+def main():
+    if len(sys.argv) < 2:
+        sys.exit(__doc__.strip())
+    for path in sys.argv[1:]:
+        resized = crop_and_resize_image(Image.open(path))
+        print("{} resized to {}x{}".format(os.path.basename(path), *resized.size))
+        for name, encoding in ENCODINGS:
+            size = len(image_to_bytes(resized, encoding))
+            duration = mean_time(lambda: image_to_bytes(resized, encoding), 20)
+            print("  {:<22} {:5.0f} KB  {:6.1f} ms".format(name, size / 1024, duration * 1e3))
+
+
+if __name__ == "__main__":
+    main()
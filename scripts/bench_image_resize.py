@@ -0,0 +1,103 @@
+"""
+Longest time the gevent hub is blocked while an upload is resized, before the resizing moved to worker processes,
+with the new inline resizing and with `ImageEngine`. The uploads are synthetic noisy photos, which compress like
+real ones. The previous `utils/image.py` is loaded from git.
+
+Usage: python -m scripts.bench_image_resize <revision>
+
+`revision` is any git revision whose `utils/image.py` still resizes the uploads inline, e.g. the parent of the
+commit that moved the resizing to worker processes.
+"""
+from gevent import monkey
+
+# Patched as in the gunicorn gevent workers
+monkey.patch_all()
+
+import base64  # noqa: E402
+import io  # noqa: E402
+import random  # noqa: E402
+import sys  # noqa: E402
+import time  # noqa: E402
+
+import gevent  # noqa: E402
+from PIL import Image  # noqa: E402
+
+from scripts.bench_utils import load_module_at, mean_time  # noqa: E402
+from utils import image  # noqa: E402
+from utils.exceptions import InvalidImageInput  # noqa: E402
+
+
+UPLOADS = (
+    ("12MP JPEG 4032x3024", (4032, 3024), "JPEG"),
+    ("12MP JPEG 3024x4032", (3024, 4032), "JPEG"),
+    ("FHD JPEG 1920x1080", (1920, 1080), "JPEG"),
+    ("PNG screenshot 1170x2532", (1170, 2532), "PNG"),
+)
+
+
+def photo(size, format: str) -> str:
+    noise = Image.effect_noise(size, 60).convert("RGB")
+    picture = Image.merge("RGB", [noise.getchannel(0), noise.getchannel(1).rotate(3), noise.getchannel(2)])
+    stream = io.BytesIO()
+    picture.save(stream, format=format, quality=90)
+    return base64.b64encode(stream.getvalue()).decode()
+
+
+def best_fit_size(module, size):
+    try:
+        return module.choose_best_fit_size(size)
+    except InvalidImageInput:
+        return None
+
+
+def max_hub_gap(resize, image_str: str) -> float:
+    """Longest interval between the wake-ups of a greenlet sleeping 1 ms while `resize` runs, in seconds"""
+    gaps = []
+    done = False
+
+    def tick():
+        last = time.perf_counter()
+        while not done:
+            gevent.sleep(0.001)
+            now = time.perf_counter()
+            gaps.append(now - last)
+            last = now
+
+    ticker = gevent.spawn(tick)
+    gevent.sleep(0.01)
+    resize(image_str)
+    done = True
+    ticker.join()
+    return max(gaps)
+
+
+def main():
+    if len(sys.argv) < 2:
+        sys.exit(__doc__.strip())
+    revision = sys.argv[1]
+    old_image = load_module_at(revision, "utils/image.py", "old_image")
+
+    rng = random.Random(0)
+    for _ in range(20000):
+        size = (rng.randint(1, 6000), rng.randint(1, 6000))
+        assert best_fit_size(old_image, size) == best_fit_size(image, size), size
+    before = mean_time(lambda: old_image.choose_best_fit_size((4032, 3024)), 10000)
+    after = mean_time(lambda: image.choose_best_fit_size((4032, 3024)), 10000)
+    print("choose_best_fit_size: {:.1f} us before, {:.1f} us now".format(before * 1e6, after * 1e6))
+
+    engine = image.ImageEngine(2)
+    try:
+        for name, size, format in UPLOADS:
+            image_str = photo(size, format)
+            # The first image also starts the worker processes
+            engine.resize_image(image_str)
+            print("{:<26} max hub gap before: {:4.0f} ms   inline: {:4.0f} ms   engine: {:4.0f} ms".format(
+                name, max_hub_gap(old_image.resize_image, image_str) * 1e3,
+                max_hub_gap(image.resize_image, image_str) * 1e3,
+                max_hub_gap(engine.resize_image, image_str) * 1e3))
+    finally:
+        engine.shutdown()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,66 @@
+"""
+Time `limit_prompts` against the implementation it replaced, which counted the tokens of every suffix of the history
+with a freshly looked up tiktoken encoding. The app settings of the `.env` are required to import `services.chat`.
+
+Usage: python -m scripts.bench_token_budget
+"""
+import random
+
+import tiktoken
+
+from scripts.bench_utils import mean_time
+from services.chat import DEFAULT_MODEL, TextToTextChatService, token_counter
+
+WORDS = ("the", "dinosaur", "planet", "why", "is", "sky", "blue", "ocean", "rocket", "moon", "tell", "me", "about",
+         "story", "friend", "school", "music", "play", "animal", "tree", "because", "how", "many", "stars")
+
+
+def old_num_tokens_from_messages(messages):
+    try:
+        encoding = tiktoken.encoding_for_model(DEFAULT_MODEL)
+    except KeyError:
+        encoding = tiktoken.get_encoding("cl100k_base")
+    num_tokens = 0
+    for message in messages:
+        num_tokens += 4
+        for key, value in message.items():
+            num_tokens += len(encoding.encode(value))
+            if key == "name":
+                num_tokens += -1
+    num_tokens += 2
+    return num_tokens
+
+
+def old_limit_prompts(system_prompt, message_history, max_input_tokens=2000, min_auto_acceptance_prompts=20):
+    for i in range(len(message_history)):
+        filtered_message_history = system_prompt + message_history[i:]
+        if len(filtered_message_history) - 1 <= min_auto_acceptance_prompts:
+            return filtered_message_history
+        n_tokens = old_num_tokens_from_messages(filtered_message_history)
+        if n_tokens <= max_input_tokens:
+            return filtered_message_history
+
+
+def text(rng: random.Random, words: int) -> str:
+    return " ".join(rng.choice(WORDS) for _ in range(words))
+
+
+def main():
+    rng = random.Random(0)
+    system_prompt = [{"role": "system", "content": text(rng, 400)}]
+    service = TextToTextChatService()
+    for length in (10, 100, 1000):
+        history = [{"role": ("user", "assistant")[index % 2], "content": text(rng, 45)} for index in range(length)]
+        assert service.limit_prompts(system_prompt, history) == old_limit_prompts(system_prompt, history)
+        number = 3 if length == 1000 else 20
+        before = mean_time(lambda: old_limit_prompts(system_prompt, history), number)
+        # The first turn encodes every message, the following ones only the new message
+        token_counter._counts.clear()
+        first = mean_time(lambda: service.limit_prompts(system_prompt, history), 1)
+        after = mean_time(lambda: service.limit_prompts(system_prompt, history), number)
+        print("{:>5} messages   before: {:9.2f} ms   first turn: {:7.2f} ms   next turns: {:6.2f} ms".format(
+            length, before * 1e3, first * 1e3, after * 1e3))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,27 @@
+"""Helpers of the benchmark scripts, run from the root of the repository, e.g. `python -m scripts.bench_aws_clients`"""
+import subprocess
+import sys
+import time
+import types
+from typing import Callable
+
+
+def mean_time(func: Callable[[], object], number: int) -> float:
+    """Mean duration of `number` calls of `func`, in seconds"""
+    start = time.perf_counter()
+    for _ in range(number):
+        func()
+    return (time.perf_counter() - start) / number
+
+
+def load_module_at(revision: str, path: str, name: str) -> types.ModuleType:
+    """
+    Load a module of the repository as it was at a git revision, to compare an implementation with the one it
+    replaced. The module is loaded under `name`, so it does not replace the current one.
+    """
+    source = subprocess.check_output(["git", "show", "{}:{}".format(revision, path)], text=True)
+    module = types.ModuleType(name)
+    module.__file__ = path
+    sys.modules[name] = module
+    exec(compile(source, "{}:{}".format(revision, path), "exec"), module.__dict__)
+    return module
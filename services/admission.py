@@ -0,0 +1,207 @@
+"""Admission control of the chat actions, so that a burst of one expensive action cannot starve the others"""
+import logging
+import os
+import threading
+import time
+from collections import Counter, OrderedDict, deque
+from typing import Dict, Hashable, Iterable, List, Tuple
+
+from gevent.event import Event
+
+from utils.enum.action import Action
+from utils.exceptions import ServiceOverloadedError
+
+# Speech synthesis of the text answers, admitted with the text action that produces it
+TEXT_TO_SPEECH = "text_to_speech"
+
+# Default (concurrency, queue size) of each lane, overridden by `<LANE>_CONCURRENCY` and `<LANE>_QUEUE_SIZE`
+DEFAULT_LANES = {
+    Action.TEXT_TO_TEXT: (32, 64),
+    Action.TEXT_TO_IMAGE: (4, 8),
+    Action.IMAGE_TO_IMAGE: (4, 8),
+    TEXT_TO_SPEECH: (16, 32),
+}
+ADMISSION_MAX_PER_USER = int(os.getenv("ADMISSION_MAX_PER_USER", 2))
+ADMISSION_QUEUE_TIMEOUT = float(os.getenv("ADMISSION_QUEUE_TIMEOUT", 20))
+
+
+class ActionLane:
+    """
+    Bounded number of concurrent requests of one action, with a bounded queue in front of it.
+
+    A request runs at once if a slot is free, waits in the queue otherwise, and is rejected when the queue is
+    full, when it has waited for `queue_timeout` seconds, or when its user already has `max_per_user` requests
+    running or waiting. Waiting requests are served one user at a time in turn, so a user sending many requests
+    does not delay the others.
+    """
+
+    def __init__(self, name: str, concurrency: int, queue_size: int, max_per_user: int = 2,
+                 queue_timeout: float = 20, report_every: int = 1000):
+        """
+        Args:
+            name (str): Name of the lane, used in logs and errors
+            concurrency (int): Maximum number of requests running at the same time
+            queue_size (int): Maximum number of waiting requests
+            max_per_user (int): Maximum number of running and waiting requests of a user
+            queue_timeout (float): Seconds a request waits for a slot before being rejected
+            report_every (int): Number of admitted requests between two logs of the stats
+        """
+        self.name = name
+        self.concurrency = concurrency
+        self.queue_size = queue_size
+        self.max_per_user = max_per_user
+        self.queue_timeout = queue_timeout
+        self.report_every = report_every
+        self.active = 0
+        self.queued = 0
+        self.counters = Counter()
+        # Requests of each user, running or waiting
+        self._per_user = Counter()
+        # Waiting requests of each user, the user served next comes first
+        self._waiting: Dict[Hashable, deque] = OrderedDict()
+        self._lock = threading.Lock()
+
+    def acquire(self, user: Hashable):
+        """
+        Take a slot for a request of `user`, waiting for one if needed.
+
+        Raises:
+            ServiceOverloadedError: The request is rejected
+        """
+        with self._lock:
+            if self._per_user[user] >= self.max_per_user:
+                self._reject("user_limit")
+            if self.active < self.concurrency and not self.queued:
+                self.active += 1
+                self._per_user[user] += 1
+                self._admit(0)
+                return
+            if self.queued >= self.queue_size:
+                self._reject("queue_full")
+            self._per_user[user] += 1
+            waiter = Event()
+            self._waiting.setdefault(user, deque()).append(waiter)
+            self.queued += 1
+            self.counters["max_queue_depth"] = max(self.counters["max_queue_depth"], self.queued)
+
+        start_time = time.monotonic()
+        waiter.wait(self.queue_timeout)
+        with self._lock:
+            # The slot may have been handed over right after the timeout
+            if waiter.is_set():
+                self._admit(time.monotonic() - start_time)
+                return
+            waiters = self._waiting[user]
+            waiters.remove(waiter)
+            if not waiters:
+                del self._waiting[user]
+            self.queued -= 1
+            self._release_user(user)
+            self._reject("timeout")
+
+    def release(self, user: Hashable):
+        """Give back the slot of a request, handing it over to the next waiting user if any"""
+        with self._lock:
+            self._release_user(user)
+            if not self._waiting:
+                self.active -= 1
+                return
+            next_user, waiters = next(iter(self._waiting.items()))
+            waiter = waiters.popleft()
+            if waiters:
+                # The user waits for its next request behind the other users
+                self._waiting.move_to_end(next_user)
+            else:
+                del self._waiting[next_user]
+            self.queued -= 1
+            waiter.set()
+
+    def stats(self) -> Dict[str, float]:
+        with self._lock:
+            counters = dict(self.counters)
+            active, queued = self.active, self.queued
+        admitted = counters.get("admitted", 0)
+        return {
+            **counters,
+            "active": active,
+            "queue_depth": queued,
+            "average_wait": counters.get("wait_time", 0) / admitted if admitted else 0.0,
+        }
+
+    def _admit(self, wait_time: float):
+        self.counters["admitted"] += 1
+        self.counters["wait_time"] += wait_time
+        if self.counters["admitted"] % self.report_every == 0:
+            logging.info("Lane {}: {} admitted, {} running, {} waiting, {} rejected, {:.3f}s average wait".format(
+                self.name, self.counters["admitted"], self.active, self.queued,
+                sum(count for name, count in self.counters.items() if name.startswith("rejected_")),
+                self.counters["wait_time"] / self.counters["admitted"]))
+
+    def _reject(self, reason: str):
+        self.counters["rejected_" + reason] += 1
+        logging.warning("Request rejected by lane {} ({}): {} running, {} waiting".format(
+            self.name, reason, self.active, self.queued))
+        raise ServiceOverloadedError(self.name, reason)
+
+    def _release_user(self, user: Hashable):
+        self._per_user[user] -= 1
+        if self._per_user[user] <= 0:
+            del self._per_user[user]
+
+
+class AdmissionTicket:
+    """Slots taken by a request, released once"""
+
+    def __init__(self, slots: List[Tuple[ActionLane, Hashable]]):
+        self.slots = slots
+
+    def release(self):
+        slots, self.slots = self.slots, []
+        for lane, user in reversed(slots):
+            lane.release(user)
+
+
+class AdmissionController:
+    """Lanes of the chat actions"""
+
+    def __init__(self, lanes: Iterable[ActionLane]):
+        self.lanes = {lane.name: lane for lane in lanes}
+
+    def admit(self, user: Hashable, *names: str) -> AdmissionTicket:
+        """
+        Take a slot in each of the named lanes, names without a lane are not limited.
+
+        Raises:
+            ServiceOverloadedError: A lane rejects the request, the slots already taken are released
+        """
+        ticket = AdmissionTicket([])
+        try:
+            for name in names:
+                lane = self.lanes.get(name)
+                if lane is not None:
+                    lane.acquire(user)
+                    ticket.slots.append((lane, user))
+        except ServiceOverloadedError:
+            ticket.release()
+            raise
+        return ticket
+
+    def stats(self) -> Dict[str, Dict[str, float]]:
+        return {name: lane.stats() for name, lane in self.lanes.items()}
+
+
+def create_admission_controller(max_per_user: int = ADMISSION_MAX_PER_USER,
+                                queue_timeout: float = ADMISSION_QUEUE_TIMEOUT) -> AdmissionController:
+    """Create the lanes of `DEFAULT_LANES`, with the sizes set in the environment"""
+    lanes = []
+    for name, (concurrency, queue_size) in DEFAULT_LANES.items():
+        name = getattr(name, "value", name)
+        prefix = name.upper()
+        lanes.append(ActionLane(
+            name,
+            int(os.getenv(prefix + "_CONCURRENCY", concurrency)),
+            int(os.getenv(prefix + "_QUEUE_SIZE", queue_size)),
+            max_per_user,
+            queue_timeout,
+        ))
+    return AdmissionController(lanes)
@@ -1,19 +1,32 @@
+import atexit
 import json
 import logging
-import sys
+import random
+import tempfile
+import threading
+import time
 import uuid
+from typing import Dict, Iterable, Optional, Tuple
 
 import boto3
 import os
-import requests
+from botocore.config import Config
 from botocore.exceptions import NoCredentialsError, ClientError
 
 from dotenv import load_dotenv, find_dotenv
 
 from requests_aws4auth import AWS4Auth
 
+from services.context_store import InMemoryContextStore, create_context_store
+from services.http_client import get_session
+from services.quota import QuotaEngine
+from services.resilience import get_breaker
+from services.s3_upload import S3Uploader, UploadErrorCallback
+from services.write_behind import WriteBehindQueue
+from utils.cache import DiskEntry, DiskLRUCache, TTLCache
 from utils.enum.role import AppRole
-from utils.exceptions import ItemNotFoundError
+from utils.exceptions import ItemNotFoundError, UpstreamUnavailableError
+from utils.image import encode_image
 from utils.time import get_current_hour, get_month_dates
 
 from utils.custom import handle_highlight_open_search
@@ -33,13 +46,75 @@ COGNITO_USER_POOL_ID = os.getenv('COGNITO_USER_POOL_ID')
 COGNITO_CLIENT_ID = os.getenv('COGNITO_CLIENT_ID')
 COGNITO_ISSUER = f'https://cognito-idp.{AWS_REGION}.amazonaws.com/{COGNITO_USER_POOL_ID}'
 OPENSEARCH_DOMAIN_ENDPOINT = os.getenv('OPENSEARCH_DOMAIN_ENDPOINT')
+OPENSEARCH_MESSAGE_ALIAS = os.getenv('OPENSEARCH_MESSAGE_ALIAS', 'history-messages')
+OPENSEARCH_MESSAGE_INDEX = os.getenv('OPENSEARCH_MESSAGE_INDEX', OPENSEARCH_MESSAGE_ALIAS + '-v1')
+OPENSEARCH_MESSAGE_SHARDS = int(os.getenv('OPENSEARCH_MESSAGE_SHARDS', 3))
 LAMBDA_FUNCTION_NAME = os.getenv('LAMBDA_FUNCTION_NAME')
 SES_ASK_PARENT_APPROVE_TEMPLATE_NAME = os.getenv('SES_ASK_PARENT_APPROVE_TEMPLATE_NAME')
 SES_EMAIL_SOURCE = os.getenv('SES_EMAIL_SOURCE')
 SES_CONFIGURATION_SET = os.getenv('SES_CONFIGURATION_SET')
 PROMPT_VERSION = os.getenv("PROMPT_VERSION")
 PROMPT_BUCKET_NAME = os.getenv("PROMPT_BUCKET_NAME")
+PROMPT_CACHE_TTL = int(os.getenv("PROMPT_CACHE_TTL", 300))
+PROMPT_CACHE_SIZE = int(os.getenv("PROMPT_CACHE_SIZE", 256))
 RETRIES_TO_ACCESS_OPENSEARCH = 3
+AWS_MAX_POOL_CONNECTIONS = int(os.getenv('AWS_MAX_POOL_CONNECTIONS', 50))
+AWS_CONNECT_TIMEOUT = float(os.getenv('AWS_CONNECT_TIMEOUT', 5))
+AWS_READ_TIMEOUT = float(os.getenv('AWS_READ_TIMEOUT', 30))
+AWS_MAX_ATTEMPTS = int(os.getenv('AWS_MAX_ATTEMPTS', 3))
+MESSAGE_WRITE_BEHIND = os.getenv('MESSAGE_WRITE_BEHIND', 'true').lower() == 'true'
+MESSAGE_QUEUE_SIZE = int(os.getenv('MESSAGE_QUEUE_SIZE', 2000))
+MESSAGE_FLUSH_INTERVAL = float(os.getenv('MESSAGE_FLUSH_INTERVAL', 0.1))
+MESSAGE_SPILL_PATH = os.getenv('MESSAGE_SPILL_PATH', 'message_spill.jsonl')
+DYNAMODB_BATCH_SIZE = 25
+DYNAMODB_BATCH_ATTEMPTS = 5
+# The workers share the message queue of Socket.IO by default, see `main.py`
+CONTEXT_STORE_URL = os.getenv('CONTEXT_STORE_URL', os.getenv('SOCKETIO_MESSAGE_QUEUE'))
+GUNICORN_WORKERS = int(os.getenv('GUNICORN_WORKERS', 1))
+CONTEXT_WINDOW = int(os.getenv('CONTEXT_WINDOW', 40))
+CONTEXT_IDLE_TTL = int(os.getenv('CONTEXT_IDLE_TTL', 1800))
+CONTEXT_CACHE_SIZE = int(os.getenv('CONTEXT_CACHE_SIZE', 2000))
+# Quotas gate the admission of the messages, they are not overrun unless a local allowance is set
+QUOTA_ALLOWANCE = int(os.getenv('QUOTA_ALLOWANCE', 0))
+QUOTA_LEASE_TTL = float(os.getenv('QUOTA_LEASE_TTL', 30))
+QUOTA_FLUSH_INTERVAL = float(os.getenv('QUOTA_FLUSH_INTERVAL', 1))
+S3_MULTIPART_THRESHOLD = int(os.getenv('S3_MULTIPART_THRESHOLD', 8 * 1024 * 1024))
+S3_MULTIPART_CONCURRENCY = int(os.getenv('S3_MULTIPART_CONCURRENCY', 4))
+S3_MAX_BACKGROUND_UPLOADS = int(os.getenv('S3_MAX_BACKGROUND_UPLOADS', 32))
+# `redirect` sends the clients to a presigned URL of the image, `proxy` serves the image from a disk cache
+IMAGE_SERVE_MODE = os.getenv('IMAGE_SERVE_MODE', 'proxy')
+PRESIGNED_URL_EXPIRATION = int(os.getenv('PRESIGNED_URL_EXPIRATION', 3600))
+# A cached presigned URL is renewed this many seconds before it expires
+PRESIGNED_URL_MARGIN = int(os.getenv('PRESIGNED_URL_MARGIN', 300))
+PRESIGNED_URL_CACHE_SIZE = int(os.getenv('PRESIGNED_URL_CACHE_SIZE', 4096))
+IMAGE_CACHE_DIR = os.getenv('IMAGE_CACHE_DIR', os.path.join(tempfile.gettempdir(), 'image-cache'))
+IMAGE_CACHE_MAX_BYTES = int(os.getenv('IMAGE_CACHE_MAX_BYTES', 512 * 1024 * 1024))
+IMAGE_CHUNK_SIZE = 64 * 1024
+
+# Shared by every boto3 client of the process
+client_config = Config(
+    max_pool_connections=AWS_MAX_POOL_CONNECTIONS,
+    connect_timeout=AWS_CONNECT_TIMEOUT,
+    read_timeout=AWS_READ_TIMEOUT,
+    retries={'max_attempts': AWS_MAX_ATTEMPTS, 'mode': 'standard'},
+    tcp_keepalive=True
+)
+
+# Raw prompt templates keyed by (PROMPT_VERSION, agent_name, age_range)
+prompt_cache = TTLCache(maxsize=PROMPT_CACHE_SIZE, ttl=PROMPT_CACHE_TTL)
+
+# Presigned GET URLs of the private images, keyed by image key
+presigned_url_cache = TTLCache(maxsize=PRESIGNED_URL_CACHE_SIZE, ttl=PRESIGNED_URL_EXPIRATION - PRESIGNED_URL_MARGIN)
+
+# Private images served by the proxy, keyed by image key
+image_cache = DiskLRUCache(IMAGE_CACHE_DIR, IMAGE_CACHE_MAX_BYTES)
+atexit.register(image_cache.clear)
+
+# Latest message records of the active conversations, in Redis if `CONTEXT_STORE_URL` is set
+context_store = create_context_store(CONTEXT_STORE_URL, CONTEXT_WINDOW, CONTEXT_IDLE_TTL, CONTEXT_CACHE_SIZE)
+if GUNICORN_WORKERS > 1 and isinstance(context_store, InMemoryContextStore):
+    # A delete handled by another worker would leave the window of this one stale
+    raise RuntimeError("More than one worker requires CONTEXT_STORE_URL (or SOCKETIO_MESSAGE_QUEUE) to be a Redis URL")
 
 session = boto3.Session(region_name=AWS_REGION)
 credentials = session.get_credentials()
@@ -50,33 +125,84 @@ awsauth = AWS4Auth(
     'es',
     session_token=credentials.token
 )
+# Requests to OpenSearch are signed by the shared session
+get_session('opensearch', auth=awsauth)
+
+clients = {}
+clients_lock = threading.Lock()
+# Whether the shared message index and its alias are known to exist in this process
+message_index_ready = False
+message_index_lock = threading.Lock()
+
+opensearch_breaker = get_breaker('opensearch')
+
+# Uploads of the registered images, through the shared S3 client
+image_uploader = S3Uploader(
+    lambda: get_client('s3'),
+    multipart_threshold=S3_MULTIPART_THRESHOLD,
+    multipart_chunksize=S3_MULTIPART_THRESHOLD,
+    max_concurrency=S3_MULTIPART_CONCURRENCY,
+    max_background=S3_MAX_BACKGROUND_UPLOADS,
+)
 
 
 def regenerate_session():
     global session, credentials, awsauth
-    session = boto3.Session(region_name=AWS_REGION)
-    credentials = session.get_credentials()
-    awsauth = AWS4Auth(
-        credentials.access_key,
-        credentials.secret_key,
-        AWS_REGION,
-        'es',
-        session_token=credentials.token
-    )
+    with clients_lock:
+        session = boto3.Session(region_name=AWS_REGION)
+        credentials = session.get_credentials()
+        awsauth = AWS4Auth(
+            credentials.access_key,
+            credentials.secret_key,
+            AWS_REGION,
+            'es',
+            session_token=credentials.token
+        )
+        get_session('opensearch', auth=awsauth)
+        # Clients and presigned URLs are bound to the credentials of the previous session
+        clients.clear()
+        presigned_url_cache.invalidate()
 
 
-def generate_presigned_url(object_name, expiration=6800, bucket_name=AWS_PRIVATE_BUCKET_NAME, action='put_object'):
+def get_client(service_name: str):
+    """
+    Get the boto3 client of a service, created once per process (and per session).
+
+    Creating a client loads the service model, the endpoint resolver and a new connection pool, which costs more
+    than most of the calls it is used for. Clients are thread-safe, so a single one is shared by all greenlets.
+
+    Args:
+        service_name (str): Name of the AWS service, e.g. `dynamodb`, `s3`
+
+    Returns:
+        The boto3 client of the service.
+    """
+    client = clients.get(service_name)
+    if client is None:
+        with clients_lock:
+            client = clients.get(service_name)
+            if client is None:
+                client = session.client(service_name, config=client_config)
+                clients[service_name] = client
+    return client
+
+
+def generate_presigned_url(object_name, expiration=6800, bucket_name=AWS_PRIVATE_BUCKET_NAME, action='put_object',
+                           content_type=None):
     """Generate a pre-signed URL for uploading a photo or message to S3"""
-    s3_client = session.client('s3')
+    s3_client = get_client('s3')
+    params = {
+        'Bucket': bucket_name,
+        'Key': object_name
+    }
+    if content_type is not None:
+        # The upload must then send the same Content-Type header
+        params['ContentType'] = content_type
 
     try:
         presigned_url = s3_client.generate_presigned_url(
             action,
-            Params={
-                'Bucket': bucket_name,
-                'Key': object_name
-                # 'ContentType': "image/jpeg"
-            },
+            Params=params,
             ExpiresIn=expiration
         )
         return presigned_url
@@ -86,8 +212,9 @@ def generate_presigned_url(object_name, expiration=6800, bucket_name=AWS_PRIVATE
         return None
 
 
-def upload_image_to_s3(image_data, presigned_url):
-    res = requests.put(presigned_url, data=image_data)
+def upload_image_to_s3(image_data, presigned_url, content_type=None):
+    headers = {'Content-Type': content_type} if content_type is not None else None
+    res = get_session('s3').put(presigned_url, data=image_data, headers=headers)
     return res
 
 
@@ -102,65 +229,164 @@ def save_message_history_to_s3(message_history, presigned_url):
     Returns:
         Response: Response of the upload request.
     """
-    res = requests.put(
+    res = get_session('s3').put(
         presigned_url,
         data=json.dumps(message_history)
     )
     return res
 
 
-def get_image_from_s3(image_key):
-    """Retrieve image from a private S3 bucket.
-    The strategy is to request S3 bucket to generate a presigned URL, then make a get request from the URL."""
-    # Check if image_key is a URL, this is experimental for dev environment.
+def get_image_url(image_key: str) -> Tuple[str, float]:
+    """
+    Get a presigned GET URL of a private image, reused until `PRESIGNED_URL_MARGIN` seconds before it expires.
+
+    Returns:
+        Tuple: the URL and the number of seconds it can still be reused
+    """
     if is_url(image_key):
-        presigned_url = image_key
-    else:
-        presigned_url = generate_presigned_url(image_key, action='get_object')
-    res = requests.get(presigned_url)
-    if res.status_code == 200:
-        return res.content
+        # Check if image_key is a URL, this is experimental for dev environment.
+        return image_key, 0
+    entry = presigned_url_cache.get_entry(image_key)
+    now = presigned_url_cache.timer()
+    if entry is None or entry.is_expired(now):
+        presigned_url = generate_presigned_url(image_key, expiration=PRESIGNED_URL_EXPIRATION, action='get_object')
+        if presigned_url is None:
+            raise ConnectionError("Cannot sign the URL of the image")
+        presigned_url_cache.set(image_key, presigned_url)
+        entry = presigned_url_cache.get_entry(image_key)
+    return entry.value, max(entry.expires_at - now, 0)
+
+
+def open_image_from_s3(image_key: str) -> Tuple[Iterable[bytes], Dict[str, Optional[str]]]:
+    """
+    Open a private image of S3 as a stream.
+
+    Returns:
+        Tuple: the chunks of the image and its metadata, i.e. its `etag` and `content_type`
+
+    Raises:
+        ConnectionError: The image cannot be retrieved
+    """
+    if is_url(image_key):
+        res = get_session('s3').get(image_key, stream=True)
+        if res.status_code != 200:
+            raise ConnectionError(f"Cannot retrieve image. Status code: {res.status_code} - Details: {res.content}")
+        metadata = {"etag": res.headers.get("ETag"), "content_type": res.headers.get("Content-Type")}
+        chunks = res.iter_content(IMAGE_CHUNK_SIZE)
     else:
-        raise ConnectionError(f"Cannot retrieve image. Status code: {res.status_code} - Details: {res.content}")
+        try:
+            obj = get_client('s3').get_object(Bucket=AWS_PRIVATE_BUCKET_NAME, Key=image_key)
+        except ClientError as e:
+            raise ConnectionError(f"Cannot retrieve image. Details: {e}") from e
+        metadata = {"etag": obj.get("ETag"), "content_type": obj.get("ContentType")}
+        chunks = obj["Body"].iter_chunks(IMAGE_CHUNK_SIZE)
+    if metadata["etag"]:
+        metadata["etag"] = metadata["etag"].strip('"')
+    return chunks, metadata
 
 
-def get_system_prompt(agent_name: str, user_age: int, username: str):
-    agent_name = agent_name.lower()
+def get_cached_image(image_key: str) -> DiskEntry:
+    """Get the file of a private image in the disk cache, downloading it on a miss"""
+    return image_cache.get_or_load(image_key, lambda: open_image_from_s3(image_key))
+
+
+def get_age_range(user_age: int) -> str:
+    """Age range of the prompt templates"""
     if user_age <= 11:
-        age_range = '6-11'
+        return '6-11'
     elif user_age <= 15:
-        age_range = '12-15'
+        return '12-15'
     else:
-        age_range = '16-18'
+        return '16-18'
 
-    s3_client = session.client('s3')
-    try:
-        agent_key = '{}/agent/general/{}.md'.format(PROMPT_VERSION, agent_name)
-        agent_prompt_response = s3_client.get_object(
-            Bucket=PROMPT_BUCKET_NAME,
-            Key=agent_key
-        )
-        if 'Body' in agent_prompt_response:
-            agent_prompt = agent_prompt_response.get('Body').read().decode("utf-8")
-        else:
-            raise ItemNotFoundError("Customized agent prompt not found")
 
-        age_key = '{}/age/{}.md'.format(PROMPT_VERSION, age_range)
-        age_prompt_response = s3_client.get_object(
-            Bucket=PROMPT_BUCKET_NAME,
-            Key=age_key
-        )
-        if 'Body' in age_prompt_response:
-            age_prompt = age_prompt_response.get('Body').read().decode("utf-8")
-            age_prompt = age_prompt.format(age=user_age, name=username)
-        else:
-            raise ItemNotFoundError("Customized age prompt not found")
+def get_system_prompt(agent_name: str, user_age: int, username: str):
+    agent_name = agent_name.lower()
+    age_range = get_age_range(user_age)
+
+    templates = get_system_prompt_templates(agent_name, age_range)
+    age_prompt = templates['age']['template'].format(age=user_age, name=username)
+    full_system_prompt = templates['agent']['template'] + '\n\n' + age_prompt
+    return full_system_prompt
 
-        full_system_prompt = agent_prompt + '\n\n' + age_prompt
-        return full_system_prompt
+
+def get_system_prompt_templates(agent_name: str, age_range: str):
+    """
+    Get the raw agent and age prompt templates, served from `prompt_cache` while they are fresh.
+    Expired templates are revalidated on S3 with their ETag and are only downloaded again if they have changed.
+
+    Returns:
+        Dict: `agent` and `age` entries, each with the `template` and its `etag`
+    """
+    cache_key = (PROMPT_VERSION, agent_name, age_range)
+    templates = prompt_cache.get(cache_key)
+    if templates is not None:
+        return templates
+
+    cached_entry = prompt_cache.get_entry(cache_key)
+    stale_templates = cached_entry.value if cached_entry else {}
+    s3_client = get_client('s3')
+    try:
+        templates = {
+            'agent': get_prompt_template(
+                s3_client,
+                '{}/agent/general/{}.md'.format(PROMPT_VERSION, agent_name),
+                stale_templates.get('agent'),
+                "Customized agent prompt not found"
+            ),
+            'age': get_prompt_template(
+                s3_client,
+                '{}/age/{}.md'.format(PROMPT_VERSION, age_range),
+                stale_templates.get('age'),
+                "Customized age prompt not found"
+            )
+        }
     except ClientError as e:
+        if stale_templates:
+            logging.warning("Fail to revalidate prompts {}, serving the cached version: {}".format(cache_key, e))
+            prompt_cache.touch(cache_key)
+            return stale_templates
         raise Exception(str(e))
 
+    prompt_cache.set(cache_key, templates)
+    return templates
+
+
+def get_prompt_template(s3_client, key: str, cached_template=None, not_found_message="Prompt not found"):
+    """Download a prompt template from S3, or revalidate `cached_template` with a conditional request"""
+    params = {'Bucket': PROMPT_BUCKET_NAME, 'Key': key}
+    if cached_template and cached_template.get('etag'):
+        params['IfNoneMatch'] = cached_template['etag']
+    try:
+        response = s3_client.get_object(**params)
+    except ClientError as e:
+        if cached_template and e.response.get('ResponseMetadata', {}).get('HTTPStatusCode') == 304:
+            return cached_template
+        raise e
+
+    if 'Body' not in response:
+        raise ItemNotFoundError(not_found_message)
+    return {
+        'template': response.get('Body').read().decode("utf-8"),
+        'etag': response.get('ETag')
+    }
+
+
+def invalidate_system_prompt_cache(agent_name: str = None):
+    """
+    Drop cached prompt templates, e.g. after new prompts have been uploaded.
+
+    Args:
+        agent_name (str, optional): Only drop the templates of this agent. Drop all templates if None.
+
+    Returns:
+        int: Number of removed entries
+    """
+    if agent_name is None:
+        return prompt_cache.invalidate()
+    agent_name = agent_name.lower()
+    return prompt_cache.invalidate(lambda key: key[1] == agent_name)
+
 
 def get_message_history(message_url):
     """
@@ -173,7 +399,7 @@ def get_message_history(message_url):
         Dict: message history
     """
     try:
-        res = requests.get(message_url)
+        res = get_session('s3').get(message_url)
         json_data = res.json()
         return json_data
     except Exception as e:
@@ -181,45 +407,48 @@ def get_message_history(message_url):
         return None
 
 
-def register_image(image_data: bytes, id: int, des: str = "chat_history") -> object:
+def register_image(image_data: bytes, id: int, des: str = "chat_history", wait: bool = True,
+                   on_error: Optional[UploadErrorCallback] = None) -> object:
     """
-    Register an image by assigning a URL to the image, then upload the image to S3 bucket.
+    Register an image by assigning a URL to the image, then upload the image to S3 bucket. The image is stored in
+    the encoding of `des`, see `utils.image.IMAGE_ENCODINGS`.
 
     Args:
-        image_data (bytes): Image data
+        image_data (bytes): Image data, in any format readable by PIL
         id (int): Depends on the dest:
             If des = "user_avatar", this will be user_id.
             If des = "parent", this will be parent_id
             If des = "app_report", this won't be considered.
             If des = "chat_history", this will be message_id.
         des (str): Define how the key format is generated.
+        wait (bool): Whether to wait for the upload. If False, the URL is returned right away and the image is
+            uploaded in the background.
+        on_error (Callable, optional): Called with the key and the error if the background upload fails
 
     Returns:
         image_url (str): The link to assigned image url
-        image_size (int): Image size
+        image_size (int): Image size, in bytes
     """
     if des == "chat_history":
-        image_key = f'chat_history/{id}/images/{uuid.uuid4()}.jpg'
+        image_key = f'chat_history/{id}/images/{uuid.uuid4()}'
         bucket_name = AWS_PUBLIC_BUCKET_NAME
     elif des == "app_report":
-        image_key = f'reports/{uuid.uuid4()}.jpg'
+        image_key = f'reports/{uuid.uuid4()}'
         bucket_name = AWS_PUBLIC_BUCKET_NAME
     elif des == "user_avatar":
-        image_key = f'avatar/user/{id}/{uuid.uuid4()}.jpg'
+        image_key = f'avatar/user/{id}/{uuid.uuid4()}'
         bucket_name = AWS_PUBLIC_BUCKET_NAME
     elif des == "parent_avatar":
-        image_key = f'avatar/parent/{id}/{uuid.uuid4()}.jpg'
+        image_key = f'avatar/parent/{id}/{uuid.uuid4()}'
         bucket_name = AWS_PUBLIC_BUCKET_NAME
     else:
         raise ValueError("Unavailable `dest` type, {} found".format(des))
-    assigned_url = generate_presigned_url(object_name=image_key, bucket_name=bucket_name)
-    upload_res = upload_image_to_s3(image_data, assigned_url)
-    if upload_res.status_code == 200:
-        image_url = f"https://{bucket_name}.s3.{AWS_REGION}.amazonaws.com/{image_key}"
-        image_size = sys.getsizeof(image_data)
-        return image_url, image_size
-    else:
-        raise ConnectionError("Fail to generate or upload image")
+    image_data, encoding = encode_image(image_data, des)
+    image_key = f'{image_key}.{encoding.extension}'
+    image_uploader.upload(image_data, bucket_name, image_key, encoding.content_type, wait=wait, on_error=on_error)
+    image_url = f"https://{bucket_name}.s3.{AWS_REGION}.amazonaws.com/{image_key}"
+    image_size = len(image_data)
+    return image_url, image_size
 
 
 def delete_message_history(message_url):
@@ -230,7 +459,7 @@ def delete_message_history(message_url):
         message_url (str): Path to the json file on AWS S3 bucket which stores the message history
     """
     try:
-        res = requests.delete(message_url)
+        res = get_session('s3').delete(message_url)
         logging.info(res.json())
         if res.status_code == 200:
             return res.json()
@@ -253,7 +482,7 @@ def delete_image(message_url):
 
 
 def get_cognito_public_keys():
-    response = requests.get(f'{COGNITO_ISSUER}/.well-known/jwks.json')
+    response = get_session('cognito').get(f'{COGNITO_ISSUER}/.well-known/jwks.json')
     json_response = response.json()
     if 'keys' not in json_response:
         raise AttributeError("Connection to third-party services is incorrect.")
@@ -269,17 +498,7 @@ def filter_json_response(json_response):
     Returns:
         _type_: _description_
     """
-    items = []
-    for item in json_response["Items"]:
-        filtered_item = {
-            "content": item["content"]["S"],
-            "history_message_id": int(item["history_message_id"]["N"]),
-            "role": item["role"]["S"],
-            "timestamp": item["timestamp"]["S"],
-            "links": item["links"]["SS"] if "links" in item else [],
-            "next_questions": item["next_questions"]["SS"] if "next_questions" in item else []
-        }
-        items.append(filtered_item)
+    items = [format_message_item(item) for item in json_response["Items"]]
     filtered_json_response = {
         "data": items[::-1],
         "count": json_response.get("Count"),
@@ -289,10 +508,26 @@ def filter_json_response(json_response):
     return filtered_json_response
 
 
+def format_message_item(item):
+    """Convert a message item of DynamoDB to a message record"""
+    return {
+        "content": item["content"]["S"],
+        "history_message_id": int(item["history_message_id"]["N"]),
+        "role": item["role"]["S"],
+        "timestamp": item["timestamp"]["S"],
+        "links": item["links"]["SS"] if "links" in item else [],
+        "next_questions": item["next_questions"]["SS"] if "next_questions" in item else []
+    }
+
+
 def save_message_record(history_message_id, role, content, timestamp,
                         links=None, next_questions=None, **kwargs):
     """Save message history to Amazon DynamoDB and Amazon OpenSearch.
 
+    The record is queued in `message_writer` and written in batches in the background. It is written synchronously
+    when the write-behind queue is disabled or full. The record is also appended to the conversation window of
+    `context_store`.
+
     Args:
         history_message_id (int): The ID of history message conversation
         role (str): Either user, assistant, image, and user_image for OpenAI GPT API
@@ -304,17 +539,30 @@ def save_message_record(history_message_id, role, content, timestamp,
     Return:
         item (Dict): Input item
     """
+    record = {
+        "history_message_id": history_message_id,
+        "role": role,
+        "content": content,
+        "timestamp": timestamp,
+        "links": links or [],
+        "next_questions": next_questions or []
+    }
+    if MESSAGE_WRITE_BEHIND and message_writer.put(record):
+        context_store.append(history_message_id, record)
+        return build_message_item(content, history_message_id, links, next_questions, role, timestamp)
+
     try:
         item = store_message_record_to_dynamodb(content, history_message_id, links, next_questions, role, timestamp)
         store_message_record_to_opensearch(content, history_message_id, links, next_questions, role, timestamp)
+        context_store.append(history_message_id, record)
         return item
     except ClientError as e:
         logging.info("An error occurred during insertion to DynamoDB: {}".format(e))
         raise e
 
 
-def store_message_record_to_dynamodb(content, history_message_id, links, next_questions, role, timestamp):
-    dynamodb_client = session.client('dynamodb')
+def build_message_item(content, history_message_id, links, next_questions, role, timestamp):
+    """Build the DynamoDB item of a message record"""
     item = {
         "history_message_id": {"N": str(history_message_id)},
         "timestamp": {"S": timestamp},
@@ -325,38 +573,260 @@ def store_message_record_to_dynamodb(content, history_message_id, links, next_qu
         item.update({"links": {"SS": links}})
     if next_questions:
         item.update({"next_questions": {"SS": next_questions}})
+    return item
+
+
+def store_message_record_to_dynamodb(content, history_message_id, links, next_questions, role, timestamp):
+    dynamodb_client = get_client('dynamodb')
+    item = build_message_item(content, history_message_id, links, next_questions, role, timestamp)
     dynamodb_client.put_item(TableName=MESSAGE_TABLE_NAME, Item=item)
     return item
 
 
 def store_message_record_to_opensearch(content, history_message_id, links, next_questions, role, timestamp):
-    item = {
+    store_message_records_to_opensearch([{
         "history_message_id": history_message_id,
         "timestamp": timestamp,
         "content": content,
         "role": role
+    }])
+
+
+def get_message_record_key(record):
+    return int(record["history_message_id"]), record["timestamp"]
+
+
+def delete_message_record(key):
+    """Delete the DynamoDB item of a (history_message_id, timestamp) key, used by `message_writer`"""
+    history_message_id, timestamp = key
+    get_client('dynamodb').delete_item(
+        TableName=MESSAGE_TABLE_NAME,
+        Key={
+            "timestamp": {"S": timestamp},
+            "history_message_id": {"N": str(history_message_id)},
+        }
+    )
+
+
+def store_message_records(records):
+    """
+    Write a batch of message records to Amazon DynamoDB and Amazon OpenSearch, used by `message_writer`.
+
+    Args:
+        records (List[Dict]): Message records, with the arguments of `save_message_record`
+
+    Returns:
+        List[Dict]: The records that could not be written to DynamoDB
+    """
+    failed = []
+    for start in range(0, len(records), DYNAMODB_BATCH_SIZE):
+        failed.extend(store_message_records_to_dynamodb(records[start:start + DYNAMODB_BATCH_SIZE]))
+    failed_keys = {get_message_record_key(record) for record in failed}
+    stored = [record for record in records if get_message_record_key(record) not in failed_keys]
+    if stored:
+        store_message_records_to_opensearch(stored)
+    return failed
+
+
+def store_message_records_to_dynamodb(records):
+    """
+    Write up to 25 message records with a single BatchWriteItem request.
+    Unprocessed items (e.g. throttled) are retried with an exponential backoff.
+
+    Returns:
+        List[Dict]: The records that are still unprocessed after `DYNAMODB_BATCH_ATTEMPTS` attempts
+    """
+    dynamodb_client = get_client('dynamodb')
+    # A batch cannot contain the same key twice, the last record wins
+    items = {
+        get_message_record_key(record): build_message_item(
+            record["content"], record["history_message_id"], record.get("links"), record.get("next_questions"),
+            record["role"], record["timestamp"]
+        )
+        for record in records
     }
-    url = OPENSEARCH_DOMAIN_ENDPOINT + '/' + str(history_message_id) + '/' + '_doc' + '/'
-    headers = {"Content-Type": "application/json"}
+    request_items = {MESSAGE_TABLE_NAME: [{"PutRequest": {"Item": item}} for item in items.values()]}
+    for attempt in range(DYNAMODB_BATCH_ATTEMPTS):
+        response = dynamodb_client.batch_write_item(RequestItems=request_items)
+        request_items = response.get('UnprocessedItems') or {}
+        if not request_items:
+            return []
+        time.sleep(min(0.05 * 2 ** attempt, 1) * (0.5 + random.random()))
+
+    unprocessed_keys = {
+        (int(request["PutRequest"]["Item"]["history_message_id"]["N"]), request["PutRequest"]["Item"]["timestamp"]["S"])
+        for request in request_items.get(MESSAGE_TABLE_NAME, [])
+    }
+    logging.info("{} message records are unprocessed by DynamoDB".format(len(unprocessed_keys)))
+    return [record for record in records if get_message_record_key(record) in unprocessed_keys]
+
+
+def request_opensearch(method, url, **kwargs):
+    """
+    Send a request to OpenSearch with the timeout of its breaker. Server errors and timeouts count as failures.
+
+    Raises:
+        UpstreamUnavailableError: The breaker of OpenSearch is open
+    """
+    with opensearch_breaker.guard() as call:
+        response = get_session('opensearch').request(method, url, timeout=call.timeout, **kwargs)
+        if response.status_code == 429 or response.status_code >= 500:
+            call.fail()
+    return response
+
+
+def ensure_message_index():
+    """
+    Create the shared index of the message records and its alias, if they do not exist yet.
+
+    All conversations are stored in the same index, and the documents of a conversation are routed to the same
+    shard by `history_message_id`, so that a search only hits one shard.
+
+    Returns:
+        bool: True if the index has been created
+    """
+    url = OPENSEARCH_DOMAIN_ENDPOINT + '/' + OPENSEARCH_MESSAGE_INDEX
+    index = {
+        "settings": {"number_of_shards": OPENSEARCH_MESSAGE_SHARDS},
+        "mappings": {
+            "_routing": {"required": True},
+            "properties": {
+                "history_message_id": {"type": "long"},
+                "timestamp": {"type": "date"},
+                "content": {"type": "text"},
+                "role": {"type": "keyword"}
+            }
+        },
+        "aliases": {OPENSEARCH_MESSAGE_ALIAS: {"is_write_index": True}}
+    }
+    for _ in range(RETRIES_TO_ACCESS_OPENSEARCH):
+        response = request_opensearch('put', url, json=index)
+        if response.status_code == 200:
+            return True
+        elif response.status_code == 400 and "resource_already_exists_exception" in response.text:
+            return False
+        elif response.status_code == 400 and "invalid_alias_name_exception" in response.text:
+            # Records indexed before the alias existed auto-created a concrete index with its name. The records
+            # are all in DynamoDB: the index can be deleted and `reindex-messages` run again.
+            raise Exception("An index named {} already exists instead of the alias, delete it and reindex the "
+                            "messages: {}".format(OPENSEARCH_MESSAGE_ALIAS, response.content.decode()))
+        elif response.status_code == 403:
+            regenerate_session()
+        else:
+            raise Exception(response.content.decode())
+    raise Exception("Fail to create the index {}".format(OPENSEARCH_MESSAGE_INDEX))
+
+
+def prepare_message_index() -> bool:
+    """
+    Create the shared message index on the first write of the process, see `ensure_message_index`.
+
+    Returns:
+        bool: False if the index could not be checked, e.g. OpenSearch is unavailable
+    """
+    global message_index_ready
+    if message_index_ready:
+        return True
+    with message_index_lock:
+        if not message_index_ready:
+            try:
+                ensure_message_index()
+            except Exception:
+                logging.exception("Fail to create the index {}".format(OPENSEARCH_MESSAGE_INDEX))
+                return False
+            message_index_ready = True
+    return True
+
+
+def store_message_records_to_opensearch(records):
+    """
+    Index message records with a single `_bulk` request, in the shared alias routed by `history_message_id`.
+
+    The index is created before the first write, and the request requires the alias, so that a write never
+    auto-creates a concrete index in its place.
+
+    Returns:
+        List[Dict]: The records that could not be indexed
+    """
+    if not prepare_message_index():
+        # The records are in DynamoDB, they are indexed again by `reindex-messages`
+        return records
+    lines = []
+    for record in records:
+        lines.append(json.dumps({"index": {
+            "_index": OPENSEARCH_MESSAGE_ALIAS,
+            "_id": "{}:{}".format(record["history_message_id"], record["timestamp"]),
+            "routing": str(record["history_message_id"])
+        }}))
+        lines.append(json.dumps({
+            "history_message_id": record["history_message_id"],
+            "timestamp": record["timestamp"],
+            "content": record["content"],
+            "role": record["role"]
+        }))
+    body = "\n".join(lines) + "\n"
+    headers = {"Content-Type": "application/x-ndjson"}
     for i in range(RETRIES_TO_ACCESS_OPENSEARCH):
-        response = requests.put(url + timestamp, auth=awsauth, json=item, headers=headers)
+        try:
+            response = request_opensearch('post', OPENSEARCH_DOMAIN_ENDPOINT + '/_bulk', data=body, headers=headers,
+                                          params={"require_alias": "true"})
+        except UpstreamUnavailableError as e:
+            # The records are in DynamoDB, they are indexed again by `reindex-messages`
+            logging.info("Skip indexing {} message records: {}".format(len(records), e))
+            return records
         if response.status_code == 403:
             regenerate_session()
         elif response.status_code == 200:
-            return None
+            result = response.json()
+            if not result.get("errors"):
+                return []
+            # Items of a bulk response are in the order of the request
+            failed = [record for record, item in zip(records, result["items"]) if "error" in item["index"]]
+            errors = [item["index"]["error"] for item in result["items"] if "error" in item["index"]]
+            logging.info("Fail to index {} message records on OpenSearch: {}".format(len(failed), errors[:3]))
+            return failed
+    logging.info("Fail to index {} message records on OpenSearch".format(len(records)))
+    return records
+
+
+# Message records are acknowledged right away and written in batches by a background worker. The records still
+# queued when the process exits are spilled to `MESSAGE_SPILL_PATH` and queued again on the next start.
+message_writer = WriteBehindQueue(
+    "message-writer",
+    write_batch=store_message_records,
+    key=get_message_record_key,
+    batch_size=DYNAMODB_BATCH_SIZE,
+    flush_interval=MESSAGE_FLUSH_INTERVAL,
+    max_size=MESSAGE_QUEUE_SIZE,
+    spill_path=MESSAGE_SPILL_PATH,
+    delete=delete_message_record
+)
+if MESSAGE_WRITE_BEHIND:
+    message_writer.recover()
+    atexit.register(message_writer.shutdown)
 
 
 def query_message_record(history_message_id, q):
-    url = OPENSEARCH_DOMAIN_ENDPOINT + '/' + str(history_message_id) + '/' + '_search' + '?sort=timestamp:desc'
+    url = OPENSEARCH_DOMAIN_ENDPOINT + '/' + OPENSEARCH_MESSAGE_ALIAS + '/' + '_search'
+    # Only the shard of the conversation is searched
+    params = {"routing": str(history_message_id)}
     data = {
         "query": {
-            "match_phrase_prefix": {
-                "content": {
-                    "query": q,
-                    "analyzer": "simple"
-                }
+            "bool": {
+                "filter": [
+                    {"term": {"history_message_id": history_message_id}}
+                ],
+                "must": [{
+                    "match_phrase_prefix": {
+                        "content": {
+                            "query": q,
+                            "analyzer": "simple"
+                        }
+                    }
+                }]
             }
         },
+        "sort": [{"timestamp": "desc"}],
         "highlight": {
             "fields": {
                 "content": {}
@@ -364,8 +834,8 @@ def query_message_record(history_message_id, q):
         }
     }
     headers = {"Content-Type": "application/json"}
-    response = requests.get(url, auth=awsauth, json=data, headers=headers)
     for _ in range(RETRIES_TO_ACCESS_OPENSEARCH):
+        response = request_opensearch('get', url, params=params, json=data, headers=headers)
         if response.status_code == 404:
             return []
         elif response.status_code == 200:
@@ -397,7 +867,7 @@ def get_message_record_from_dynamo_db(history_message_id, limit=None, last_times
             for more details.
     """
     try:
-        dynamodb_client = session.client('dynamodb')
+        dynamodb_client = get_client('dynamodb')
         query = {
             "TableName": MESSAGE_TABLE_NAME,
             "KeyConditions": {
@@ -430,6 +900,22 @@ def get_message_record_from_dynamo_db(history_message_id, limit=None, last_times
         raise e
 
 
+def get_latest_message_records(history_message_id, limit):
+    """
+    Get the latest message records of a conversation, oldest first, from `context_store` if it holds them.
+    Otherwise they are queried from DynamoDB and seed the window of the conversation.
+
+    Args:
+        history_message_id (int): The ID of history message conversation
+        limit (int): Number of records
+    """
+    records = context_store.get(history_message_id, limit)
+    if records is None:
+        records = get_message_record_from_dynamo_db(history_message_id, limit).get("data")
+        context_store.seed(history_message_id, records, complete=len(records) < limit)
+    return records
+
+
 def get_message_by_search_key_timestamp(history_message_id, limit=None, timestamp=None):
     """Get 10 previous and 10 next messages based on a provided timestamp.
 
@@ -439,7 +925,7 @@ def get_message_by_search_key_timestamp(history_message_id, limit=None, timestam
         limit (int, optional): Limit the number of records to fetch for each direction. Default is 10.
     """
 
-    dynamodb_client = session.client('dynamodb')
+    dynamodb_client = get_client('dynamodb')
     query = {
         "TableName": MESSAGE_TABLE_NAME,
         "KeyConditions": {
@@ -482,8 +968,10 @@ def delete_item_on_message_history(message_id, timestamp):
         message_id (int): The ID of history message conversation
         timestamp (str): Timestamp of the message you would like to delete
     """
+    # The record may not have been written yet, or be written again by a batch in flight
+    discarded = message_writer.discard((int(message_id), timestamp))
     try:
-        dynamodb_client = session.client('dynamodb')
+        dynamodb_client = get_client('dynamodb')
         response = dynamodb_client.delete_item(
             TableName=MESSAGE_TABLE_NAME,
             ReturnValues='ALL_OLD',
@@ -493,28 +981,53 @@ def delete_item_on_message_history(message_id, timestamp):
                 "history_message_id": {"N": str(message_id)},
             }
         )
+        context_store.remove(int(message_id), timestamp)
         status_code = response['ResponseMetadata']['HTTPStatusCode']
-        success = (status_code == 200) and ("Attributes" in response)
+        success = (status_code == 200) and ("Attributes" in response or discarded)
         return success
     except ClientError as e:
         logging.info("An error occurred during query on DynamoDB: {}".format(e))
         raise e
 
 
-def update_text_to_text_counter(user_id: int):
-    """Update text to text counter"""
-    current_hour = get_current_hour().isoformat()
+def read_text_to_text_count(counter_key):
+    """Read the text to text counter of a (user_id, hour) key"""
+    user_id, hour = counter_key
+    try:
+        dynamodb_client = get_client('dynamodb')
+        response = dynamodb_client.get_item(
+            TableName=TEXT_COUNT_CACHE_TABLE_NAME,
+            Key={
+                'user_id': {'N': str(user_id)},
+                'hour': {'S': hour}
+            }
+        )
+
+        item = response.get('Item')
+        if item:
+            return int(item['message_count']['N'])
+        else:
+            return 0
+
+    except ClientError as e:
+        logging.info("An error occurred during query on DynamoDB: {}".format(e))
+        raise e
+
+
+def add_text_to_text_count(counter_key, increment: int = 1):
+    """Add an increment to the text to text counter of a (user_id, hour) key, returns the new count"""
+    user_id, hour = counter_key
     try:
-        dynamodb_client = session.client('dynamodb')
+        dynamodb_client = get_client('dynamodb')
         response = dynamodb_client.update_item(
             TableName=TEXT_COUNT_CACHE_TABLE_NAME,
             Key={
                 'user_id': {'N': str(user_id)},
-                'hour': {'S': current_hour}
+                'hour': {'S': hour}
             },
             UpdateExpression='ADD message_count :incr',
             ExpressionAttributeValues={
-                ':incr': {'N': '1'}
+                ':incr': {'N': str(increment)}
             },
             ReturnValues='UPDATED_NEW'
         )
@@ -524,19 +1037,43 @@ def update_text_to_text_counter(user_id: int):
         raise e
 
 
-def get_text_to_text_counter(user_id: int, role: str):
-    """Get text to text counter for a user"""
-    if role == AppRole.PARENT:
-        return 0
-
-    current_hour = get_current_hour().isoformat()
+def add_text_to_text_count_below(counter_key, increment: int, limit: int):
+    """Add an increment to the text to text counter only if it is below the limit, returns None otherwise"""
+    user_id, hour = counter_key
     try:
-        dynamodb_client = session.client('dynamodb')
-        response = dynamodb_client.get_item(
+        dynamodb_client = get_client('dynamodb')
+        response = dynamodb_client.update_item(
             TableName=TEXT_COUNT_CACHE_TABLE_NAME,
             Key={
                 'user_id': {'N': str(user_id)},
-                'hour': {'S': current_hour}
+                'hour': {'S': hour}
+            },
+            UpdateExpression='ADD message_count :incr',
+            ConditionExpression='attribute_not_exists(message_count) OR message_count < :limit',
+            ExpressionAttributeValues={
+                ':incr': {'N': str(increment)},
+                ':limit': {'N': str(limit)}
+            },
+            ReturnValues='UPDATED_NEW'
+        )
+        return int(response['Attributes']['message_count']['N'])
+    except ClientError as e:
+        if e.response['Error']['Code'] == 'ConditionalCheckFailedException':
+            return None
+        logging.info("An error occurred during query on DynamoDB: {}".format(e))
+        raise e
+
+
+def read_image_generation_count(counter_key):
+    """Read the image generation counter of a (package_group_id, month_start) key"""
+    package_group_id, month_start = counter_key
+    try:
+        dynamodb_client = get_client('dynamodb')
+        response = dynamodb_client.get_item(
+            TableName=IMAGE_COUNT_CACHE_TABLE_NAME,
+            Key={
+                'package_group_id': {'N': str(package_group_id)},
+                'month_start': {'S': month_start},
             }
         )
 
@@ -551,20 +1088,20 @@ def get_text_to_text_counter(user_id: int, role: str):
         raise e
 
 
-def update_image_generation_counter(package_group_id: int, current_period_start):
-    """Update text to text counter"""
-    current_month_start = get_month_dates(current_period_start)
+def add_image_generation_count(counter_key, increment: int = 1):
+    """Add an increment to the image generation counter of a (package_group_id, month_start) key"""
+    package_group_id, month_start = counter_key
     try:
-        dynamodb_client = session.client('dynamodb')
+        dynamodb_client = get_client('dynamodb')
         response = dynamodb_client.update_item(
             TableName=IMAGE_COUNT_CACHE_TABLE_NAME,
             Key={
                 'package_group_id': {'N': str(package_group_id)},
-                'month_start': {'S': current_month_start.isoformat()},
+                'month_start': {'S': month_start},
             },
             UpdateExpression='ADD message_count :incr',
             ExpressionAttributeValues={
-                ':incr': {'N': '1'}
+                ':incr': {'N': str(increment)}
             },
             ReturnValues='UPDATED_NEW'
         )
@@ -575,32 +1112,131 @@ def update_image_generation_counter(package_group_id: int, current_period_start)
         raise e
 
 
-def get_image_generation_counter(package_group_id: int, current_period_start):
-    """Get text to text counter for a user"""
-    current_month_start = get_month_dates(current_period_start)
+def add_image_generation_count_below(counter_key, increment: int, limit: int):
+    """Add an increment to the image generation counter only if it is below the limit, returns None otherwise"""
+    package_group_id, month_start = counter_key
     try:
-        dynamodb_client = session.client('dynamodb')
-        response = dynamodb_client.get_item(
+        dynamodb_client = get_client('dynamodb')
+        response = dynamodb_client.update_item(
             TableName=IMAGE_COUNT_CACHE_TABLE_NAME,
             Key={
                 'package_group_id': {'N': str(package_group_id)},
-                'month_start': {'S': current_month_start.isoformat()},
-            }
+                'month_start': {'S': month_start},
+            },
+            UpdateExpression='ADD message_count :incr',
+            ConditionExpression='attribute_not_exists(message_count) OR message_count < :limit',
+            ExpressionAttributeValues={
+                ':incr': {'N': str(increment)},
+                ':limit': {'N': str(limit)}
+            },
+            ReturnValues='UPDATED_NEW'
         )
 
-        item = response.get('Item')
-        if item:
-            return int(item['message_count']['N'])
-        else:
-            return 0
-
+        return int(response['Attributes']['message_count']['N'])
     except ClientError as e:
+        if e.response['Error']['Code'] == 'ConditionalCheckFailedException':
+            return None
         logging.info("An error occurred during query on DynamoDB: {}".format(e))
         raise e
 
 
+def get_text_to_text_counter_key(user_id: int):
+    return user_id, get_current_hour().isoformat()
+
+
+def get_image_generation_counter_key(package_group_id: int, current_period_start):
+    return package_group_id, get_month_dates(current_period_start).isoformat()
+
+
+def update_text_to_text_counter(user_id: int):
+    """Update text to text counter"""
+    return add_text_to_text_count(get_text_to_text_counter_key(user_id))
+
+
+def get_text_to_text_counter(user_id: int, role: str):
+    """Get text to text counter for a user"""
+    if role == AppRole.PARENT:
+        return 0
+    return read_text_to_text_count(get_text_to_text_counter_key(user_id))
+
+
+def update_image_generation_counter(package_group_id: int, current_period_start):
+    """Update image generation counter"""
+    return add_image_generation_count(get_image_generation_counter_key(package_group_id, current_period_start))
+
+
+def get_image_generation_counter(package_group_id: int, current_period_start):
+    """Get image generation counter for a package group"""
+    return read_image_generation_count(get_image_generation_counter_key(package_group_id, current_period_start))
+
+
+# By default every message is admitted by one conditional increment on DynamoDB, which never overruns a quota.
+# With a `QUOTA_ALLOWANCE` above 0, counters are checked and incremented locally and written to DynamoDB in
+# aggregated updates, each process admitting at most `QUOTA_ALLOWANCE` messages per counter before reading it
+# again, at the cost of an overrun of up to `QUOTA_ALLOWANCE` messages per process.
+text_to_text_quota = QuotaEngine(
+    "text-to-text-quota",
+    read=read_text_to_text_count,
+    add=add_text_to_text_count,
+    add_below=add_text_to_text_count_below,
+    allowance=QUOTA_ALLOWANCE,
+    lease_ttl=QUOTA_LEASE_TTL,
+    flush_interval=QUOTA_FLUSH_INTERVAL
+)
+image_generation_quota = QuotaEngine(
+    "image-generation-quota",
+    read=read_image_generation_count,
+    add=add_image_generation_count,
+    add_below=add_image_generation_count_below,
+    allowance=QUOTA_ALLOWANCE,
+    lease_ttl=QUOTA_LEASE_TTL,
+    flush_interval=QUOTA_FLUSH_INTERVAL
+)
+atexit.register(text_to_text_quota.shutdown)
+atexit.register(image_generation_quota.shutdown)
+
+
+def reserve_text_to_text_usage(user_id: int, role: str, allowed_request: int):
+    """
+    Count a text to text message if the counter of the current hour is below `allowed_request` (-1 for no
+    limit). Parents are not limited and their count is reported as 0, as in `get_text_to_text_counter`.
+
+    Returns:
+        Tuple: key of the counter, to refund the message, and the new count, None if the quota is used up
+    """
+    counter_key = get_text_to_text_counter_key(user_id)
+    if role == AppRole.PARENT:
+        text_to_text_quota.reserve(counter_key)
+        return counter_key, 0
+    limit = None if allowed_request == -1 else allowed_request
+    return counter_key, text_to_text_quota.reserve(counter_key, limit)
+
+
+def refund_text_to_text_usage(counter_key):
+    """Give back a text to text message reserved by `reserve_text_to_text_usage`"""
+    text_to_text_quota.refund(counter_key)
+
+
+def reserve_image_generation_usage(package_group_id: int, current_period_start, image_generation_limit: int):
+    """
+    Count a generated image if the counter of the current month is below `image_generation_limit` (-1 for no
+    limit).
+
+    Returns:
+        Tuple: key of the counter, to refund the image, and the new count, None if the quota is used up
+    """
+    counter_key = get_image_generation_counter_key(package_group_id, current_period_start)
+    limit = None if image_generation_limit == -1 else image_generation_limit
+    return counter_key, image_generation_quota.reserve(counter_key, limit)
+
+
+def refund_image_generation_usage(counter_key):
+    """Give back an image reserved by `reserve_image_generation_usage`"""
+    image_generation_quota.refund(counter_key)
+
+
 def admin_confirm_sign_up(username):
-    client = session.client('cognito-idp')
+    client = get_client('cognito-idp')
     try:
         client.admin_confirm_sign_up(
             UserPoolId=COGNITO_USER_POOL_ID,
@@ -612,7 +1248,7 @@ def admin_confirm_sign_up(username):
 
 def cognito_disable_user(username):
     """Disable a Cognito user"""
-    client = session.client('cognito-idp')
+    client = get_client('cognito-idp')
     try:
         client.admin_disable_user(
             UserPoolId=COGNITO_USER_POOL_ID,
@@ -624,7 +1260,7 @@ def cognito_disable_user(username):
 
 def cognito_delete_user(username):
     """Delete a Cognito user"""
-    client = session.client('cognito-idp')
+    client = get_client('cognito-idp')
     try:
         client.admin_delete_user(
             UserPoolId=COGNITO_USER_POOL_ID,
@@ -636,7 +1272,7 @@ def cognito_delete_user(username):
 
 def cognito_set_password(username, password):
     """Set a new password for the user"""
-    client = session.client('cognito-idp')
+    client = get_client('cognito-idp')
     try:
         client.admin_set_user_password(
             UserPoolId=COGNITO_USER_POOL_ID,
@@ -657,7 +1293,7 @@ def invoke_progress_tracking(history_message_id, start_time):
         history_message_id: History Message ID
         start_time: Timestamp that the user entered the room. This will be tracked from the websocket.
     """
-    lambda_client = session.client('lambda')
+    lambda_client = get_client('lambda')
     try:
         payload = {
             "history_message_id": history_message_id,
@@ -684,7 +1320,7 @@ def comprehend_detect_language(text: str, threshold: float = 0.2):
     Returns:
         List[Languages]: The languages that are inferred from the text
     """
-    comprehend_client = session.client('comprehend')
+    comprehend_client = get_client('comprehend')
     try:
         response = comprehend_client.detect_dominant_language(Text=text)
         languages = response['Languages']
@@ -697,7 +1333,7 @@ def send_ses_email(recipient_email, template_name, template_data=None,
                    category="undefined", user_id="NULL", parent_id="NULL"):
     if template_data is None:
         template_data = {}
-    ses_client = session.client('sesv2')
+    ses_client = get_client('sesv2')
     try:
         response = ses_client.send_email(
             FromEmailAddress=SES_EMAIL_SOURCE,
@@ -1,46 +1,109 @@
-import base64
 import json
+import logging
 import os
+import threading
+import time
 from abc import ABC
 from datetime import datetime
-from typing import Dict, List, Optional
+from functools import partial
+from typing import Callable, Dict, List, Optional
 
 import openai
-import requests
-import tiktoken
 
 from services import aws_service
-from services.aws_service import update_text_to_text_counter, get_text_to_text_counter, get_image_generation_counter, \
-    update_image_generation_counter, comprehend_detect_language, get_system_prompt
+from services.aws_service import reserve_text_to_text_usage, refund_text_to_text_usage, \
+    reserve_image_generation_usage, refund_image_generation_usage, comprehend_detect_language, get_system_prompt, \
+    get_age_range
 from services.notification_service import generate_notification
+from services.pipeline import Pipeline
+from services.resilience import Hedger, backoff_delay, get_breaker
+from services.stability import StabilityClient
+from utils.cache import TTLCache
 from utils.chat_config import ChatConfig
 from utils.enum.action import Action
 from utils.enum.language import Language, get_language_name_from_code
 from utils.enum.role import ChatRole, AppRole
 from utils.enum.style import ImageGenerationStyle
-from utils.exceptions import ActionNotFoundError, StabilityAIRequestError, OutOfQuotaError, LanguageIncompatibleError
+from utils.exceptions import ActionNotFoundError, OutOfQuotaError, LanguageIncompatibleError
+from utils.json_stream import JSONObjectStreamParser, STRING_DELTA
+from utils.language_detection import LanguageDetector, normalize_text
+from utils.token_budget import TokenCounter, longest_fitting_suffix
 
 DEFAULT_MODEL = "gpt-3.5-turbo"
-STABILITY_TEXT_TO_IMAGE_URL = os.getenv('STABILITY_TEXT_TO_IMAGE_URL')
-STABILITY_IMAGE_TO_IMAGE_URL = os.getenv('STABILITY_IMAGE_TO_IMAGE_URL')
+
+LANGUAGE_DETECTION_THRESHOLD = float(os.getenv('LANGUAGE_DETECTION_THRESHOLD', 0.8))
+LANGUAGE_CACHE_SIZE = int(os.getenv('LANGUAGE_CACHE_SIZE', 4096))
+LANGUAGE_CACHE_TTL = int(os.getenv('LANGUAGE_CACHE_TTL', 86400))
+
+# Slow OpenAI requests are duplicated after the p95 latency, the first answer wins
+OPENAI_HEDGING = os.getenv('OPENAI_HEDGING', 'false').lower() == 'true'
+OPENAI_MAX_RETRIES = int(os.getenv('OPENAI_MAX_RETRIES', 2))
+OPENAI_BACKOFF = float(os.getenv('OPENAI_BACKOFF', 0.5))
+
+ANSWER_CACHE_SIZE = int(os.getenv('ANSWER_CACHE_SIZE', 256))
+ANSWER_CACHE_TTL = int(os.getenv('ANSWER_CACHE_TTL', 86400))
+# Longer questions are unlikely to be repeated word for word
+ANSWER_CACHE_MAX_QUESTION_LENGTH = 200
+ANSWER_CACHE_MAX_AUDIO_SIZE = int(os.getenv('ANSWER_CACHE_MAX_AUDIO_SIZE', 2 * 1024 * 1024))
+ANSWER_CACHE_REPORT_EVERY = 1000
+
+# Errors of the requests themselves, which do not tell anything about the health of OpenAI
+OPENAI_REQUEST_ERRORS = (openai.error.InvalidRequestError, openai.error.AuthenticationError,
+                         openai.error.PermissionError)
+
+token_counter = TokenCounter(DEFAULT_MODEL)
+# Errors worth retrying, when they are due to the load of OpenAI (see `is_retryable_openai_error`)
+OPENAI_RETRY_ERRORS = (openai.error.RateLimitError, openai.error.APIError, openai.error.ServiceUnavailableError,
+                       openai.error.Timeout, openai.error.APIConnectionError, openai.error.TryAgain)
+
+openai_breaker = get_breaker('openai')
+# The first chunk of a stream and a full answer have very different latencies, they are hedged separately
+openai_hedgers = {False: Hedger('openai'), True: Hedger('openai-stream')}
+
+# Answers to the first question of a conversation with their audio, keyed by
+# (prompt version, person AI id, age range, language, normalized question)
+answer_cache = TTLCache(maxsize=ANSWER_CACHE_SIZE, ttl=ANSWER_CACHE_TTL)
+
+# Comprehend is only called for the messages the local classifier is unsure about
+language_detector = LanguageDetector(
+    comprehend_detect_language,
+    threshold=LANGUAGE_DETECTION_THRESHOLD,
+    cache_size=LANGUAGE_CACHE_SIZE,
+    cache_ttl=LANGUAGE_CACHE_TTL
+)
 
 
 def num_tokens_from_messages(messages):
     """Returns the number of tokens used by a list of messages."""
-    try:
-        encoding = tiktoken.encoding_for_model(DEFAULT_MODEL)
-    except KeyError:
-        encoding = tiktoken.get_encoding("cl100k_base")
-    if True:  # note: future models may deviate from this
-        num_tokens = 0
-        for message in messages:
-            num_tokens += 4  # every message follows <im_start>{role/name}\n{content}<im_end>\n
-            for key, value in message.items():
-                num_tokens += len(encoding.encode(value))
-                if key == "name":  # if there's a name, the role is omitted
-                    num_tokens += -1  # role is always required and always 1 token
-        num_tokens += 2  # every reply is primed with <im_start>assistant
-        return num_tokens
+    return token_counter.count_messages(messages)
+
+
+def normalize_question(text: str) -> str:
+    """Question without case, spacing and surrounding punctuation differences, e.g. `Who are you?` and `who are you`"""
+    return normalize_text(text).strip(" .,;:!?¿¡…")
+
+
+def invalidate_cached_answers(person_ai_id: Optional[int] = None) -> int:
+    """
+    Drop the cached answers of a person AI, or every answer if no person AI is given.
+
+    Returns:
+        Number of removed answers.
+    """
+    if person_ai_id is None:
+        return answer_cache.invalidate()
+    return answer_cache.invalidate(lambda key: key[1] == person_ai_id)
+
+
+class CachedAnswer:
+    """Answer shared by the conversations asking the same first question, with its audio payloads"""
+
+    def __init__(self, answer: Dict, audio: List[bytes]):
+        self.answer = answer
+        self.audio = audio
+
+    def to_response(self, uuid_request: str) -> Dict:
+        return reformat_chat(role=ChatRole.ASSISTANT, uuid_request=uuid_request, **self.answer)
 
 
 def reformat_chat(role: ChatRole, content: Optional[str], uuid_request: Optional[str], links=None, next_questions=None):
@@ -76,135 +139,241 @@ def filter_message_history(message_history: List[Dict]):
 
 def call_openai_request(messages: List[Dict], configs: ChatConfig = None,
                         function_call: Optional[Dict] = None,
-                        functions: Optional[List] = None):
+                        functions: Optional[List] = None,
+                        stream: bool = False):
     call_configs = {
         "model": DEFAULT_MODEL,
         "messages": messages
         # "temperature": 0.2
     }
+    if stream:
+        call_configs.update({"stream": True})
     if function_call:
         call_configs.update({"function_call": function_call})
     if functions:
         call_configs.update({"functions": functions})
-    return openai.ChatCompletion.create(**call_configs)
+    deadline = configs.deadline if configs is not None else None
+
+    def request():
+        # A stream is guarded until the response starts, its timeout then applies to each chunk
+        with openai_breaker.guard(deadline, ignore=OPENAI_REQUEST_ERRORS) as call:
+            return openai.ChatCompletion.create(request_timeout=call.timeout, **call_configs)
+
+    hedger = openai_hedgers[stream] if OPENAI_HEDGING else None
+    for attempt in range(OPENAI_MAX_RETRIES + 1):
+        try:
+            return hedger.call(request) if hedger is not None else request()
+        except OPENAI_RETRY_ERRORS as e:
+            if attempt == OPENAI_MAX_RETRIES or not is_retryable_openai_error(e):
+                raise
+            retry_after = e.headers.get("retry-after") if e.headers else None
+            delay = backoff_delay(attempt, OPENAI_BACKOFF,
+                                  retry_after=float(retry_after) if retry_after and retry_after.isdigit() else None)
+            if deadline is not None and deadline.remaining() <= delay:
+                raise
+            logging.info("Retry OpenAI request in {:.2f}s after {}: {}".format(delay, e.__class__.__name__, e))
+            time.sleep(delay)
+
+
+def is_retryable_openai_error(error: openai.error.OpenAIError) -> bool:
+    """Rate limits and server errors are retried, an exhausted quota or an invalid request is not"""
+    if isinstance(error, openai.error.RateLimitError):
+        return error.code != "insufficient_quota"
+    if isinstance(error, openai.error.APIError):
+        return error.http_status is None or error.http_status >= 500
+    return True
 
 
 class BaseChatService(ABC):
     """
-    Base class for chat service
+    Base class for chat service. A service is created once per action by `ChatFactory` and shared by every
+    message, so it must not keep per-message state.
     """
 
-    def __init__(self):
-        # Language detection prompt
-        self.language_detect_function_call = {"name": "detect_language"}
-        self.language_detect_functions = [
-            {
-                "name": "detect_language",
-                "description": "Detect the language of a prompt",
-                "parameters": {
-                    "type": "object",
-                    "properties": {
-                        "language": {
-                            "type": "string",
-                            "enum": [e.value for e in Language],
-                            "description": "Language of a prompt, output `other` if none of the list is "
-                                           "satisfiable. Please provide the answer only from the list."
-                        }
+    # Language detection prompt, built once for every message
+    language_detect_function_call = {"name": "detect_language"}
+    language_detect_functions = [
+        {
+            "name": "detect_language",
+            "description": "Detect the language of a prompt",
+            "parameters": {
+                "type": "object",
+                "properties": {
+                    "language": {
+                        "type": "string",
+                        "enum": [e.value for e in Language],
+                        "description": "Language of a prompt, output `other` if none of the list is "
+                                       "satisfiable. Please provide the answer only from the list."
                     }
-                },
-                "required": ["language"]
-            }
-        ]
+                }
+            },
+            "required": ["language"]
+        }
+    ]
+
+    def warm_up(self):
+        """Load the resources reused by every message, so that the first message does not pay for them"""
+        pass
 
-    def run(self, user_data: Dict, configs: ChatConfig):
+    def run(self, user_data: Dict, configs: ChatConfig, context: Optional[Dict] = None,
+            on_delta: Optional[Callable[[Dict], None]] = None):
         raise NotImplementedError
 
+    def prepare(self, user_data: Dict, configs: ChatConfig) -> Dict[str, Callable]:
+        """
+        Loaders of the data required by `run` that do not depend on each other. The caller may execute them
+        concurrently and pass the results to `run` as `context`, keyed by the same names.
+        """
+        return {}
+
     def validate(self, user_data: Dict, configs: ChatConfig) -> bool:
         """Validate if user has enough quota based on package"""
         raise NotImplementedError
 
     @staticmethod
     def detect_language(message: Dict):
-        """Detect the language of the message using AWS Comprehend"""
+        """Detect the language of the message locally, or using AWS Comprehend when the local guess is unsure"""
         text = message.get("content")
-        languages = comprehend_detect_language(text)
+        languages = language_detector.detect(text)
         languages = [get_language_name_from_code(language) for language in languages]
         return languages
 
-    def update_counter(self, configs: ChatConfig) -> int:
-        """Update the number of request after a period for validation check"""
+    def refund_quota(self, configs: ChatConfig):
+        """Give back the quota reserved by `validate`, when the request has failed"""
         raise NotImplementedError
 
+    def get_answer_cache_key(self, user_data: Dict, configs: ChatConfig, context: Dict) -> Optional[tuple]:
+        """Key of the answer to the message in `answer_cache`, None if the answer cannot be shared"""
+        return None
+
+    def get_cached_answer(self, cache_key: Optional[tuple]) -> Optional[CachedAnswer]:
+        if cache_key is None:
+            return None
+        cached_answer = answer_cache.get(cache_key)
+        stats = answer_cache.stats()
+        if (stats["hits"] + stats["misses"]) % ANSWER_CACHE_REPORT_EVERY == 0:
+            logging.info("Answer cache: {} answers, {} hits, {} misses ({:.1%} hit rate), {} evictions".format(
+                stats["size"], stats["hits"], stats["misses"], stats["hit_rate"], stats["evictions"]))
+        return cached_answer
+
+    def cache_answer(self, cache_key: Optional[tuple], configs: ChatConfig, response: Dict, audio: List[bytes]):
+        """Share an answer, unless it mentions the chatter or its audio is missing or too large"""
+        if cache_key is None or not audio or sum(len(payload) for payload in audio) > ANSWER_CACHE_MAX_AUDIO_SIZE:
+            return
+        content = (response.get("content") or "").lower()
+        names = {configs.chatter.display_name, configs.chatter.username}
+        if any(name and name.lower() in content for name in names):
+            return
+        answer = {key: response.get(key) for key in ("content", "links", "next_questions")}
+        answer_cache.set(cache_key, CachedAnswer(answer, list(audio)))
+
     def check_quota(self, configs: ChatConfig):
         """Check quota for raising notification, if any"""
         raise NotImplementedError
 
 
 class TextToTextChatService(BaseChatService):
-
-    def __init__(self):
-        super().__init__()
-        self.limit = 10
-        # Function call in OpenAI
-        # (https://github.com/openai/openai-cookbook/blob/main/examples/How_to_call_functions_with_chat_models.ipynb)
-        self.function_call = {"name": "get_answer"}
-        self.functions = [
-            {
-                "name": "get_answer",
-                "description": "",
-                "parameters": {
-                    "type": "object",
-                    "properties": {
-                        "content": {
-                            "type": "string",
-                            "description": "Your response to user"
-                        },
-                        "links": {
-                            "type": "array",
-                            "description": "Around 3 links as references to your answer",
-                            "items": {
-                                "type": "string"
-                            }
-                        },
-                        "next_questions": {
-                            "type": "array",
-                            "description": "Around 3 possible next questions to be asked, if there is none,"
-                                           " you can create random questions relating to yourself.",
-                            "items": {
-                                "type": "string"
-                            }
+    limit = 10
+    # Function call in OpenAI
+    # (https://github.com/openai/openai-cookbook/blob/main/examples/How_to_call_functions_with_chat_models.ipynb)
+    function_call = {"name": "get_answer"}
+    functions = [
+        {
+            "name": "get_answer",
+            "description": "",
+            "parameters": {
+                "type": "object",
+                "properties": {
+                    "content": {
+                        "type": "string",
+                        "description": "Your response to user"
+                    },
+                    "links": {
+                        "type": "array",
+                        "description": "Around 3 links as references to your answer",
+                        "items": {
+                            "type": "string"
                         }
                     },
-                    "required": ["content", "links", "next_questions"]
-                }
+                    "next_questions": {
+                        "type": "array",
+                        "description": "Around 3 possible next questions to be asked, if there is none,"
+                                       " you can create random questions relating to yourself.",
+                        "items": {
+                            "type": "string"
+                        }
+                    }
+                },
+                "required": ["content", "links", "next_questions"]
             }
-        ]
-
-    def run(self, user_data: Dict, configs: ChatConfig):
+        }
+    ]
+
+    def warm_up(self):
+        # Loading the encoding reads and parses the whole BPE ranks file
+        token_counter.encoding
+
+    def prepare(self, user_data: Dict, configs: ChatConfig) -> Dict[str, Callable]:
+        return {
+            "system_prompt": partial(format_system_prompt, configs),
+            "message_history": partial(self.load_message_history, configs.message_id),
+        }
+
+    def load_message_history(self, message_id: int) -> List[Dict]:
+        return aws_service.get_latest_message_records(message_id, self.limit)
+
+    def get_answer_cache_key(self, user_data: Dict, configs: ChatConfig, context: Dict) -> Optional[tuple]:
+        # Only the first question of a conversation is shared, at most after the welcome message, so that an
+        # answer never depends on personal history
+        history = [record for record in context["message_history"]
+                   if record["timestamp"] != user_data.get("timestamp")]
+        if len(history) > 1 or any(record["role"] != ChatRole.ASSISTANT.value for record in history):
+            return None
+        question = normalize_question(user_data.get("content") or "")
+        if not question or len(question) > ANSWER_CACHE_MAX_QUESTION_LENGTH:
+            return None
+        return (aws_service.PROMPT_VERSION, configs.person_ai.id, get_age_range(configs.user_age),
+                configs.chatter.display_language, question)
+
+    def run(self, user_data: Dict, configs: ChatConfig, context: Optional[Dict] = None,
+            on_delta: Optional[Callable[[Dict], None]] = None):
         """
         Call to get text generation from OpenAI service.
 
         Args:
             user_data (Dict): Should contain
 
-                prompt (str): User prompt
+                content (str): User prompt
 
-                message_id (int): Message ID
+                timestamp (str): Timestamp of the user message record, if it has already been saved
 
             configs (Dict): Configurations
 
+            context (Dict, optional): Results of the loaders returned by `prepare`. Loaded sequentially if missing.
+
+            on_delta (Callable, optional): If provided, the answer is streamed and the callback receives partial
+                `content` chunks as they are generated, then `links` and `next_questions` once each is complete.
+
         Returns:
             Dict with 3 fields: `content`, `links`, and `next_questions`
         """
-        system_prompt = format_system_prompt(configs)
-
-        message_id = configs.message_id
-        message_history = aws_service.get_message_record_from_dynamo_db(message_id, self.limit).get("data")
+        if context is None:
+            context = {name: loader() for name, loader in self.prepare(user_data, configs).items()}
+        system_prompt = context["system_prompt"]
+
+        # The history may be loaded while the user message is still being saved, the user message is therefore
+        # removed from the history if found and appended at the end in both cases
+        message_history = [record for record in context["message_history"]
+                           if record["timestamp"] != user_data.get("timestamp")]
         message_history = filter_message_history(message_history)
+        message_history.append({"role": ChatRole.USER.value, "content": user_data.get("content")})
 
         filtered_message_history = self.limit_prompts(system_prompt, message_history)
-        response = call_openai_request(filtered_message_history, configs, self.function_call, self.functions)
-        bot_response = json.loads(response["choices"][0]["message"]["function_call"]["arguments"])
+        if on_delta is None:
+            response = call_openai_request(filtered_message_history, configs, self.function_call, self.functions)
+            bot_response = json.loads(response["choices"][0]["message"]["function_call"]["arguments"])
+        else:
+            bot_response = self.stream_answer(filtered_message_history, configs, on_delta)
 
         return reformat_chat(
             role=ChatRole.ASSISTANT,
@@ -212,17 +381,40 @@ class TextToTextChatService(BaseChatService):
             **bot_response
         ), None
 
+    def stream_answer(self, messages: List[Dict], configs: ChatConfig, on_delta: Callable[[Dict], None]) -> Dict:
+        """Stream the `get_answer` function call, parsing its arguments incrementally as the deltas arrive"""
+        response = call_openai_request(messages, configs, self.function_call, self.functions, stream=True)
+        parser = JSONObjectStreamParser(stream_keys=["content"])
+        arguments = []
+        for chunk in response:
+            delta = chunk["choices"][0]["delta"]
+            argument_delta = delta.get("function_call", {}).get("arguments")
+            if not argument_delta:
+                continue
+            arguments.append(argument_delta)
+            for event, key, value in parser.feed(argument_delta):
+                # `content` is forwarded chunk by chunk, the lists once they are complete
+                if event == STRING_DELTA or key in ("links", "next_questions"):
+                    on_delta({"uuid_request": configs.uuid_request, key: value})
+        return json.loads("".join(arguments))
+
     def validate(self, user_data: Dict, configs: ChatConfig):
-        allowed_request = configs.package.allowed_request
-        # Check allowed request
-        if allowed_request == -1:
-            return self.validate_languages(configs, user_data)
-        else:
-            request_within_an_hour = get_text_to_text_counter(configs.chatter.id, configs.role)
-            if request_within_an_hour < allowed_request:
-                return self.validate_languages(configs, user_data)
-            else:
-                raise OutOfQuotaError("Out of text-to-text quota")
+        # Quota and language are checked concurrently, a quota error takes precedence over a language error
+        pipeline = Pipeline("validate")
+        pipeline.add_stage("quota", self.validate_quota, configs)
+        pipeline.add_stage("languages", self.validate_languages, configs, user_data)
+        pipeline.run()
+        return True
+
+    def validate_quota(self, configs: ChatConfig):
+        # The message is counted by the check itself, and refunded if the request fails
+        counter_key, request_count = reserve_text_to_text_usage(
+            configs.chatter.id, configs.role, configs.package.allowed_request
+        )
+        if request_count is None:
+            raise OutOfQuotaError("Out of text-to-text quota")
+        configs.set_quota_reservation(counter_key, request_count)
+        return True
 
     def validate_languages(self, configs: ChatConfig, user_data: Dict):
         # Continue to check language
@@ -235,12 +427,14 @@ class TextToTextChatService(BaseChatService):
             raise LanguageIncompatibleError("The language you are using may be incorrect, expect"
                                             " {} but {} found".format(allowed_language, inferred_language))
 
-    def update_counter(self, configs: ChatConfig) -> int:
-        return update_text_to_text_counter(configs.chatter.id)
+    def refund_quota(self, configs: ChatConfig):
+        counter_key = configs.pop_quota_reservation()
+        if counter_key is not None:
+            refund_text_to_text_usage(counter_key)
 
     def check_quota(self, configs: ChatConfig):
-        num_chat = get_text_to_text_counter(configs.chatter.id, configs.role)
-        if configs.package.allowed_request != -1 and num_chat + 1 >= configs.package.allowed_request:
+        num_chat = configs.request_count
+        if configs.package.allowed_request != -1 and num_chat >= configs.package.allowed_request:
             if configs.role == AppRole.USER:
                 generate_notification(
                     event_code="CHILD_OUT_OF_MESSAGE_QUOTA_WARNING",
@@ -253,21 +447,35 @@ class TextToTextChatService(BaseChatService):
                 )
 
     def limit_prompts(self, system_prompt, message_history, max_input_tokens=2000, min_auto_acceptance_prompts=20):
-        for i in range(len(message_history)):
-            filtered_message_history = system_prompt + message_history[i:]
-            if len(filtered_message_history) - 1 <= min_auto_acceptance_prompts:
-                return filtered_message_history
-            n_tokens = num_tokens_from_messages(filtered_message_history)
-            if n_tokens <= max_input_tokens:
-                return filtered_message_history
+        """
+        Keep the longest suffix of the message history that either has at most `min_auto_acceptance_prompts`
+        messages (system prompt excluded) or fits in `max_input_tokens` with the system prompt. The last message
+        is always kept.
+        """
+        if not message_history:
+            return list(system_prompt)
+        # Shortest suffix accepted by its number of messages
+        count_start = max(len(system_prompt) + len(message_history) - 1 - min_auto_acceptance_prompts, 0)
+        if count_start == 0:
+            return system_prompt + message_history
+
+        budget = max_input_tokens - num_tokens_from_messages(system_prompt)
+        token_start = longest_fitting_suffix(message_history, budget, token_counter.count_message)
+        start = min(count_start, token_start, len(message_history) - 1)
+        return system_prompt + message_history[start:]
 
 
 class ImageGenerationChatService(BaseChatService):
+    ENGINE_ID = 'stable-diffusion-512-v2-1'
 
     def __init__(self):
         super(ImageGenerationChatService, self).__init__()
-        self.ENGINE_ID = 'stable-diffusion-512-v2-1'
         self.STABILITY_API_KEY = os.getenv('STABILITY_KEY')
+        self.stability_client = StabilityClient(self.STABILITY_API_KEY)
+
+    def warm_up(self):
+        # Open the pooled Stability session before the first image is requested
+        self.stability_client.warm_up()
 
     def get_engine_id(self):
         return self.ENGINE_ID
@@ -275,30 +483,44 @@ class ImageGenerationChatService(BaseChatService):
     def get_api_key(self):
         return self.STABILITY_API_KEY
 
+    def generate_image(self, configs: ChatConfig, on_delta: Optional[Callable[[Dict], None]],
+                       generate: Callable[..., bytes], *args) -> bytes:
+        """Run a generation job of the Stability client, reporting its progress to `on_delta`"""
+        on_progress = None
+        if on_delta is not None:
+            def on_progress(progress):
+                on_delta({"uuid_request": configs.uuid_request, **progress})
+
+        return self.stability_client.submit(generate, *args, configs.deadline).wait(on_progress)
+
     def validate(self, user_data: Dict, configs: ChatConfig) -> bool:
         image_generation_limit = configs.package.image_generation_limit
-        if image_generation_limit == -1:
-            return True
-        else:
-            if configs.package_group is None:
-                raise OutOfQuotaError("Cannot create image on a free package")
-
-            current_period_start = configs.package_group.current_period_start
-            request_within_a_month = get_image_generation_counter(
-                package_group_id=configs.package_group.id,
-                current_period_start=current_period_start
-            )
-            if request_within_a_month < image_generation_limit:
+        if configs.package_group is None:
+            if image_generation_limit == -1:
                 return True
-            else:
-                raise OutOfQuotaError("Out of image generation quota")
+            raise OutOfQuotaError("Cannot create image on a free package")
 
-    def check_quota(self, configs: ChatConfig):
-        num_images = get_image_generation_counter(
+        # The image is counted by the check itself, and refunded if the request fails
+        counter_key, request_count = reserve_image_generation_usage(
             package_group_id=configs.package_group.id,
-            current_period_start=configs.package_group.current_period_start
+            current_period_start=configs.package_group.current_period_start,
+            image_generation_limit=image_generation_limit
         )
-        if num_images + 1 >= configs.package.image_generation_limit:
+        if request_count is None:
+            raise OutOfQuotaError("Out of image generation quota")
+        configs.set_quota_reservation(counter_key, request_count)
+        return True
+
+    def refund_quota(self, configs: ChatConfig):
+        counter_key = configs.pop_quota_reservation()
+        if counter_key is not None:
+            refund_image_generation_usage(counter_key)
+
+    def check_quota(self, configs: ChatConfig):
+        num_images = configs.request_count
+        if num_images is None or configs.package.image_generation_limit == -1:
+            return
+        if num_images >= configs.package.image_generation_limit:
             # Raise notifications to learners
             for learner in configs.package_group.users:
                 generate_notification(
@@ -312,18 +534,9 @@ class ImageGenerationChatService(BaseChatService):
                     receive_parent_id=parent.id
                 )
 
-    def update_counter(self, configs: ChatConfig) -> int:
-        return update_image_generation_counter(
-            package_group_id=configs.package_group.id,
-            current_period_start=configs.package_group.current_period_start
-        )
-
 
 class TextToImageChatService(ImageGenerationChatService):
-
-    def __init__(self):
-        super().__init__()
-        self.draw_extraction_prompt = """From the given prompt, extract keywords from the prompt, along with 
+    draw_extraction_prompt = """From the given prompt, extract keywords from the prompt, along with 
         potential keywords to enhance image generation. Your answer would contain keyword only.
 
         User: Draw Kobe Bryant
@@ -345,42 +558,20 @@ class TextToImageChatService(ImageGenerationChatService):
         User: {}
         Agent:"""
 
-    def extract_draw_keywords(self, user_prompt):
+    def extract_draw_keywords(self, user_prompt, configs: ChatConfig = None):
         formatted_prompt = self.draw_extraction_prompt.format(user_prompt)
         message_history = [
             {"role": "user", "content": formatted_prompt},
         ]
-        response = call_openai_request(message_history)
+        response = call_openai_request(message_history, configs)
         bot_response = response["choices"][0]["message"]["content"]
         return bot_response
 
-    def run(self, user_data: Dict, configs: ChatConfig):
+    def run(self, user_data: Dict, configs: ChatConfig, context: Optional[Dict] = None,
+            on_delta: Optional[Callable[[Dict], None]] = None):
         user_prompt = user_data.get('content')
-        extracted_prompt = self.extract_draw_keywords(user_prompt)
-        response = requests.post(
-            STABILITY_TEXT_TO_IMAGE_URL,
-            headers={
-                "Content-Type": "application/json",
-                "Accept": "application/json",
-                "Authorization": f"Bearer {self.get_api_key()}"
-            },
-            json={
-                "text_prompts": [
-                    {
-                        "text": extracted_prompt
-                    }
-                ],
-                "cfg_scale": 12,
-                "height": 512,
-                "width": 512,
-                "samples": 1,
-                "steps": 50,
-            },
-        )
-        if response.status_code != 200:
-            raise StabilityAIRequestError("Non-200 response during image generation: " + str(response.text))
-        data = response.json()
-        img_data = base64.b64decode(data["artifacts"][0]["base64"])
+        extracted_prompt = self.extract_draw_keywords(user_prompt, configs)
+        img_data = self.generate_image(configs, on_delta, self.stability_client.text_to_image, extracted_prompt)
 
         message_id = configs.message_id
         img_url, img_size = aws_service.register_image(img_data, message_id)
@@ -393,10 +584,8 @@ class TextToImageChatService(ImageGenerationChatService):
 
 class ImageToImageChatService(ImageGenerationChatService):
 
-    def __init__(self):
-        super().__init__()
-
-    def run(self, user_data: Dict, configs: ChatConfig):
+    def run(self, user_data: Dict, configs: ChatConfig, context: Optional[Dict] = None,
+            on_delta: Optional[Callable[[Dict], None]] = None):
         """Image to image generation using Stability AI API
 
         Args:
@@ -408,35 +597,18 @@ class ImageToImageChatService(ImageGenerationChatService):
 
             configs (Dict): Configuration
 
+            context (Dict, optional): Unused, no data is prepared for image generation
+
+            on_delta (Callable, optional): Receives the progress of the generation, see `GenerationJob.progress`
+
         Returns:
             img_data (bytes): The returned image
         """
         user_prompt = user_data.get('content')
         user_prompt = ImageGenerationStyle.keyword_mapping(user_prompt)
         image_bytes = user_data.get('image')
-        response = requests.post(
-            STABILITY_IMAGE_TO_IMAGE_URL,
-            headers={
-                "Accept": "application/json",
-                "Authorization": f"Bearer {self.get_api_key()}"
-            },
-            files={
-                "init_image": image_bytes
-            },
-            data={
-                "image_strength": 0.3,
-                "init_image_mode": "IMAGE_STRENGTH",
-                "text_prompts[0][text]": user_prompt,
-                "cfg_scale": 7,
-                "clip_guidance_preset": "FAST_BLUE",
-                "samples": 1,
-                "steps": 50,
-            }
-        )
-        if response.status_code != 200:
-            raise StabilityAIRequestError("Non-200 response during image generation: " + str(response.text))
-        data = response.json()
-        img_data = base64.b64decode(data["artifacts"][0]["base64"])
+        img_data = self.generate_image(
+            configs, on_delta, self.stability_client.image_to_image, user_prompt, image_bytes)
 
         message_id = configs.message_id
         img_url, img_size = aws_service.register_image(img_data, message_id)
@@ -454,8 +626,20 @@ class ChatFactory:
         Action.IMAGE_TO_IMAGE: ImageToImageChatService
     }
 
+    def __init__(self):
+        # One long-lived service per action, created and warmed up on first use
+        self.chat_services: Dict[Action, BaseChatService] = {}
+        self.lock = threading.Lock()
+
     def get_chat_service(self, action: Action) -> BaseChatService:
-        if action in self.chat_service_mapper:
-            return self.chat_service_mapper[action]()
-        else:
+        if action not in self.chat_service_mapper:
             raise ActionNotFoundError("Action is not available at this moment")
+        chat_service = self.chat_services.get(action)
+        if chat_service is None:
+            with self.lock:
+                chat_service = self.chat_services.get(action)
+                if chat_service is None:
+                    chat_service = self.chat_service_mapper[action]()
+                    chat_service.warm_up()
+                    self.chat_services[action] = chat_service
+        return chat_service
@@ -0,0 +1,185 @@
+"""Rolling window of the latest message records of each conversation, so that a turn does not re-read DynamoDB"""
+import json
+import threading
+from abc import ABC, abstractmethod
+from typing import Dict, List, Optional
+
+from utils.cache import TTLCache
+
+
+class ConversationContextStore(ABC):
+    """
+    Latest message records of the conversations, ordered by timestamp.
+
+    A window is `complete` when it holds the whole conversation, i.e. it has been seeded with fewer records than
+    requested and has never been trimmed. A window that is not complete only serves requests for at most as many
+    records as it holds, the caller reads DynamoDB otherwise and seeds the window with the result.
+
+    Records are appended to a window even before it is seeded, and seeding merges them with the loaded records.
+    Seeding is atomic with respect to `append` and `remove`, so a record saved while the history is being loaded is
+    kept, whichever finishes first.
+    """
+
+    def __init__(self, window: int = 40, idle_ttl: float = 1800):
+        """
+        Args:
+            window (int): Maximum number of records kept per conversation
+            idle_ttl (float): Seconds after which the window of an inactive conversation is dropped
+        """
+        self.window = window
+        self.idle_ttl = idle_ttl
+
+    @abstractmethod
+    def get(self, history_message_id: int, limit: int) -> Optional[List[Dict]]:
+        """Return the latest `limit` records, oldest first, or None if the window cannot serve them"""
+        raise NotImplementedError
+
+    @abstractmethod
+    def seed(self, history_message_id: int, records: List[Dict], complete: bool = False):
+        """Merge records loaded from DynamoDB into the window"""
+        raise NotImplementedError
+
+    @abstractmethod
+    def append(self, history_message_id: int, record: Dict):
+        raise NotImplementedError
+
+    @abstractmethod
+    def remove(self, history_message_id: int, timestamp: str):
+        raise NotImplementedError
+
+    @abstractmethod
+    def drop(self, history_message_id: int):
+        raise NotImplementedError
+
+    def _merge(self, records: List[Dict], new_records: List[Dict], complete: bool):
+        merged = {record["timestamp"]: record for record in records}
+        merged.update((record["timestamp"], record) for record in new_records)
+        records = [merged[timestamp] for timestamp in sorted(merged)]
+        if len(records) > self.window:
+            return records[-self.window:], False
+        return records, complete
+
+    @staticmethod
+    def _serve(records: List[Dict], complete: bool, limit: int) -> Optional[List[Dict]]:
+        if len(records) >= limit:
+            return records[len(records) - limit:]
+        return list(records) if complete else None
+
+
+class InMemoryContextStore(ConversationContextStore):
+    """Process-local store, evicting the least recently used windows and the idle ones"""
+
+    def __init__(self, window: int = 40, idle_ttl: float = 1800, maxsize: int = 2000):
+        super().__init__(window, idle_ttl)
+        self.cache = TTLCache(maxsize=maxsize, ttl=idle_ttl)
+        self._lock = threading.Lock()
+
+    def get(self, history_message_id, limit):
+        entry = self.cache.get(history_message_id)
+        if entry is None:
+            return None
+        self.cache.touch(history_message_id)
+        return self._serve(entry["records"], entry["complete"], limit)
+
+    def seed(self, history_message_id, records, complete=False):
+        self._update(history_message_id, records, complete)
+
+    def append(self, history_message_id, record):
+        self._update(history_message_id, [record], None)
+
+    def remove(self, history_message_id, timestamp):
+        with self._lock:
+            entry = self.cache.get(history_message_id)
+            if entry is not None:
+                records = [record for record in entry["records"] if record["timestamp"] != timestamp]
+                self.cache.set(history_message_id, {"records": records, "complete": entry["complete"]})
+
+    def drop(self, history_message_id):
+        self.cache.pop(history_message_id)
+
+    def _update(self, history_message_id, new_records, complete):
+        with self._lock:
+            entry = self.cache.get(history_message_id) or {"records": [], "complete": False}
+            # Appending keeps the completeness of the window, seeding sets it
+            complete = entry["complete"] if complete is None else complete or entry["complete"]
+            records, complete = self._merge(entry["records"], new_records, complete)
+            self.cache.set(history_message_id, {"records": records, "complete": complete})
+
+
+class RedisContextStore(ConversationContextStore):
+    """
+    Store shared by the processes through Redis (or any server implementing its protocol). Each window is a list
+    of JSON records, with a flag key marking it complete, both expiring after `idle_ttl` without activity.
+    `seed` merges the window in a WATCH/MULTI transaction, retried when another process changes it meanwhile.
+    """
+
+    def __init__(self, url: str, window: int = 40, idle_ttl: float = 1800, prefix: str = "context"):
+        super().__init__(window, idle_ttl)
+        # Optional dependency, only required when the store is configured
+        import redis
+
+        self.redis = redis.Redis.from_url(url)
+        self.prefix = prefix
+
+    def get(self, history_message_id, limit):
+        key, complete_key = self._keys(history_message_id)
+        with self.redis.pipeline() as pipeline:
+            pipeline.lrange(key, -limit, -1)
+            pipeline.llen(key)
+            pipeline.exists(complete_key)
+            pipeline.expire(key, int(self.idle_ttl))
+            pipeline.expire(complete_key, int(self.idle_ttl))
+            values, length, complete, _, _ = pipeline.execute()
+        if length == 0:
+            return None
+        return self._serve([json.loads(value) for value in values], bool(complete), limit)
+
+    def seed(self, history_message_id, records, complete=False):
+        key, complete_key = self._keys(history_message_id)
+
+        def merge(pipeline):
+            # The window is read and replaced in a transaction watching its keys, so that it is read again and
+            # merged again if a record is appended or removed by another process meanwhile
+            existing = [json.loads(value) for value in pipeline.lrange(key, 0, -1)]
+            merged, merged_complete = self._merge(existing, records, complete or bool(pipeline.exists(complete_key)))
+            pipeline.multi()
+            pipeline.delete(key, complete_key)
+            if merged:
+                pipeline.rpush(key, *[json.dumps(record) for record in merged])
+                pipeline.expire(key, int(self.idle_ttl))
+            if merged_complete:
+                pipeline.set(complete_key, 1, ex=int(self.idle_ttl))
+
+        self.redis.transaction(merge, key, complete_key)
+
+    def append(self, history_message_id, record):
+        key, complete_key = self._keys(history_message_id)
+        with self.redis.pipeline() as pipeline:
+            pipeline.rpush(key, json.dumps(record))
+            pipeline.ltrim(key, -self.window, -1)
+            pipeline.expire(key, int(self.idle_ttl))
+            length = pipeline.execute()[0]
+        if length > self.window:
+            # The window has been trimmed, it does not hold the whole conversation anymore
+            self.redis.delete(complete_key)
+
+    def remove(self, history_message_id, timestamp):
+        key, _ = self._keys(history_message_id)
+        for value in self.redis.lrange(key, 0, -1):
+            if json.loads(value)["timestamp"] == timestamp:
+                self.redis.lrem(key, 0, value)
+
+    def drop(self, history_message_id):
+        self.redis.delete(*self._keys(history_message_id))
+
+    def _keys(self, history_message_id):
+        key = "{}:{}".format(self.prefix, history_message_id)
+        return key, key + ":complete"
+
+
+def create_context_store(url: Optional[str] = None, window: int = 40, idle_ttl: float = 1800,
+                         maxsize: int = 2000) -> ConversationContextStore:
+    """Create a Redis store if `url` is a Redis URL, a process-local store otherwise"""
+    if url and url.startswith(("redis://", "rediss://", "unix://")):
+        return RedisContextStore(url, window, idle_ttl)
+    return InMemoryContextStore(window, idle_ttl, maxsize)
@@ -1,15 +1,31 @@
+import logging
 import os
+import re
+import time
+from typing import Callable, Optional
+
+import gevent
+from gevent.queue import Queue, Empty
+from flask import has_request_context, copy_current_request_context
 
 from elevenlabs import set_api_key, generate
 
 from dotenv import load_dotenv, find_dotenv
 
+from services.resilience import Deadline, get_breaker
+
 
 # Set API key
 load_dotenv(find_dotenv())
 ELEVENLABS_API_KEY = os.getenv("ELEVENLABS_API_KEY")
 set_api_key(ELEVENLABS_API_KEY)
 
+# A sentence ends with a terminal punctuation (optionally followed by closing quotes/brackets) and a whitespace,
+# or with a line break
+SENTENCE_BOUNDARY = re.compile(r"[.!?।。！？]+[\"'”’)\]]*\s+|\n+")
+
+elevenlabs_breaker = get_breaker('elevenlabs')
+
 
 def voice_stream(text, voice, stream=True, stream_chunk_size=8192):
     # TODO: Voice must be customized by character
@@ -21,3 +37,142 @@ def voice_stream(text, voice, stream=True, stream_chunk_size=8192):
         model="eleven_multilingual_v2",
     )
     return audio_stream
+
+
+def synthesize_sentence(text, voice, deadline: Optional[Deadline] = None, stream_chunk_size=8192):
+    """
+    Stream the speech of a sentence, guarded by the breaker of ElevenLabs. The client sets no timeout, the whole
+    synthesis is therefore bounded by the timeout of the breaker.
+    """
+    with elevenlabs_breaker.guard(deadline) as call:
+        give_up_at = time.monotonic() + call.timeout
+        error = TimeoutError("Speech synthesis timed out after {:.1f}s".format(call.timeout))
+        # The timeout is only armed while waiting for ElevenLabs, not while the caller handles a chunk
+        with gevent.Timeout(call.timeout, error):
+            chunks = iter(voice_stream(text, voice, stream_chunk_size=stream_chunk_size))
+        while True:
+            with gevent.Timeout(max(give_up_at - time.monotonic(), 0), error):
+                chunk = next(chunks, StopIteration)
+            if chunk is StopIteration:
+                return
+            yield chunk
+
+
+class SentenceSpeechStream:
+    """
+    Synthesize speech sentence by sentence while the text is still being generated.
+
+    Text is pushed with `feed` as it arrives. Every complete sentence is queued and synthesized by a background
+    greenlet, so the first audio is available about one sentence after the first token instead of after the full
+    generation. Sentences are synthesized in order and `on_audio` receives the chunks with a monotonic count.
+
+    Usage:
+    ```python
+    speech = SentenceSpeechStream(voice, on_audio=lambda chunk, count: emit("audio", ...))
+    for delta in deltas:
+        speech.feed(delta)
+    speech.close()  # Synthesize the remaining text and wait for the audio to be sent
+    ```
+    """
+
+    def __init__(self, voice, on_audio: Callable[[bytes, int], None], chunks_per_payload: int = 10,
+                 min_sentence_length: int = 12, idle_timeout: float = 120, deadline: Optional[Deadline] = None):
+        """
+        Args:
+            voice: ElevenLabs voice of the agent
+            on_audio (Callable): Called with each audio payload and its count
+            chunks_per_payload (int): Number of streamed chunks concatenated into one payload. A payload is also
+                sent at the end of each sentence.
+            min_sentence_length (int): Shorter sentences are merged with the next one to limit the number of
+                synthesis requests
+            idle_timeout (float): Seconds to wait for new text before the synthesis greenlet gives up
+            deadline (Deadline, optional): Deadline of the message, bounding the synthesis of each sentence
+        """
+        self.voice = voice
+        self.on_audio = on_audio
+        self.chunks_per_payload = chunks_per_payload
+        self.min_sentence_length = min_sentence_length
+        self.idle_timeout = idle_timeout
+        self.deadline = deadline
+        self.count = 0
+        # Error that stopped the synthesis, set by `close`
+        self.error: Optional[Exception] = None
+        self._buffer = ""
+        self._queue = Queue()
+        self._closed = False
+
+        synthesize = self._synthesize
+        if has_request_context():
+            synthesize = copy_current_request_context(synthesize)
+        self._worker = gevent.spawn(synthesize)
+
+    def feed(self, text: str):
+        """Append generated text, queueing every sentence completed by it"""
+        if self._closed or not text:
+            return
+        self._buffer += text
+        start = 0
+        for match in SENTENCE_BOUNDARY.finditer(self._buffer):
+            if match.end() - start >= self.min_sentence_length:
+                self._put(self._buffer[start:match.end()])
+                start = match.end()
+        self._buffer = self._buffer[start:]
+
+    def close(self) -> int:
+        """
+        Queue the remaining text and wait until all the audio has been sent.
+
+        A synthesis error is not raised, as the text has usually been sent already: it is logged and kept in `error`,
+        and the audio sent before it is counted. `error` is also set when the synthesis gave up waiting for text.
+
+        Returns:
+            Number of audio payloads sent.
+        """
+        if not self._closed:
+            self._put(self._buffer)
+            self._buffer = ""
+            self._closed = True
+            self._queue.put(StopIteration)
+        try:
+            return self._worker.get()
+        except Exception as e:
+            if self.error is None:
+                logging.exception("Speech synthesis failed after {} audio payloads".format(self.count))
+                self.error = e
+            return self.count
+
+    def abort(self):
+        """Stop synthesizing, e.g. when the text generation failed"""
+        self._closed = True
+        self._worker.kill(block=False)
+
+    def _put(self, sentence: str):
+        sentence = sentence.strip()
+        if sentence:
+            self._queue.put(sentence)
+
+    def _synthesize(self) -> int:
+        while True:
+            try:
+                sentence = self._queue.get(timeout=self.idle_timeout)
+            except Empty:
+                logging.warning("No text received for {}s, stop synthesizing speech".format(self.idle_timeout))
+                # The text fed afterwards is never synthesized, the audio is incomplete
+                self.error = TimeoutError("No text received for {}s".format(self.idle_timeout))
+                return self.count
+            if sentence is StopIteration:
+                return self.count
+
+            chunks = []
+            for chunk in synthesize_sentence(sentence, self.voice, self.deadline):
+                if chunk:
+                    chunks.append(chunk)
+                    if len(chunks) >= self.chunks_per_payload:
+                        self._send(chunks)
+                        chunks = []
+            if chunks:
+                self._send(chunks)
+
+    def _send(self, chunks):
+        self.on_audio(b"".join(chunks), self.count)
+        self.count += 1
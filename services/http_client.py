@@ -0,0 +1,88 @@
+"""Pooled keep-alive HTTP sessions for the outbound calls to third-party services"""
+import os
+import threading
+from typing import Dict, Optional, Tuple
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+from dotenv import load_dotenv, find_dotenv
+
+load_dotenv(find_dotenv())
+
+HTTP_POOL_SIZE = int(os.getenv('HTTP_POOL_SIZE', 20))
+HTTP_CONNECT_TIMEOUT = float(os.getenv('HTTP_CONNECT_TIMEOUT', 5))
+HTTP_READ_TIMEOUT = float(os.getenv('HTTP_READ_TIMEOUT', 30))
+HTTP_RETRIES = int(os.getenv('HTTP_RETRIES', 3))
+HTTP_BACKOFF_FACTOR = float(os.getenv('HTTP_BACKOFF_FACTOR', 0.3))
+RETRY_STATUS_CODES = (429, 500, 502, 503, 504)
+
+# Settings of the upstreams that differ from the defaults
+upstream_settings = {
+    # Image generation takes several seconds before the first byte is sent
+    "stability": {"read_timeout": float(os.getenv('STABILITY_READ_TIMEOUT', 90))},
+}
+
+sessions: Dict[str, requests.Session] = {}
+sessions_lock = threading.Lock()
+
+
+class TimeoutSession(requests.Session):
+    """Session applying a default (connect, read) timeout to the requests that do not set one"""
+
+    def __init__(self, timeout: Tuple[float, float]):
+        super().__init__()
+        self.timeout = timeout
+
+    def request(self, method, url, **kwargs):
+        kwargs.setdefault("timeout", self.timeout)
+        return super().request(method, url, **kwargs)
+
+
+def create_session(pool_size: int = HTTP_POOL_SIZE, connect_timeout: float = HTTP_CONNECT_TIMEOUT,
+                   read_timeout: float = HTTP_READ_TIMEOUT, retries: int = HTTP_RETRIES,
+                   backoff_factor: float = HTTP_BACKOFF_FACTOR) -> requests.Session:
+    """
+    Create a session keeping up to `pool_size` connections alive per host.
+
+    Connection errors are retried for every method, since the request has not been sent. Responses with a status
+    in `RETRY_STATUS_CODES` are only retried for idempotent methods (not POST). Retries wait with an exponential
+    backoff and respect the `Retry-After` header.
+    """
+    retry = Retry(
+        total=retries,
+        backoff_factor=backoff_factor,
+        status_forcelist=RETRY_STATUS_CODES,
+        raise_on_status=False,
+        respect_retry_after_header=True
+    )
+    adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size, max_retries=retry)
+    session = TimeoutSession(timeout=(connect_timeout, read_timeout))
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    return session
+
+
+def get_session(upstream: str, auth: Optional[requests.auth.AuthBase] = None) -> requests.Session:
+    """
+    Get the shared session of an upstream, created on first use.
+
+    Args:
+        upstream (str): Name of the upstream, e.g. `opensearch`, `s3`, `stability`
+        auth (AuthBase, optional): Authentication attached to the session, replacing the previous one. Used for
+            signed requests whose credentials may be rotated (e.g. AWS4Auth).
+
+    Returns:
+        The session of the upstream.
+    """
+    session = sessions.get(upstream)
+    if session is None:
+        with sessions_lock:
+            session = sessions.get(upstream)
+            if session is None:
+                session = create_session(**upstream_settings.get(upstream, {}))
+                sessions[upstream] = session
+    if auth is not None:
+        session.auth = auth
+    return session
@@ -0,0 +1,126 @@
+"""Backfill of the shared OpenSearch index of the message records from DynamoDB"""
+import json
+import logging
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Dict, Optional
+
+from services.aws_service import (
+    MESSAGE_TABLE_NAME,
+    ensure_message_index,
+    format_message_item,
+    get_client,
+    store_message_records_to_opensearch,
+)
+
+BULK_INDEX_ATTEMPTS = 3
+
+
+class ReindexCheckpoint:
+    """
+    Progress of a parallel scan, saved to a JSON file after every page so that an interrupted reindex resumes
+    from the last indexed page of each segment.
+    """
+
+    def __init__(self, path: Optional[str], total_segments: int):
+        self.path = path
+        self.total_segments = total_segments
+        self.segments = {segment: {"last_evaluated_key": None, "done": False, "count": 0}
+                         for segment in range(total_segments)}
+        self._lock = threading.Lock()
+
+        if path and os.path.exists(path):
+            with open(path) as file:
+                saved = json.load(file)
+            if saved.get("total_segments") != total_segments:
+                raise ValueError("The checkpoint {} was created with {} segments, {} given".format(
+                    path, saved.get("total_segments"), total_segments))
+            self.segments = {int(segment): progress for segment, progress in saved["segments"].items()}
+
+    @property
+    def count(self) -> int:
+        return sum(progress["count"] for progress in self.segments.values())
+
+    def update(self, segment: int, last_evaluated_key: Optional[Dict], count: int):
+        with self._lock:
+            progress = self.segments[segment]
+            progress["last_evaluated_key"] = last_evaluated_key
+            progress["done"] = last_evaluated_key is None
+            progress["count"] += count
+            self._save()
+
+    def _save(self):
+        if not self.path:
+            return
+        # Write then rename, so that the checkpoint is never left half-written
+        with open(self.path + ".tmp", "w") as file:
+            json.dump({"total_segments": self.total_segments, "segments": self.segments}, file)
+        os.replace(self.path + ".tmp", self.path)
+
+
+def reindex_message_history(total_segments: int = 4, page_size: int = 500, checkpoint_path: Optional[str] = None,
+                            on_progress: Optional[Callable[[int, int], None]] = None) -> int:
+    """
+    Stream all the message records of `MESSAGE_TABLE_NAME` into the shared OpenSearch alias.
+
+    The table is read with a parallel Scan, one thread per segment, and each page is indexed with one `_bulk`
+    request. Documents are indexed with a deterministic ID, so indexing a page twice (e.g. when resuming) is
+    harmless.
+
+    Args:
+        total_segments (int): Number of Scan segments read in parallel
+        page_size (int): Maximum number of items per page, i.e. per bulk request
+        checkpoint_path (str, optional): JSON file recording the progress. An existing checkpoint is resumed.
+        on_progress (Callable, optional): Called with the segment and the total number of indexed records after
+            every page
+
+    Returns:
+        int: Total number of indexed records
+    """
+    ensure_message_index()
+    checkpoint = ReindexCheckpoint(checkpoint_path, total_segments)
+    pending_segments = [segment for segment, progress in checkpoint.segments.items() if not progress["done"]]
+
+    def scan_segment(segment: int):
+        dynamodb_client = get_client('dynamodb')
+        last_evaluated_key = checkpoint.segments[segment]["last_evaluated_key"]
+        while True:
+            query = {
+                "TableName": MESSAGE_TABLE_NAME,
+                "Segment": segment,
+                "TotalSegments": total_segments,
+                "Limit": page_size
+            }
+            if last_evaluated_key is not None:
+                query["ExclusiveStartKey"] = last_evaluated_key
+            response = dynamodb_client.scan(**query)
+            records = [format_message_item(item) for item in response["Items"]]
+            index_records(records)
+
+            last_evaluated_key = response.get("LastEvaluatedKey")
+            checkpoint.update(segment, last_evaluated_key, len(records))
+            if on_progress is not None:
+                on_progress(segment, checkpoint.count)
+            if last_evaluated_key is None:
+                return
+
+    with ThreadPoolExecutor(max_workers=max(len(pending_segments), 1)) as executor:
+        # Raise the first error, the checkpoint keeps the progress of the other segments
+        for future in [executor.submit(scan_segment, segment) for segment in pending_segments]:
+            future.result()
+    return checkpoint.count
+
+
+def index_records(records):
+    """Bulk index records, retrying the failed ones. Raise if some records still cannot be indexed."""
+    for attempt in range(BULK_INDEX_ATTEMPTS):
+        if not records:
+            return
+        records = store_message_records_to_opensearch(records)
+        if records and attempt + 1 < BULK_INDEX_ATTEMPTS:
+            time.sleep(2 ** attempt)
+    if records:
+        logging.error("Fail to index {} message records".format(len(records)))
+        raise RuntimeError("Fail to index {} message records on OpenSearch".format(len(records)))
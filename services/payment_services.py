@@ -14,6 +14,7 @@ from dotenv import load_dotenv, find_dotenv
 
 from services.notification_service import generate_notification
 from utils.auth import validate_token
+from utils.chat_config import invalidate_chat_config
 from utils.exceptions import ItemNotFoundError, NotificationGenerationError, ValidationError
 
 # Configure API key
@@ -368,6 +369,8 @@ def apply_package(buyer_id: int, buyer_type: str, status: str, data: Dict, metad
         raise Exception(f"Buyer type {buyer_type} is not available. It should be either `user` or `parent`")
 
     db.session.commit()
+    # The package of the buyer and of its linked chatters has changed
+    invalidate_chat_config()
 
 
 def create_package_group(data: Dict):
@@ -484,3 +487,4 @@ def remove_package(data: Dict, package_group: PackageGroup):
         parent.package_group_id = None
 
     db.session.commit()
+    invalidate_chat_config()
@@ -0,0 +1,126 @@
+"""Staged execution of independent calls on gevent greenlets"""
+import logging
+import time
+from typing import Any, Callable, Dict, Iterable, List, Optional
+
+import gevent
+from flask import has_request_context, copy_current_request_context
+from gevent.pool import Pool
+
+DEFAULT_POOL_SIZE = 8
+
+
+class PipelineStage:
+
+    def __init__(self, name: str, func: Callable, args: tuple, kwargs: Dict, depends_on: List[str]):
+        self.name = name
+        self.func = func
+        self.args = args
+        self.kwargs = kwargs
+        self.depends_on = depends_on
+        self.result = None
+        self.error: Optional[BaseException] = None
+        self.skipped = False
+        self.elapsed = None
+
+
+class Pipeline:
+    """
+    Run a set of stages concurrently while respecting the dependency graph between them.
+
+    A stage starts as soon as every stage it depends on has finished, so the wall time of the pipeline is the
+    length of its slowest dependency chain instead of the sum of all stages. Stages are executed on a bounded
+    gevent pool and keep the Flask request context of the caller (so `emit` and the database session keep
+    working inside a stage).
+
+    Usage:
+    ```python
+    pipeline = Pipeline("message-v2")
+    pipeline.add_stage("save", save_message_record, message_id, **user_message)
+    pipeline.add_stage("validate", chat_service.validate, last_message, configs)
+    pipeline.add_stage("answer", chat_service.run, last_message, configs, depends_on=["validate"])
+    results = pipeline.run()
+    ```
+    """
+
+    def __init__(self, name: str = "pipeline", pool_size: int = DEFAULT_POOL_SIZE):
+        self.name = name
+        self.pool_size = pool_size
+        self.stages: Dict[str, PipelineStage] = {}
+        self.elapsed = None
+
+    def add_stage(self, name: str, func: Callable, *args, depends_on: Iterable[str] = (), **kwargs) -> "Pipeline":
+        """
+        Register a stage. Dependencies must be registered before the stages that depend on them, which keeps the
+        graph acyclic by construction.
+
+        Args:
+            name (str): Unique name of the stage, used as the key of its result
+            func (Callable): Function to execute
+            *args: Positional arguments of `func`
+            depends_on (Iterable[str]): Names of the stages that must finish before this one starts
+            **kwargs: Keyword arguments of `func`
+        """
+        if name in self.stages:
+            raise ValueError("Stage `{}` is already registered in pipeline `{}`".format(name, self.name))
+        depends_on = list(depends_on)
+        for dependency in depends_on:
+            if dependency not in self.stages:
+                raise ValueError("Stage `{}` depends on unknown stage `{}`".format(name, dependency))
+        if has_request_context():
+            func = copy_current_request_context(func)
+        self.stages[name] = PipelineStage(name, func, args, kwargs, depends_on)
+        return self
+
+    def run(self) -> Dict[str, Any]:
+        """
+        Execute all stages and wait for them to finish.
+
+        Returns:
+            Dict mapping each stage name to its result.
+
+        Raises:
+            The exception of the first failed stage, in registration order. Stages depending on a failed stage are
+            skipped, the other stages still run to completion.
+        """
+        pool = Pool(self.pool_size)
+        greenlets = {}
+        start_time = time.perf_counter()
+        for stage in self.stages.values():
+            dependencies = [greenlets[dependency] for dependency in stage.depends_on]
+            greenlets[stage.name] = pool.spawn(self._run_stage, stage, dependencies)
+        gevent.joinall(list(greenlets.values()))
+        self.elapsed = time.perf_counter() - start_time
+
+        logging.info("Pipeline {} finished in {:.3f}s ({})".format(self.name, self.elapsed, self.format_timings()))
+
+        for stage in self.stages.values():
+            if stage.error is not None:
+                raise stage.error
+        return {stage.name: stage.result for stage in self.stages.values()}
+
+    def _run_stage(self, stage: PipelineStage, dependencies: List[gevent.Greenlet]):
+        gevent.joinall(dependencies)
+        if any(self.stages[dependency].error is not None or self.stages[dependency].skipped
+               for dependency in stage.depends_on):
+            stage.skipped = True
+            return
+
+        start_time = time.perf_counter()
+        try:
+            stage.result = stage.func(*stage.args, **stage.kwargs)
+        except Exception as e:
+            stage.error = e
+        finally:
+            stage.elapsed = time.perf_counter() - start_time
+
+    @property
+    def timings(self) -> Dict[str, Optional[float]]:
+        """Execution time of each stage in seconds, None if the stage was skipped"""
+        return {stage.name: stage.elapsed for stage in self.stages.values()}
+
+    def format_timings(self) -> str:
+        return ", ".join(
+            "{}={}".format(name, "skipped" if elapsed is None else "{:.3f}s".format(elapsed))
+            for name, elapsed in self.timings.items()
+        )
@@ -0,0 +1,236 @@
+"""Quota counters served from a local lease and flushed to the shared store in aggregated increments"""
+import logging
+import threading
+import time
+from collections import Counter
+from typing import Callable, Dict, Hashable, Optional
+
+
+class CounterLease:
+    """Local state of one counter"""
+
+    def __init__(self, base: int, expires_at: float):
+        # Value of the shared counter at the last reconciliation
+        self.base = base
+        # Increments not sent yet, and increments being sent
+        self.pending = 0
+        self.flushing = 0
+        # Increments admitted since the lease was granted
+        self.used = 0
+        self.expires_at = expires_at
+
+    @property
+    def value(self) -> int:
+        return self.base + self.pending + self.flushing
+
+
+class QuotaEngine:
+    """
+    Quota counters kept in memory and persisted to a shared store (e.g. DynamoDB) by a background flusher.
+
+    A counter is read from the store once, then leased for `lease_ttl` seconds. While the lease is valid, the
+    counter is read and incremented locally, up to `allowance` increments. The flusher sends the increments of
+    each counter every `flush_interval` seconds as one aggregated `add`. When the lease expires or its allowance
+    is used, the next read reconciles the counter with the store before granting a new lease.
+
+    Each process admits at most `allowance` increments that the other processes cannot see, so a quota is
+    overrun by at most `allowance` times the number of processes. With an `allowance` of 0, `reserve` is a single
+    conditional increment on the store instead, which never overruns the quota.
+    """
+
+    def __init__(self, name: str, read: Callable[[Hashable], int], add: Callable[[Hashable, int], int],
+                 add_below: Callable[[Hashable, int, int], Optional[int]], allowance: int = 5,
+                 lease_ttl: float = 30, flush_interval: float = 1, timer: Callable[[], float] = time.monotonic):
+        """
+        Args:
+            name (str): Name used in logs
+            read (Callable): Read the shared value of a counter
+            add (Callable): Add an increment to the shared counter, returns its new value
+            add_below (Callable): Add an increment to the shared counter only if its value is below a limit,
+                returns its new value or None if the limit is reached
+            allowance (int): Maximum number of local increments per lease
+            lease_ttl (float): Time a counter is served locally without being reconciled, in seconds
+            flush_interval (float): Time between two flushes of the increments, in seconds
+            timer (Callable): Clock used for leases, monotonic by default
+        """
+        self.name = name
+        self.read = read
+        self.add = add
+        self.add_below = add_below
+        self.allowance = allowance
+        self.lease_ttl = lease_ttl
+        self.flush_interval = flush_interval
+        self.timer = timer
+        self.counters = Counter()
+        self._leases: Dict[Hashable, CounterLease] = {}
+        self._lock = threading.Lock()
+        self._worker = None
+        self._stopped = threading.Event()
+
+    def start(self):
+        with self._lock:
+            if self._worker is None and not self._stopped.is_set():
+                self._worker = threading.Thread(target=self._run, name=self.name, daemon=True)
+                self._worker.start()
+
+    def get(self, key: Hashable) -> int:
+        """Value of a counter, including the local increments that are not flushed yet"""
+        lease = self._lease(key)
+        self.counters["local_reads"] += 1
+        return lease.value
+
+    def increment(self, key: Hashable, amount: int = 1) -> int:
+        """
+        Increment a counter locally, the increment is sent to the store by the next flush.
+
+        Returns:
+            New value of the counter.
+        """
+        self.start()
+        lease = self._lease(key)
+        with self._lock:
+            # The lease may have been dropped as idle since it was returned
+            lease = self._leases.setdefault(key, lease)
+            lease.pending += amount
+            lease.used += amount
+            return lease.value
+
+    def reserve(self, key: Hashable, limit: Optional[int] = None) -> Optional[int]:
+        """
+        Increment a counter if its value is below the limit. The check and the increment are atomic in the
+        process, and on the store too when `allowance` is 0.
+
+        Args:
+            key (Hashable): Key of the counter
+            limit (int, optional): Maximum value of the counter, unlimited if None
+
+        Returns:
+            New value of the counter, None if the limit is reached.
+        """
+        if self.allowance == 0:
+            value = self.add(key, 1) if limit is None else self.add_below(key, 1, limit)
+            self.counters["reserved" if value is not None else "refused"] += 1
+            return value
+
+        self.start()
+        lease = self._lease(key)
+        with self._lock:
+            lease = self._leases.setdefault(key, lease)
+            if limit is not None and lease.value >= limit:
+                self.counters["refused"] += 1
+                return None
+            lease.pending += 1
+            lease.used += 1
+            self.counters["reserved"] += 1
+            return lease.value
+
+    def refund(self, key: Hashable, amount: int = 1):
+        """Give back reserved increments, e.g. when the request they admitted has failed"""
+        self.counters["refunded"] += amount
+        if self.allowance == 0:
+            self.add(key, -amount)
+            return
+        with self._lock:
+            lease = self._leases.get(key)
+            if lease is not None:
+                # Flushed as a compensating decrement if the reservation has already been sent
+                lease.pending -= amount
+                return
+        self.add(key, -amount)
+
+    def flush(self):
+        """Send the pending increments of every counter and drop the idle counters"""
+        now = self.timer()
+        with self._lock:
+            keys = list(self._leases)
+        for key in keys:
+            try:
+                self._flush_key(key)
+            except Exception:
+                # The increments stay pending until the next flush
+                pass
+        with self._lock:
+            idle = [key for key, lease in self._leases.items()
+                    if lease.expires_at <= now and not lease.pending and not lease.flushing]
+            for key in idle:
+                del self._leases[key]
+
+    def shutdown(self, timeout: float = 5):
+        """Stop the flusher and send the increments that are left"""
+        self._stopped.set()
+        worker = self._worker
+        if worker is not None:
+            worker.join(timeout)
+        self.flush()
+
+    def stats(self) -> Dict[str, int]:
+        with self._lock:
+            return dict(self.counters, counters=len(self._leases),
+                        pending=sum(lease.pending for lease in self._leases.values()))
+
+    def _lease(self, key: Hashable) -> CounterLease:
+        with self._lock:
+            lease = self._leases.get(key)
+            if lease is not None and (lease.flushing or (
+                    lease.expires_at > self.timer() and lease.used < self.allowance)):
+                # A lease being flushed is reconciled by the flush itself
+                return lease
+
+        if lease is None:
+            base = self.read(key)
+            self.counters["reads"] += 1
+            with self._lock:
+                # Another caller may have leased the counter meanwhile
+                lease = self._leases.setdefault(key, CounterLease(base, self.timer() + self.lease_ttl))
+            return lease
+
+        self.counters["reconciliations"] += 1
+        try:
+            if not self._flush_key(key):
+                base = self.read(key)
+                self.counters["reads"] += 1
+                with self._lock:
+                    lease.base = base
+        except Exception as e:
+            # The local value is served until the store is reachable again
+            logging.warning("Fail to reconcile counter {} of quota {}: {}".format(key, self.name, e))
+        with self._lock:
+            lease.used = 0
+            lease.expires_at = self.timer() + self.lease_ttl
+        return lease
+
+    def _flush_key(self, key: Hashable) -> bool:
+        """
+        Send the pending increments of a counter.
+
+        Returns:
+            True if the counter has been reconciled with the store.
+        """
+        with self._lock:
+            lease = self._leases.get(key)
+            # Only one flush per counter is in flight, so that the value returned by the store is the latest one
+            if lease is None or not lease.pending or lease.flushing:
+                return False
+            amount = lease.pending
+            lease.pending = 0
+            lease.flushing = amount
+
+        try:
+            value = self.add(key, amount)
+        except Exception as e:
+            with self._lock:
+                lease.flushing = 0
+                lease.pending += amount
+            self.counters["failed_flushes"] += 1
+            logging.warning("Fail to flush {} increments of counter {} of quota {}: {}".format(
+                amount, key, self.name, e))
+            raise
+        with self._lock:
+            lease.flushing = 0
+            lease.base = value
+        self.counters["flushes"] += 1
+        return True
+
+    def _run(self):
+        while not self._stopped.wait(self.flush_interval):
+            self.flush()
@@ -0,0 +1,357 @@
+"""Circuit breakers, adaptive timeouts and deadlines for the calls to third-party services"""
+import logging
+import os
+import random
+import threading
+import time
+from collections import Counter, deque
+from contextlib import contextmanager
+from typing import Any, Callable, Deque, Dict, Optional, Tuple, Type
+
+import gevent
+from dotenv import load_dotenv, find_dotenv
+
+from utils.exceptions import UpstreamUnavailableError, DeadlineExceededError
+
+load_dotenv(find_dotenv())
+
+BREAKER_WINDOW = float(os.getenv('BREAKER_WINDOW', 60))
+BREAKER_MIN_CALLS = int(os.getenv('BREAKER_MIN_CALLS', 10))
+BREAKER_FAILURE_RATE = float(os.getenv('BREAKER_FAILURE_RATE', 0.5))
+BREAKER_OPEN_DURATION = float(os.getenv('BREAKER_OPEN_DURATION', 15))
+BREAKER_HALF_OPEN_CALLS = int(os.getenv('BREAKER_HALF_OPEN_CALLS', 2))
+
+# (minimum, maximum) timeout of the calls to each upstream, in seconds. The maximum is used until enough latencies
+# have been observed.
+upstream_timeouts = {
+    "openai": (float(os.getenv('OPENAI_MIN_TIMEOUT', 10)), float(os.getenv('OPENAI_MAX_TIMEOUT', 60))),
+    # Image generation takes several seconds before the first byte is sent
+    "stability": (float(os.getenv('STABILITY_MIN_TIMEOUT', 20)), float(os.getenv('STABILITY_READ_TIMEOUT', 90))),
+    "elevenlabs": (float(os.getenv('ELEVENLABS_MIN_TIMEOUT', 5)), float(os.getenv('ELEVENLABS_MAX_TIMEOUT', 30))),
+    "opensearch": (float(os.getenv('OPENSEARCH_MIN_TIMEOUT', 2)), float(os.getenv('OPENSEARCH_MAX_TIMEOUT', 10))),
+}
+
+CLOSED = "closed"
+OPEN = "open"
+HALF_OPEN = "half_open"
+
+breakers: Dict[str, "CircuitBreaker"] = {}
+breakers_lock = threading.Lock()
+
+
+class Deadline:
+    """Point in time after which the result of a request is not useful anymore"""
+
+    def __init__(self, seconds: float, timer=time.monotonic):
+        self.timer = timer
+        self.expires_at = timer() + seconds
+
+    def remaining(self) -> float:
+        return self.expires_at - self.timer()
+
+    @property
+    def expired(self) -> bool:
+        return self.remaining() <= 0
+
+
+class UpstreamCall:
+    """Call guarded by a breaker, with its timeout. A call returning an error response is marked with `fail`."""
+
+    def __init__(self, timeout: float):
+        self.timeout = timeout
+        self.failed = False
+
+    def fail(self):
+        self.failed = True
+
+
+class CircuitBreaker:
+    """
+    Error rate and latencies of the calls to an upstream over a rolling window of `window` seconds.
+
+    The breaker opens when at least `failure_rate` of the last `min_calls` (or more) calls have failed, and the
+    calls then fail at once with `UpstreamUnavailableError` instead of waiting for an upstream that is down. After
+    `open_duration` seconds, it lets `half_open_calls` probe calls through: it closes if they all succeed, and
+    opens again as soon as one fails.
+
+    The timeout of a call adapts to the upstream: `timeout_factor` times the 95th percentile of the recent
+    latencies, between `min_timeout` and `max_timeout`, and never longer than the deadline of the request.
+    """
+
+    def __init__(self, name: str, min_timeout: float, max_timeout: float, timeout_factor: float = 3,
+                 window: float = BREAKER_WINDOW, min_calls: int = BREAKER_MIN_CALLS,
+                 failure_rate: float = BREAKER_FAILURE_RATE, open_duration: float = BREAKER_OPEN_DURATION,
+                 half_open_calls: int = BREAKER_HALF_OPEN_CALLS, max_samples: int = 1000, timer=time.monotonic):
+        """
+        Args:
+            name (str): Name of the upstream
+            min_timeout (float): Shortest timeout of a call, in seconds
+            max_timeout (float): Longest timeout of a call, in seconds
+            timeout_factor (float): Timeout of a call relative to the 95th percentile of the latencies
+            window (float): Seconds of calls the error rate and the latencies are computed on
+            min_calls (int): Minimum number of calls in the window to open the breaker or adapt the timeout
+            failure_rate (float): Share of failed calls opening the breaker
+            open_duration (float): Seconds the breaker stays open before probing the upstream
+            half_open_calls (int): Number of successful probes closing the breaker
+            max_samples (int): Maximum number of calls kept in the window
+            timer (Callable): Clock, monotonic by default
+        """
+        self.name = name
+        self.min_timeout = min_timeout
+        self.max_timeout = max_timeout
+        self.timeout_factor = timeout_factor
+        self.window = window
+        self.min_calls = min_calls
+        self.failure_rate = failure_rate
+        self.open_duration = open_duration
+        self.half_open_calls = half_open_calls
+        self.timer = timer
+        self.state = CLOSED
+        self.opened_at = 0.0
+        # (time, success, latency) of the recent calls
+        self._calls: Deque[Tuple[float, bool, float]] = deque(maxlen=max_samples)
+        self._probes = 0
+        self._probe_successes = 0
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def guard(self, deadline: Optional[Deadline] = None, ignore: Tuple[Type[BaseException], ...] = ()):
+        """
+        Guard a call to the upstream, which must apply the `timeout` of the yielded `UpstreamCall`.
+
+        Exceptions raised by the call count as failures, except the `ignore` ones (e.g. invalid requests), which
+        do not tell anything about the health of the upstream.
+
+        Raises:
+            UpstreamUnavailableError: The breaker is open
+            DeadlineExceededError: The deadline of the request has passed
+        """
+        timeout = self.timeout(deadline)
+        probe = self._acquire()
+        call = UpstreamCall(timeout)
+        start_time = self.timer()
+        try:
+            yield call
+        except (gevent.GreenletExit, GeneratorExit):
+            # The call has been cancelled (e.g. a hedge that lost, or a generator guarding a stream closed by its
+            # consumer), it tells nothing about the upstream
+            self._cancel(probe)
+            raise
+        except ignore:
+            self._record(True, self.timer() - start_time, probe)
+            raise
+        except BaseException:
+            self._record(False, self.timer() - start_time, probe)
+            raise
+        self._record(not call.failed, self.timer() - start_time, probe)
+
+    def timeout(self, deadline: Optional[Deadline] = None) -> float:
+        """Timeout of the next call, in seconds"""
+        with self._lock:
+            self._prune()
+            latencies = sorted(latency for _, success, latency in self._calls if success)
+        timeout = self.max_timeout
+        if len(latencies) >= self.min_calls:
+            p95 = latencies[min(int(len(latencies) * 0.95), len(latencies) - 1)]
+            timeout = min(max(p95 * self.timeout_factor, self.min_timeout), self.max_timeout)
+        if deadline is not None:
+            remaining = deadline.remaining()
+            if remaining <= 0:
+                raise DeadlineExceededError(self.name)
+            timeout = min(timeout, remaining)
+        return timeout
+
+    def stats(self) -> Dict:
+        with self._lock:
+            self._prune()
+            calls = len(self._calls)
+            failures = sum(1 for _, success, _ in self._calls if not success)
+            state = self.state
+        return {
+            "state": state,
+            "calls": calls,
+            "failure_rate": failures / calls if calls else 0.0,
+            "timeout": self.timeout(),
+        }
+
+    def _acquire(self) -> bool:
+        """Let a call through, returns True if it is a probe of a half-open breaker"""
+        with self._lock:
+            if self.state == OPEN:
+                if self.timer() - self.opened_at < self.open_duration:
+                    raise UpstreamUnavailableError(self.name)
+                self.state = HALF_OPEN
+                self._probes = 0
+                self._probe_successes = 0
+                logging.info("Circuit breaker {} is half-open".format(self.name))
+            if self.state == HALF_OPEN:
+                if self._probes >= self.half_open_calls:
+                    raise UpstreamUnavailableError(self.name)
+                self._probes += 1
+                return True
+            return False
+
+    def _cancel(self, probe: bool):
+        with self._lock:
+            if probe and self.state == HALF_OPEN:
+                self._probes -= 1
+
+    def _record(self, success: bool, latency: float, probe: bool):
+        with self._lock:
+            now = self.timer()
+            if probe and self.state == HALF_OPEN:
+                if not success:
+                    self._open(now)
+                    return
+                self._probe_successes += 1
+                if self._probe_successes >= self.half_open_calls:
+                    # The failures that opened the breaker are forgotten
+                    self.state = CLOSED
+                    self._calls.clear()
+                    logging.info("Circuit breaker {} is closed".format(self.name))
+            self._calls.append((now, success, latency))
+            if self.state != CLOSED:
+                return
+            self._prune()
+            if len(self._calls) >= self.min_calls:
+                failures = sum(1 for _, call_success, _ in self._calls if not call_success)
+                if failures >= self.failure_rate * len(self._calls):
+                    self._open(now)
+
+    def _open(self, now: float):
+        self.state = OPEN
+        self.opened_at = now
+        logging.warning("Circuit breaker {} is open for {}s".format(self.name, self.open_duration))
+
+    def _prune(self):
+        limit = self.timer() - self.window
+        while self._calls and self._calls[0][0] < limit:
+            self._calls.popleft()
+
+
+class Hedger:
+    """
+    Duplicate the calls that are slower than usual. When a call has not finished after the `percentile` of the
+    recent latencies, a second identical call is started and the first one to succeed wins, the other is killed.
+
+    A hedge costs one more call to the upstream, `stats` reports how many were issued and how many were faster
+    than the original call, to weigh this cost against the tail latency saved.
+    """
+
+    def __init__(self, name: str, percentile: float = 0.95, min_samples: int = 20, window: float = 300,
+                 max_samples: int = 1000, min_delay: float = 0.05, report_every: int = 100):
+        """
+        Args:
+            name (str): Name used in logs
+            percentile (float): Percentile of the latencies after which a call is hedged
+            min_samples (int): Minimum number of latencies observed before hedging
+            window (float): Seconds of latencies the percentile is computed on
+            max_samples (int): Maximum number of latencies kept
+            min_delay (float): Shortest delay before hedging, in seconds
+            report_every (int): Number of hedges between two logs of the stats
+        """
+        self.name = name
+        self.percentile = percentile
+        self.min_samples = min_samples
+        self.window = window
+        self.min_delay = min_delay
+        self.report_every = report_every
+        self.counters = Counter()
+        # (time, latency) of the recent successful calls
+        self._latencies: Deque[Tuple[float, float]] = deque(maxlen=max_samples)
+        self._lock = threading.Lock()
+
+    def delay(self) -> Optional[float]:
+        """Seconds after which a call is hedged, None until enough latencies have been observed"""
+        with self._lock:
+            limit = time.monotonic() - self.window
+            while self._latencies and self._latencies[0][0] < limit:
+                self._latencies.popleft()
+            latencies = sorted(latency for _, latency in self._latencies)
+        if len(latencies) < self.min_samples:
+            return None
+        return max(latencies[min(int(len(latencies) * self.percentile), len(latencies) - 1)], self.min_delay)
+
+    def call(self, func: Callable[[], Any]) -> Any:
+        """
+        Call `func`, and a second time if the first call is slow.
+
+        Raises:
+            The exception of the last call to fail, if none succeeds.
+        """
+        delay = self.delay()
+        self.counters["calls"] += 1
+        first = gevent.spawn(self._timed, func)
+        if delay is None:
+            return first.get()
+        first.join(delay)
+        if first.ready():
+            return first.get()
+
+        second = gevent.spawn(self._timed, func)
+        self.counters["hedges_issued"] += 1
+        pending = [first, second]
+        error = None
+        while pending:
+            done = gevent.wait(pending, count=1)[0]
+            pending.remove(done)
+            if done.successful():
+                for attempt in pending:
+                    attempt.kill(block=False)
+                if done is second:
+                    self.counters["hedges_won"] += 1
+                self._report()
+                return done.value
+            error = done.exception
+        self._report()
+        raise error
+
+    def stats(self) -> Dict[str, float]:
+        counters = dict(self.counters)
+        issued = counters.get("hedges_issued", 0)
+        return {
+            **counters,
+            "hedge_rate": issued / counters["calls"] if counters.get("calls") else 0.0,
+            "hedge_win_rate": counters.get("hedges_won", 0) / issued if issued else 0.0,
+            "delay": self.delay(),
+        }
+
+    def _timed(self, func: Callable[[], Any]) -> Any:
+        start_time = time.monotonic()
+        result = func()
+        with self._lock:
+            self._latencies.append((time.monotonic(), time.monotonic() - start_time))
+        return result
+
+    def _report(self):
+        if self.counters["hedges_issued"] % self.report_every == 0:
+            stats = self.stats()
+            logging.info("Hedging {}: {} calls, {} hedges issued ({:.1%}), {} won ({:.1%})".format(
+                self.name, stats["calls"], stats["hedges_issued"], stats["hedge_rate"], stats["hedges_won"],
+                stats["hedge_win_rate"]))
+
+
+def backoff_delay(attempt: int, base: float, cap: float = 8, retry_after: Optional[float] = None) -> float:
+    """Exponential backoff with jitter before retry number `attempt` (from 0), at least `retry_after` if given"""
+    delay = min(base * 2 ** attempt, cap) * (0.5 + random.random())
+    if retry_after is not None:
+        delay = max(delay, retry_after)
+    return delay
+
+
+def get_breaker(upstream: str) -> CircuitBreaker:
+    """
+    Get the breaker of an upstream, created on first use.
+
+    Args:
+        upstream (str): Name of the upstream, e.g. `openai`, `stability`, `elevenlabs`, `opensearch`
+    """
+    breaker = breakers.get(upstream)
+    if breaker is None:
+        with breakers_lock:
+            breaker = breakers.get(upstream)
+            if breaker is None:
+                min_timeout, max_timeout = upstream_timeouts.get(upstream, (5, 30))
+                breaker = CircuitBreaker(upstream, min_timeout, max_timeout)
+                breakers[upstream] = breaker
+    return breaker
@@ -0,0 +1,135 @@
+"""Occupancy of the chat rooms, shared by the workers so that a room is known to be empty on every node"""
+import threading
+from abc import ABC, abstractmethod
+from datetime import datetime
+from typing import Dict, Optional
+
+
+class RoomRegistry(ABC):
+    """
+    Number of connections in each chat room, with the time the room was entered and the role of the chatter.
+
+    `join` and `leave` are atomic, and only the `leave` emptying a room returns its occupancy. Whichever node the
+    last participant leaves from, exactly one caller therefore sees the room empty.
+    """
+
+    def __init__(self, ttl: float = 86400):
+        """
+        Args:
+            ttl (float): Seconds after which a room without activity is dropped, so that the connections of a
+                crashed node do not keep it occupied forever
+        """
+        self.ttl = ttl
+
+    @abstractmethod
+    def join(self, room: int, role: str) -> int:
+        """
+        Add a connection to a room. The start time and the role are set when the room was empty.
+
+        Returns:
+            Number of connections in the room.
+        """
+        raise NotImplementedError
+
+    @abstractmethod
+    def leave(self, room: int) -> Optional[Dict[str, str]]:
+        """
+        Remove a connection from a room.
+
+        Returns:
+            The `start_time` and `role` of the room if this connection was the last one, None otherwise.
+        """
+        raise NotImplementedError
+
+    @staticmethod
+    def _now() -> str:
+        return datetime.utcnow().isoformat()
+
+
+class InMemoryRoomRegistry(RoomRegistry):
+    """Process-local registry, for a single worker and for tests"""
+
+    def __init__(self, ttl: float = 86400):
+        super().__init__(ttl)
+        self.rooms: Dict[int, Dict] = {}
+        self._lock = threading.Lock()
+
+    def join(self, room, role):
+        with self._lock:
+            occupancy = self.rooms.get(room)
+            if occupancy is None:
+                occupancy = self.rooms[room] = {"count": 0, "start_time": self._now(), "role": role}
+            occupancy["count"] += 1
+            return occupancy["count"]
+
+    def leave(self, room):
+        with self._lock:
+            occupancy = self.rooms.get(room)
+            if occupancy is None:
+                return None
+            occupancy["count"] -= 1
+            if occupancy["count"] > 0:
+                return None
+            del self.rooms[room]
+            return {"start_time": occupancy["start_time"], "role": occupancy["role"]}
+
+
+class RedisRoomRegistry(RoomRegistry):
+    """
+    Registry shared by the nodes through Redis (or any server implementing its protocol). Each room is a hash
+    updated by Lua scripts, so that reading and changing the count is one atomic step.
+    """
+
+    JOIN_SCRIPT = """
+        local count = redis.call('HINCRBY', KEYS[1], 'count', 1)
+        if count == 1 then
+            redis.call('HSET', KEYS[1], 'start_time', ARGV[1], 'role', ARGV[2])
+        end
+        redis.call('EXPIRE', KEYS[1], ARGV[3])
+        return count
+    """
+    LEAVE_SCRIPT = """
+        if redis.call('EXISTS', KEYS[1]) == 0 then
+            return nil
+        end
+        local count = redis.call('HINCRBY', KEYS[1], 'count', -1)
+        if count > 0 then
+            redis.call('EXPIRE', KEYS[1], ARGV[1])
+            return nil
+        end
+        local occupancy = redis.call('HMGET', KEYS[1], 'start_time', 'role')
+        redis.call('DEL', KEYS[1])
+        return occupancy
+    """
+
+    def __init__(self, url: str, ttl: float = 86400, prefix: str = "room"):
+        super().__init__(ttl)
+        # Optional dependency, only required when the registry is configured
+        import redis
+
+        self.redis = redis.Redis.from_url(url, decode_responses=True)
+        self.prefix = prefix
+        self._join = self.redis.register_script(self.JOIN_SCRIPT)
+        self._leave = self.redis.register_script(self.LEAVE_SCRIPT)
+
+    def join(self, room, role):
+        # Store the value of an `AppRole`, not its name
+        role = getattr(role, "value", role)
+        return int(self._join(keys=[self._key(room)], args=[self._now(), role, int(self.ttl)]))
+
+    def leave(self, room):
+        occupancy = self._leave(keys=[self._key(room)], args=[int(self.ttl)])
+        if occupancy is None:
+            return None
+        start_time, role = occupancy
+        return {"start_time": start_time, "role": role}
+
+    def _key(self, room):
+        return "{}:{}".format(self.prefix, room)
+
+
+def create_room_registry(url: Optional[str] = None, ttl: float = 86400) -> RoomRegistry:
+    """Create a Redis registry if `url` is a Redis URL, a process-local registry otherwise"""
+    if url and url.startswith(("redis://", "rediss://", "unix://")):
+        return RedisRoomRegistry(url, ttl)
+    return InMemoryRoomRegistry(ttl)
@@ -0,0 +1,126 @@
+"""Uploads to S3 through the shared boto3 client, in the calling greenlet or in the background"""
+import io
+import logging
+import threading
+from collections import Counter
+from typing import Callable, Dict, Optional
+
+from boto3.s3.transfer import TransferConfig
+from botocore.exceptions import BotoCoreError, ClientError
+
+# Called with the key and the error of a failed background upload
+UploadErrorCallback = Callable[[str, Exception], None]
+
+
+class S3Uploader:
+    """
+    Upload objects with the shared S3 client, so that uploads reuse its connection pool instead of going through a
+    presigned URL.
+
+    Payloads smaller than `multipart_threshold` are sent in a single `put_object`, larger ones with a multipart
+    `upload_fileobj` sending `max_concurrency` parts at a time.
+
+    With `wait=False`, `upload` returns as soon as the upload is started and reports a failure to `on_error`. At
+    most `max_background` uploads run in the background; beyond that, uploads run in the calling greenlet, so that
+    a slow S3 slows the callers down instead of piling up payloads in memory.
+    """
+
+    def __init__(self, get_client: Callable, multipart_threshold: int = 8 * 1024 * 1024,
+                 multipart_chunksize: int = 8 * 1024 * 1024, max_concurrency: int = 4, max_background: int = 32,
+                 report_every: int = 1000):
+        """
+        Args:
+            get_client (Callable): Returns the S3 client, called for each upload so that a renewed client is used
+            multipart_threshold (int): Minimum size of a multipart upload, in bytes
+            multipart_chunksize (int): Size of the parts of a multipart upload, in bytes
+            max_concurrency (int): Number of parts of a multipart upload sent at the same time
+            max_background (int): Maximum number of uploads running in the background
+            report_every (int): Number of uploads between two logs of the stats
+        """
+        self.get_client = get_client
+        self.multipart_threshold = multipart_threshold
+        self.transfer_config = TransferConfig(
+            multipart_threshold=multipart_threshold,
+            multipart_chunksize=multipart_chunksize,
+            max_concurrency=max_concurrency,
+        )
+        self.report_every = report_every
+        self.counters = Counter()
+        self._background = threading.BoundedSemaphore(max_background)
+        self._lock = threading.Lock()
+
+    def upload(self, data: bytes, bucket: str, key: str, content_type: Optional[str] = None, wait: bool = True,
+               on_error: Optional[UploadErrorCallback] = None):
+        """
+        Upload `data` to `key` in `bucket`.
+
+        Args:
+            data (bytes): Content of the object
+            bucket (str): Name of the bucket
+            key (str): Key of the object
+            content_type (str, optional): Content-Type of the object
+            wait (bool): Whether to wait for the upload to complete
+            on_error (Callable, optional): Called with the key and the error if a background upload fails
+
+        Raises:
+            ConnectionError: The upload failed, when waiting for it
+        """
+        if not wait and self._background.acquire(blocking=False):
+            threading.Thread(
+                target=self._upload_in_background, args=(data, bucket, key, content_type, on_error),
+                name="s3-upload", daemon=True,
+            ).start()
+            return
+        if not wait:
+            self._count("background_full")
+        self._upload(data, bucket, key, content_type)
+
+    def stats(self) -> Dict[str, int]:
+        with self._lock:
+            return dict(self.counters)
+
+    def _upload(self, data: bytes, bucket: str, key: str, content_type: Optional[str]):
+        client = self.get_client()
+        try:
+            if len(data) < self.multipart_threshold:
+                kwargs = {"ContentType": content_type} if content_type is not None else {}
+                client.put_object(Bucket=bucket, Key=key, Body=data, **kwargs)
+                self._count("put_object", len(data))
+            else:
+                extra_args = {"ContentType": content_type} if content_type is not None else None
+                client.upload_fileobj(io.BytesIO(data), bucket, key, ExtraArgs=extra_args,
+                                      Config=self.transfer_config)
+                self._count("multipart", len(data))
+        except (BotoCoreError, ClientError) as e:
+            self._count("failed")
+            raise ConnectionError("Fail to upload {} to S3: {}".format(key, e)) from e
+
+    def _upload_in_background(self, data: bytes, bucket: str, key: str, content_type: Optional[str],
+                              on_error: Optional[UploadErrorCallback]):
+        try:
+            self._upload(data, bucket, key, content_type)
+        except Exception as e:
+            logging.exception("Background upload of {} failed".format(key))
+            if on_error is not None:
+                try:
+                    on_error(key, e)
+                except Exception:
+                    logging.exception("Callback of the failed upload of {} failed".format(key))
+        finally:
+            self._background.release()
+
+    def _count(self, name: str, size: int = 0):
+        with self._lock:
+            self.counters[name] += 1
+            if name in ("put_object", "multipart"):
+                self.counters["bytes"] += size
+                uploads = self.counters["put_object"] + self.counters["multipart"]
+                report = uploads % self.report_every == 0
+            else:
+                report = False
+            counters = dict(self.counters)
+        if report:
+            logging.info("S3 uploads: {} single, {} multipart, {} bytes, {} failed, {} run inline as the background "
+                         "was full".format(counters.get("put_object", 0), counters.get("multipart", 0),
+                                           counters.get("bytes", 0), counters.get("failed", 0),
+                                           counters.get("background_full", 0)))
@@ -0,0 +1,64 @@
+"""Client managers of Socket.IO, relaying the events of every worker through a pub/sub message queue"""
+import queue
+import threading
+from collections import defaultdict
+from typing import Dict, List, Optional
+
+import socketio
+
+
+class InProcessPubSubManager(socketio.PubSubManager):
+    """
+    Pub/sub manager whose message queue is a process-local broker. Every manager on the same channel receives the
+    messages published by the others, like servers sharing a Redis channel, which lets tests run several servers
+    in one process.
+    """
+
+    name = "inprocess"
+    # Queues of the subscribed managers, by channel
+    subscribers: Dict[str, List[queue.Queue]] = defaultdict(list)
+    _lock = threading.Lock()
+
+    def __init__(self, url: str = "memory://", channel: str = "socketio", write_only: bool = False, logger=None):
+        super().__init__(channel=channel, write_only=write_only, logger=logger)
+        self.queue = queue.Queue()
+        if not write_only:
+            with self._lock:
+                self.subscribers[channel].append(self.queue)
+
+    def _publish(self, data):
+        with self._lock:
+            subscribers = list(self.subscribers[self.channel])
+        for subscriber in subscribers:
+            subscriber.put(data)
+
+    def _listen(self):
+        while True:
+            data = self.queue.get()
+            if data is None:
+                break
+            yield data
+
+    def close(self):
+        """Unsubscribe from the broker and stop the listener"""
+        with self._lock:
+            if self.queue in self.subscribers[self.channel]:
+                self.subscribers[self.channel].remove(self.queue)
+        self.queue.put(None)
+
+
+def create_client_manager(url: Optional[str] = None, channel: str = "socketio") -> Optional[socketio.BaseManager]:
+    """
+    Create the client manager of a Socket.IO server from the URL of its message queue.
+
+    Returns:
+        An in-process manager for `memory://`, a Redis manager for a Redis URL, a Kombu manager for any other
+        broker URL, and None if `url` is not set, i.e. the default manager of a single worker.
+    """
+    if not url:
+        return None
+    if url.startswith("memory://"):
+        return InProcessPubSubManager(url, channel=channel)
+    if url.startswith(("redis://", "rediss://", "unix://")):
+        return socketio.RedisManager(url, channel=channel)
+    return socketio.KombuManager(url, channel=channel)
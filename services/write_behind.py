@@ -0,0 +1,299 @@
+"""Write-behind queue acknowledging writes right away and persisting them in micro-batches"""
+import glob
+import json
+import logging
+import os
+import queue
+import random
+import threading
+import time
+from collections import Counter
+from typing import Callable, Dict, Hashable, List, Optional
+
+_STOP = object()
+
+
+class WriteBehindQueue:
+    """
+    Bounded in-process queue of records persisted by a background worker.
+
+    `put` only enqueues the record, the worker groups queued records into batches of up to `batch_size` (waiting
+    at most `flush_interval` seconds for a batch to fill) and hands them to `write_batch`. Records that
+    `write_batch` reports as failed are retried with an exponential backoff, and spilled to a local file after
+    `max_attempts`. On shutdown, the records that are still queued are spilled as well, and `recover` enqueues
+    them again on the next start.
+
+    Each process spills into its own file, derived from `spill_path` and its pid, so that the workers of a server
+    never share one. `recover` takes over the files of the processes that are no longer running.
+
+    A record discarded while its batch is being written may be written after the caller deleted it. Its key is
+    kept as a tombstone until the batch has finished, then `delete` is called with it to delete it again.
+
+    When the queue is full, `put` waits up to `put_timeout` seconds then returns False, so that the caller can
+    apply backpressure (e.g. write synchronously) instead of growing the queue without bound.
+    """
+
+    def __init__(self, name: str, write_batch: Callable[[List[Dict]], List[Dict]], key: Callable[[Dict], Hashable],
+                 batch_size: int = 25, flush_interval: float = 0.1, max_size: int = 2000, put_timeout: float = 0.5,
+                 max_attempts: int = 5, spill_path: Optional[str] = None,
+                 delete: Optional[Callable[[Hashable], None]] = None):
+        """
+        Args:
+            name (str): Name used in logs
+            write_batch (Callable): Persist a batch of records, returns the records that could not be written
+            key (Callable): Unique key of a record, used to discard pending records
+            batch_size (int): Maximum number of records per batch
+            flush_interval (float): Maximum time to wait for a batch to fill, in seconds
+            max_size (int): Maximum number of queued records
+            put_timeout (float): Maximum time `put` waits for a free slot when the queue is full, in seconds
+            max_attempts (int): Number of attempts to write a record before it is spilled
+            spill_path (str, optional): JSON lines file receiving the records that could not be written, suffixed
+                with the pid of the process, e.g. `message_spill.123.jsonl` for `message_spill.jsonl`
+            delete (Callable, optional): Delete the persisted record of a key, called after a batch holding a record
+                discarded while it was written
+        """
+        self.name = name
+        self.write_batch = write_batch
+        self.key = key
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.put_timeout = put_timeout
+        self.max_attempts = max_attempts
+        self.delete = delete
+        self.spill_root, self.spill_ext = os.path.splitext(spill_path) if spill_path else (None, None)
+        self.spill_path = self._spill_path_of(os.getpid()) if spill_path else None
+        self.counters = Counter()
+        self._queue = queue.Queue(maxsize=max_size)
+        self._pending_keys = Counter()
+        self._discarded_keys = set()
+        # Keys of the batch being written, and the ones discarded meanwhile
+        self._inflight_keys = Counter()
+        self._tombstones = set()
+        self._lock = threading.Lock()
+        self._worker = None
+        self._stopped = False
+
+    def start(self):
+        with self._lock:
+            if self._worker is None and not self._stopped:
+                self._worker = threading.Thread(target=self._run, name=self.name, daemon=True)
+                self._worker.start()
+
+    def put(self, record: Dict) -> bool:
+        """
+        Enqueue a record.
+
+        Returns:
+            True if the record has been queued, False if the queue is full or stopped.
+        """
+        if self._stopped:
+            return False
+        self.start()
+        with self._lock:
+            self._pending_keys[self.key(record)] += 1
+        try:
+            self._queue.put(record, timeout=self.put_timeout)
+        except queue.Full:
+            self._release(record)
+            self.counters["rejected"] += 1
+            logging.warning("Write-behind queue {} is full, the record is rejected".format(self.name))
+            return False
+        self.counters["queued"] += 1
+        return True
+
+    def discard(self, key: Hashable) -> bool:
+        """
+        Drop a pending record, e.g. when it has been deleted before being written. A record already being written
+        is deleted again once written.
+
+        Returns:
+            True if a record of the key was queued or being written.
+        """
+        with self._lock:
+            found = False
+            if self._pending_keys[key] > 0:
+                self._discarded_keys.add(key)
+                found = True
+            if self._inflight_keys[key] > 0:
+                self._tombstones.add(key)
+                found = True
+            return found
+
+    def qsize(self) -> int:
+        return self._queue.qsize()
+
+    def shutdown(self, timeout: float = 5):
+        """Stop the worker after the queued records are written, spilling what is left after `timeout` seconds"""
+        with self._lock:
+            self._stopped = True
+            worker = self._worker
+        if worker is not None:
+            self._queue.put(_STOP)
+            worker.join(timeout)
+
+        remaining = []
+        while True:
+            try:
+                record = self._queue.get_nowait()
+            except queue.Empty:
+                break
+            if record is not _STOP:
+                remaining.append(record)
+        if remaining:
+            self._spill(remaining)
+
+    def recover(self) -> int:
+        """
+        Enqueue the records spilled by a previous run.
+
+        Returns:
+            Number of recovered records.
+        """
+        if not self.spill_path:
+            return 0
+        count = 0
+        for path in self._orphan_spill_paths():
+            # Take over the file so that the records failing again are spilled into a new one. Another worker
+            # starting at the same time may have taken it first.
+            recovering_path = "{}.recovering.{}".format(path, os.getpid())
+            try:
+                os.replace(path, recovering_path)
+            except FileNotFoundError:
+                continue
+            with open(recovering_path) as file:
+                records = [json.loads(line) for line in file if line.strip()]
+            for record in records:
+                if not self.put(record):
+                    self._spill([record])
+            os.remove(recovering_path)
+            count += len(records)
+        if count:
+            logging.info("Recovered {} records of write-behind queue {}".format(count, self.name))
+        return count
+
+    def _spill_path_of(self, pid: int) -> str:
+        return "{}.{}{}".format(self.spill_root, pid, self.spill_ext)
+
+    def _orphan_spill_paths(self) -> List[str]:
+        """Spill files of the processes that are not running, including the file of a previous version"""
+        paths = []
+        legacy_path = self.spill_root + self.spill_ext
+        if os.path.exists(legacy_path):
+            paths.append(legacy_path)
+        prefix, suffix = self.spill_root + ".", self.spill_ext
+        for path in glob.glob(glob.escape(prefix) + "*" + glob.escape(suffix)):
+            pid = path[len(prefix):len(path) - len(suffix)]
+            if pid.isdigit() and (int(pid) == os.getpid() or not _is_running(int(pid))):
+                paths.append(path)
+        return paths
+
+    def _run(self):
+        while True:
+            batch, stop = self._next_batch()
+            if batch:
+                self._write(batch)
+            if stop:
+                return
+
+    def _next_batch(self):
+        record = self._queue.get()
+        if record is _STOP:
+            return [], True
+        batch = [record]
+        deadline = time.monotonic() + self.flush_interval
+        while len(batch) < self.batch_size:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                record = self._queue.get(timeout=remaining)
+            except queue.Empty:
+                break
+            if record is _STOP:
+                return batch, True
+            batch.append(record)
+        return batch, False
+
+    def _write(self, batch: List[Dict]):
+        with self._lock:
+            # The keys move from pending to in flight at once, so that a discard always finds them
+            batch = [record for record in batch if self.key(record) not in self._discarded_keys]
+            keys = [self.key(record) for record in batch]
+            self._inflight_keys.update(keys)
+        for record in batch:
+            self._release(record)
+        with self._lock:
+            self._discarded_keys.intersection_update(self._pending_keys)
+
+        try:
+            self._write_batch(batch)
+        finally:
+            with self._lock:
+                self._inflight_keys.subtract(keys)
+                finished = {key for key in keys if self._inflight_keys[key] <= 0}
+                for key in finished:
+                    del self._inflight_keys[key]
+                deleted = finished & self._tombstones
+                self._tombstones -= deleted
+            for key in deleted:
+                self._delete(key)
+
+    def _write_batch(self, batch: List[Dict]):
+        for attempt in range(self.max_attempts):
+            if not batch:
+                return
+            try:
+                failed = self.write_batch(batch)
+            except Exception as e:
+                logging.warning("Fail to write a batch of write-behind queue {}: {}".format(self.name, e))
+                failed = batch
+            self.counters["written"] += len(batch) - len(failed)
+            batch = failed
+            if batch and attempt + 1 < self.max_attempts:
+                time.sleep(min(0.05 * 2 ** attempt, 2) * (0.5 + random.random()))
+
+        with self._lock:
+            # Records deleted meanwhile must not come back with the spill
+            batch = [record for record in batch if self.key(record) not in self._tombstones]
+        if batch:
+            self.counters["failed"] += len(batch)
+            self._spill(batch)
+
+    def _delete(self, key: Hashable):
+        if self.delete is None:
+            logging.warning("Record {} of write-behind queue {} was discarded while written".format(key, self.name))
+            return
+        try:
+            self.delete(key)
+            self.counters["deleted_after_write"] += 1
+        except Exception:
+            logging.exception("Fail to delete record {} of write-behind queue {}".format(key, self.name))
+
+    def _release(self, record: Dict):
+        with self._lock:
+            key = self.key(record)
+            self._pending_keys[key] -= 1
+            if self._pending_keys[key] <= 0:
+                del self._pending_keys[key]
+
+    def _spill(self, records: List[Dict]):
+        if not self.spill_path:
+            logging.error("{} records of write-behind queue {} are lost".format(len(records), self.name))
+            return
+        with self._lock:
+            with open(self.spill_path, "a") as file:
+                for record in records:
+                    file.write(json.dumps(record) + "\n")
+        self.counters["spilled"] += len(records)
+        logging.warning("Spilled {} records of write-behind queue {} to {}".format(
+            len(records), self.name, self.spill_path))
+
+
+def _is_running(pid: int) -> bool:
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
@@ -0,0 +1,91 @@
+import gevent
+import pytest
+
+from services.admission import ActionLane, AdmissionController
+from utils.exceptions import ServiceOverloadedError
+
+
+def create_lane(**kwargs):
+    options = dict(concurrency=1, queue_size=4, max_per_user=3, queue_timeout=1)
+    options.update(kwargs)
+    return ActionLane("test", **options)
+
+
+def test_request_waits_for_a_released_slot():
+    lane = create_lane()
+    lane.acquire("a")
+    waiting = gevent.spawn(lane.acquire, "b")
+    gevent.sleep(0)
+    assert lane.stats()["queue_depth"] == 1
+
+    lane.release("a")
+    waiting.get(timeout=1)
+
+    assert lane.active == 1
+    assert lane.queued == 0
+
+
+def test_waiting_users_are_served_in_turn():
+    lane = create_lane()
+    lane.acquire("a")
+    served = []
+
+    def request(user, index):
+        lane.acquire(user)
+        served.append((user, index))
+
+    requests = [gevent.spawn(request, "b", 0), gevent.spawn(request, "b", 1), gevent.spawn(request, "c", 0)]
+    gevent.sleep(0)
+    lane.release("a")
+    for user, _ in [("b", 0), ("c", 0), ("b", 1)]:
+        gevent.sleep(0)
+        lane.release(user)
+    gevent.joinall(requests, raise_error=True)
+
+    assert served == [("b", 0), ("c", 0), ("b", 1)]
+
+
+def test_requests_are_rejected_beyond_the_limits():
+    lane = create_lane(queue_size=1, max_per_user=1)
+    lane.acquire("a")
+    with pytest.raises(ServiceOverloadedError):
+        lane.acquire("a")
+
+    waiting = gevent.spawn(lane.acquire, "b")
+    gevent.sleep(0)
+    with pytest.raises(ServiceOverloadedError):
+        lane.acquire("c")
+
+    stats = lane.stats()
+    assert stats["rejected_user_limit"] == 1
+    assert stats["rejected_queue_full"] == 1
+    waiting.kill()
+
+
+def test_request_times_out_and_leaves_the_queue():
+    lane = create_lane(queue_timeout=0.01)
+    lane.acquire("a")
+
+    with pytest.raises(ServiceOverloadedError):
+        lane.acquire("b")
+
+    assert lane.queued == 0
+    lane.release("a")
+    assert lane.active == 0
+    lane.acquire("b")
+
+
+def test_rejected_admission_releases_the_slots_already_taken():
+    text = ActionLane("text", concurrency=2, queue_size=0)
+    speech = ActionLane("speech", concurrency=1, queue_size=0)
+    controller = AdmissionController([text, speech])
+    ticket = controller.admit("a", "text", "speech")
+
+    with pytest.raises(ServiceOverloadedError):
+        controller.admit("b", "text", "speech")
+
+    assert text.active == 1
+    ticket.release()
+    ticket.release()
+    assert text.active == 0
+    assert speech.active == 0
@@ -0,0 +1,74 @@
+import datetime
+import os
+import threading
+
+import pytest
+
+pytest.importorskip("flask_sqlalchemy")
+pytest.importorskip("requests_aws4auth")
+for name, value in [("AWS_ACCESS_KEY_ID", "test"), ("AWS_SECRET_ACCESS_KEY", "test"), ("AWS_REGION", "us-east-1"),
+                    ("MESSAGE_WRITE_BEHIND", "false")]:
+    os.environ.setdefault(name, value)
+
+from utils import chat_config  # noqa: E402
+from utils.cache import InvalidationChannel  # noqa: E402
+from utils.enum.role import AppRole  # noqa: E402
+
+
+class Chatter:
+    date_of_birth = datetime.date(2015, 1, 1)
+    display_name = "Kid"
+    username = "kid"
+
+
+@pytest.fixture
+def snapshots(monkeypatch):
+    loads = []
+
+    def load_chat_snapshot(id, person_ai_id, role):
+        loads.append((id, person_ai_id, role))
+        return chat_config.ChatSnapshot(Chatter(), None, None, None, message_id=7)
+
+    monkeypatch.setattr(chat_config, "load_chat_snapshot", load_chat_snapshot)
+    chat_config.chat_config_cache.invalidate()
+    return loads
+
+
+def test_snapshot_of_string_ids_is_invalidated_by_the_int_ids(snapshots):
+    chat_config.get_chat_config("12", "3", AppRole.USER, "uuid")
+    chat_config.get_chat_config(12, 3, AppRole.USER, "uuid")
+
+    assert snapshots == [(12, 3, AppRole.USER)]
+    assert chat_config.invalidate_chat_config(AppRole.USER, 12) == 1
+    assert chat_config.invalidate_chat_config(AppRole.USER, 12) == 0
+
+
+def test_invalidations_are_relayed_to_the_other_processes(monkeypatch):
+    fakeredis = pytest.importorskip("fakeredis")
+    import redis
+
+    server = fakeredis.FakeServer()
+    monkeypatch.setattr(redis.Redis, "from_url", lambda url, **kwargs: fakeredis.FakeRedis(server=server, **kwargs))
+    received = []
+    relayed = threading.Event()
+
+    def on_message(message):
+        received.append(message)
+        relayed.set()
+
+    sender = InvalidationChannel("redis://localhost", "test", lambda message: None)
+    receiver = InvalidationChannel("redis://localhost", "test", on_message)
+    assert sender.wait_subscribed(1) and receiver.wait_subscribed(1)
+
+    sender.publish({"role": AppRole.USER, "id": 12})
+
+    assert relayed.wait(1)
+    assert received == [{"role": "user", "id": 12}]
+
+
+def test_relayed_invalidation_drops_the_snapshots_of_the_chatter(snapshots):
+    chat_config.get_chat_config(12, 3, AppRole.USER, "uuid")
+    chat_config.get_chat_config(12, 3, AppRole.PARENT, "uuid")
+
+    assert chat_config.drop_chat_config("user", 12) == 1
+    assert len(chat_config.chat_config_cache) == 1
@@ -0,0 +1,63 @@
+import pytest
+
+from services.context_store import InMemoryContextStore, create_context_store
+
+
+def record(timestamp, content="hello"):
+    return {"timestamp": timestamp, "content": content}
+
+
+def test_only_a_redis_url_selects_a_shared_store():
+    assert isinstance(create_context_store(None), InMemoryContextStore)
+    assert isinstance(create_context_store("memory://"), InMemoryContextStore)
+    assert isinstance(create_context_store("amqp://guest@localhost//"), InMemoryContextStore)
+
+
+def test_record_appended_while_loading_is_kept_by_seed():
+    store = InMemoryContextStore(window=10)
+    store.append(1, record("3"))
+    store.seed(1, [record("1"), record("2")], complete=True)
+
+    assert [item["timestamp"] for item in store.get(1, 10)] == ["1", "2", "3"]
+
+
+def test_incomplete_window_does_not_serve_more_records_than_it_holds():
+    store = InMemoryContextStore(window=2)
+    store.seed(1, [record("1"), record("2"), record("3")], complete=True)
+
+    assert store.get(1, 3) is None
+    assert [item["timestamp"] for item in store.get(1, 2)] == ["2", "3"]
+
+
+def test_removed_record_is_not_served():
+    store = InMemoryContextStore(window=10)
+    store.seed(1, [record("1"), record("2")], complete=True)
+    store.remove(1, "1")
+
+    assert [item["timestamp"] for item in store.get(1, 10)] == ["2"]
+
+
+def test_record_appended_by_another_process_during_a_redis_seed_is_kept():
+    fakeredis = pytest.importorskip("fakeredis")
+    from services import context_store
+
+    server = fakeredis.FakeServer()
+    other = context_store.RedisContextStore("redis://localhost", window=10)
+    other.redis = fakeredis.FakeRedis(server=server)
+
+    class InterleavedStore(context_store.RedisContextStore):
+        merges = 0
+
+        def _merge(self, records, new_records, complete):
+            self.merges += 1
+            if self.merges == 1:
+                # Another worker appends between the read and the write of the window
+                other.append(1, record("3"))
+            return super()._merge(records, new_records, complete)
+
+    store = InterleavedStore("redis://localhost", window=10)
+    store.redis = fakeredis.FakeRedis(server=server)
+    store.seed(1, [record("1"), record("2")], complete=True)
+
+    assert store.merges == 2
+    assert [item["timestamp"] for item in store.get(1, 10)] == ["1", "2", "3"]
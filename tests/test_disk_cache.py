@@ -0,0 +1,98 @@
+import os
+import threading
+import time
+
+import pytest
+
+from utils.cache import DiskLRUCache
+
+
+def loader(data, metadata=None):
+    return lambda: ([data[index:index + 4] for index in range(0, len(data), 4)], metadata or {})
+
+
+def read(entry):
+    with open(entry.path, "rb") as file:
+        return file.read()
+
+
+def test_loaded_file_is_served_from_disk(tmp_path):
+    cache = DiskLRUCache(str(tmp_path), max_bytes=1024)
+
+    entry = cache.get_or_load("a", loader(b"hello world", {"content_type": "image/jpeg"}))
+
+    assert read(entry) == b"hello world"
+    assert entry.size == 11
+    assert entry.metadata == {"content_type": "image/jpeg"}
+    assert cache.get_or_load("a", loader(b"other")) is entry
+    assert cache.stats()["hits"] == 1
+
+
+def test_least_recently_used_files_are_evicted(tmp_path):
+    cache = DiskLRUCache(str(tmp_path), max_bytes=20)
+    first = cache.get_or_load("a", loader(b"a" * 8))
+    cache.get_or_load("b", loader(b"b" * 8))
+    cache.get("a")
+
+    cache.get_or_load("c", loader(b"c" * 8))
+
+    assert cache.get("b") is None
+    assert cache.get("a") is first
+    assert cache.stats()["bytes"] == 16
+    assert sorted(os.listdir(cache.directory)) == sorted(
+        os.path.basename(cache.get(key).path) for key in ("a", "c"))
+
+
+def test_file_larger_than_the_cache_is_kept_alone(tmp_path):
+    cache = DiskLRUCache(str(tmp_path), max_bytes=10)
+    cache.get_or_load("a", loader(b"a" * 8))
+
+    entry = cache.get_or_load("b", loader(b"b" * 32))
+
+    assert cache.get("a") is None
+    assert read(entry) == b"b" * 32
+
+
+def test_evicted_file_stays_readable_while_open(tmp_path):
+    cache = DiskLRUCache(str(tmp_path), max_bytes=10)
+    entry = cache.get_or_load("a", loader(b"a" * 8))
+
+    with open(entry.path, "rb") as file:
+        cache.get_or_load("b", loader(b"b" * 8))
+        assert not os.path.exists(entry.path)
+        assert file.read() == b"a" * 8
+
+
+def test_concurrent_misses_load_a_key_once(tmp_path):
+    cache = DiskLRUCache(str(tmp_path), max_bytes=1024)
+    calls = []
+
+    def load():
+        calls.append(True)
+        time.sleep(0.05)
+        return [b"data"], {}
+
+    entries = []
+    threads = [threading.Thread(target=lambda: entries.append(cache.get_or_load("a", load))) for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert len(calls) == 1
+    assert len(set(map(id, entries))) == 1
+    assert cache.stats()["misses"] == 1
+
+
+def test_failed_load_leaves_no_file_and_is_retried(tmp_path):
+    cache = DiskLRUCache(str(tmp_path), max_bytes=1024)
+
+    def chunks():
+        yield b"partial"
+        raise ConnectionError()
+
+    with pytest.raises(ConnectionError):
+        cache.get_or_load("a", lambda: (chunks(), {}))
+
+    assert os.listdir(cache.directory) == []
+    assert read(cache.get_or_load("a", loader(b"complete"))) == b"complete"
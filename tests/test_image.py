@@ -0,0 +1,40 @@
+import io
+
+import pytest
+from PIL import Image, UnidentifiedImageError
+
+from utils.image import encode_image
+
+
+def png(mode, color):
+    stream = io.BytesIO()
+    Image.new(mode, (64, 64), color).save(stream, format="PNG")
+    return stream.getvalue()
+
+
+def test_transparent_avatar_is_kept_as_png():
+    image_data = png("RGBA", (255, 0, 0, 0))
+
+    encoded, encoding = encode_image(image_data, "user_avatar")
+
+    assert encoding.format == "PNG"
+    assert encoded == image_data
+
+
+def test_opaque_avatar_is_encoded_as_jpeg():
+    encoded, encoding = encode_image(png("RGBA", (255, 0, 0, 255)), "parent_avatar")
+
+    assert encoding.format == "JPEG"
+    assert Image.open(io.BytesIO(encoded)).format == "JPEG"
+
+
+def test_transparent_report_is_flattened():
+    encoded, encoding = encode_image(png("RGBA", (255, 0, 0, 0)), "app_report")
+
+    assert encoding.format == "JPEG"
+    assert Image.open(io.BytesIO(encoded)).getpixel((0, 0)) == (255, 255, 255)
+
+
+def test_unreadable_image_raises():
+    with pytest.raises(UnidentifiedImageError):
+        encode_image(b"not an image", "user_avatar")
@@ -0,0 +1,62 @@
+import json
+
+import pytest
+
+from utils.json_stream import FIELD, STRING_DELTA, JSONObjectStreamParser
+
+DOCUMENT = json.dumps({
+    "content": "Line \"one\"\ncafé \U0001F600 back\\slash",
+    "links": ["https://a.example/]", "quote \" and {brace}"],
+    "meta": {"nested": [1, {"deep": "}"}]},
+    "count": 12,
+    "done": True,
+    "none": None,
+    "next_questions": [],
+})
+
+
+def parse(chunks):
+    parser = JSONObjectStreamParser(stream_keys=["content"])
+    events = []
+    for chunk in chunks:
+        events.extend(parser.feed(chunk))
+    return parser, events
+
+
+def split(text, size):
+    return [text[index:index + size] for index in range(0, len(text), size)]
+
+
+@pytest.mark.parametrize("size", [1, 2, 3, 5, 7, 64, len(DOCUMENT)])
+def test_chunked_document_is_parsed_as_a_whole(size):
+    parser, events = parse(split(DOCUMENT, size))
+
+    assert parser.is_done
+    assert parser.result == json.loads(DOCUMENT)
+    assert [(key, value) for event, key, value in events if event == FIELD] == list(json.loads(DOCUMENT).items())
+
+
+@pytest.mark.parametrize("cut", range(1, len(DOCUMENT)))
+def test_deltas_rebuild_the_streamed_string_wherever_the_text_is_cut(cut):
+    parser, events = parse([DOCUMENT[:cut], DOCUMENT[cut:]])
+
+    deltas = [text for event, key, text in events if event == STRING_DELTA]
+    assert all(key == "content" for event, key, _ in events if event == STRING_DELTA)
+    assert "".join(deltas) == json.loads(DOCUMENT)["content"]
+
+
+def test_surrogate_pair_split_between_chunks_is_delivered_whole():
+    _, events = parse(['{"content": "a\\ud83d', '\\ude00b"}'])
+
+    deltas = [text for event, _, text in events if event == STRING_DELTA]
+    assert deltas == ["a", "\U0001F600b"]
+
+
+def test_deltas_are_sent_as_the_chunks_arrive():
+    parser = JSONObjectStreamParser(stream_keys=["content"])
+
+    assert parser.feed('{"content": "Hel') == [(STRING_DELTA, "content", "Hel")]
+    assert parser.feed('lo"') == [(STRING_DELTA, "content", "lo"), (FIELD, "content", "Hello")]
+    assert not parser.is_done
+    assert parser.feed("}") == []
+    assert parser.is_done
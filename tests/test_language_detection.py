@@ -0,0 +1,46 @@
+import pytest
+
+from utils.enum.language import Language
+from utils.language_detection import LanguageDetector, classify_language, normalize_text
+
+
+@pytest.mark.parametrize("text, language", [
+    ("what is the biggest dinosaur and why is it so big", Language.ENGLISH),
+    ("hola, ¿cómo estás? cuéntame una historia por favor", Language.SPANISH),
+    ("bonjour, pourquoi le ciel est bleu et pas vert", Language.FRENCH),
+    ("ciao, perché il cielo è blu? sono curioso", Language.ITALIAN),
+    ("hallo, warum ist der himmel blau und nicht grün", Language.GERMAN),
+    ("cześć, dlaczego niebo jest niebieskie? powiedz mi", Language.POLISH),
+    ("olá, como você está? eu não sei porque o céu é azul", Language.PORTUGUESE),
+    ("नमस्ते, आकाश नीला क्यों है", Language.HINDI),
+])
+def test_clear_messages_are_classified_locally(text, language):
+    detected, confidence = classify_language(normalize_text(text))
+
+    assert detected == language
+    assert confidence >= 0.8
+
+
+@pytest.mark.parametrize("text", ["ok", "1234 !!", "你好，天空为什么是蓝色的"])
+def test_messages_without_evidence_are_not_classified(text):
+    detected, confidence = classify_language(normalize_text(text))
+
+    assert detected is None or confidence < 0.8
+
+
+def test_detector_falls_back_once_per_normalized_text():
+    calls = []
+
+    def fallback(text):
+        calls.append(text)
+        return ["zh"]
+
+    detector = LanguageDetector(fallback)
+
+    assert detector.detect("你好") == ["zh"]
+    assert detector.detect("  你好 ") == ["zh"]
+    assert detector.detect("What is the moon made of?") == [Language.ENGLISH.value]
+    assert calls == ["你好"]
+    assert detector.stats()["cache_hits"] == 1
+    assert detector.stats()["fallback"] == 1
+    assert detector.stats()["local"] == 1
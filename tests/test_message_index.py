@@ -0,0 +1,107 @@
+import json
+import os
+
+import pytest
+
+pytest.importorskip("requests_aws4auth")
+for name, value in [("AWS_ACCESS_KEY_ID", "test"), ("AWS_SECRET_ACCESS_KEY", "test"), ("AWS_REGION", "us-east-1"),
+                    ("MESSAGE_WRITE_BEHIND", "false")]:
+    os.environ.setdefault(name, value)
+
+from services import aws_service  # noqa: E402
+from utils.exceptions import UpstreamUnavailableError  # noqa: E402
+
+
+class Response:
+    def __init__(self, status_code, body):
+        self.status_code = status_code
+        self.body = body
+        self.text = json.dumps(body)
+        self.content = self.text.encode()
+
+    def json(self):
+        return self.body
+
+
+class OpenSearch:
+    """Answers the requests of `aws_service.request_opensearch` in turn"""
+
+    def __init__(self, *responses):
+        self.responses = list(responses)
+        self.requests = []
+
+    def __call__(self, method, url, **kwargs):
+        self.requests.append((method, url, kwargs))
+        response = self.responses.pop(0)
+        if isinstance(response, Exception):
+            raise response
+        return response
+
+
+def record(history_message_id, timestamp):
+    return {"history_message_id": history_message_id, "timestamp": timestamp, "content": "hi", "role": "user"}
+
+
+@pytest.fixture
+def opensearch(monkeypatch):
+    monkeypatch.setattr(aws_service, "OPENSEARCH_DOMAIN_ENDPOINT", "https://search")
+    monkeypatch.setattr(aws_service, "message_index_ready", False)
+
+    def install(*responses):
+        server = OpenSearch(*responses)
+        monkeypatch.setattr(aws_service, "request_opensearch", server)
+        return server
+
+    return install
+
+
+def test_index_is_created_before_the_first_write_only(opensearch):
+    server = opensearch(Response(200, {}), Response(200, {"errors": False}), Response(200, {"errors": False}))
+
+    assert aws_service.store_message_records_to_opensearch([record(1, "a")]) == []
+    assert aws_service.store_message_records_to_opensearch([record(1, "b")]) == []
+
+    methods = [(method, url) for method, url, _ in server.requests]
+    assert methods == [("put", "https://search/" + aws_service.OPENSEARCH_MESSAGE_INDEX),
+                       ("post", "https://search/_bulk"), ("post", "https://search/_bulk")]
+    assert server.requests[1][2]["params"] == {"require_alias": "true"}
+
+
+def test_records_are_not_written_without_the_index(opensearch):
+    server = opensearch(UpstreamUnavailableError("opensearch"),
+                        Response(400, {"error": {"type": "resource_already_exists_exception"}}),
+                        Response(200, {"errors": False}))
+    records = [record(1, "a")]
+
+    assert aws_service.store_message_records_to_opensearch(records) == records
+    assert [method for method, _, _ in server.requests] == ["put"]
+    assert aws_service.store_message_records_to_opensearch(records) == []
+    assert [method for method, _, _ in server.requests] == ["put", "put", "post"]
+
+
+def test_concrete_index_in_place_of_the_alias_is_reported(opensearch):
+    opensearch(Response(400, {"error": {"type": "invalid_alias_name_exception"}}))
+
+    with pytest.raises(Exception, match="delete it and reindex"):
+        aws_service.ensure_message_index()
+
+
+def test_failed_bulk_items_are_mapped_back_to_their_records(opensearch):
+    records = [record(1, "a"), record(2, "b"), record(1, "c")]
+    opensearch(Response(200, {}), Response(200, {"errors": True, "items": [
+        {"index": {"_id": "1:a", "status": 201}},
+        {"index": {"_id": "2:b", "status": 429, "error": {"type": "es_rejected_execution_exception"}}},
+        {"index": {"_id": "1:c", "status": 201}},
+    ]}))
+
+    assert aws_service.store_message_records_to_opensearch(records) == [records[1]]
+
+
+def test_bulk_body_routes_each_record_by_conversation(opensearch):
+    server = opensearch(Response(200, {}), Response(200, {"errors": False}))
+
+    aws_service.store_message_records_to_opensearch([record(7, "a")])
+
+    action, document = [json.loads(line) for line in server.requests[1][2]["data"].splitlines()]
+    assert action == {"index": {"_index": aws_service.OPENSEARCH_MESSAGE_ALIAS, "_id": "7:a", "routing": "7"}}
+    assert document == record(7, "a")
@@ -0,0 +1,79 @@
+import time
+
+import gevent
+import pytest
+
+from services.pipeline import Pipeline
+
+
+def sleep_and_return(value, seconds=0.05):
+    gevent.sleep(seconds)
+    return value
+
+
+def test_independent_stages_run_concurrently():
+    pipeline = Pipeline("test")
+    for index in range(4):
+        pipeline.add_stage("stage{}".format(index), sleep_and_return, index)
+
+    start_time = time.perf_counter()
+    results = pipeline.run()
+
+    assert time.perf_counter() - start_time < 0.15
+    assert results == {"stage0": 0, "stage1": 1, "stage2": 2, "stage3": 3}
+
+
+def test_stage_starts_after_its_dependencies():
+    order = []
+
+    def record(name, seconds):
+        gevent.sleep(seconds)
+        order.append(name)
+
+    pipeline = Pipeline("test")
+    pipeline.add_stage("slow", record, "slow", 0.05)
+    pipeline.add_stage("fast", record, "fast", 0)
+    pipeline.add_stage("after", record, "after", 0, depends_on=["slow"])
+    pipeline.run()
+
+    assert order == ["fast", "slow", "after"]
+
+
+def test_failed_stage_skips_its_dependents_only():
+    ran = []
+
+    def fail():
+        raise ValueError("first")
+
+    pipeline = Pipeline("test")
+    pipeline.add_stage("fail", fail)
+    pipeline.add_stage("other", lambda: ran.append("other"))
+    pipeline.add_stage("dependent", lambda: ran.append("dependent"), depends_on=["fail"])
+    pipeline.add_stage("transitive", lambda: ran.append("transitive"), depends_on=["dependent"])
+
+    with pytest.raises(ValueError, match="first"):
+        pipeline.run()
+    assert ran == ["other"]
+    assert pipeline.timings["dependent"] is None
+    assert pipeline.timings["transitive"] is None
+
+
+def test_chains_longer_than_the_pool_do_not_deadlock():
+    pipeline = Pipeline("test", pool_size=2)
+    pipeline.add_stage("stage0", sleep_and_return, 0, 0.01)
+    for index in range(1, 6):
+        pipeline.add_stage("stage{}".format(index), sleep_and_return, index, 0.01,
+                           depends_on=["stage{}".format(index - 1)])
+
+    with gevent.Timeout(1):
+        assert pipeline.run()["stage5"] == 5
+
+
+def test_invalid_stages_are_refused():
+    pipeline = Pipeline("test")
+    pipeline.add_stage("stage", sleep_and_return, 0)
+
+    with pytest.raises(ValueError):
+        pipeline.add_stage("stage", sleep_and_return, 1)
+    with pytest.raises(ValueError):
+        pipeline.add_stage("dependent", sleep_and_return, 1, depends_on=["unknown"])
@@ -0,0 +1,82 @@
+import threading
+from collections import Counter
+
+from services.quota import QuotaEngine
+
+
+class Store:
+    """DynamoDB counters, whose conditional increment is atomic"""
+
+    def __init__(self):
+        self.values = Counter()
+        self.lock = threading.Lock()
+
+    def read(self, key):
+        return self.values[key]
+
+    def add(self, key, amount):
+        with self.lock:
+            self.values[key] += amount
+            return self.values[key]
+
+    def add_below(self, key, amount, limit):
+        with self.lock:
+            if self.values[key] >= limit:
+                return None
+            self.values[key] += amount
+            return self.values[key]
+
+
+def create_engine(store, **kwargs):
+    return QuotaEngine("test", store.read, store.add, store.add_below, flush_interval=0.01, **kwargs)
+
+
+def test_engines_sharing_a_store_never_overrun_the_limit_without_allowance():
+    store = Store()
+    engines = [create_engine(store, allowance=0) for _ in range(4)]
+    results = []
+
+    def reserve(engine):
+        for _ in range(10):
+            results.append(engine.reserve("user", limit=15))
+
+    threads = [threading.Thread(target=reserve, args=(engine,)) for engine in engines]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert store.values["user"] == 15
+    assert sum(result is not None for result in results) == 15
+
+
+def test_leased_reservations_overrun_by_at_most_the_allowance_per_engine():
+    store = Store()
+    engines = [create_engine(store, allowance=3) for _ in range(2)]
+    admitted = sum(engine.reserve("user", limit=4) is not None for engine in engines for _ in range(10))
+    for engine in engines:
+        engine.shutdown()
+
+    assert 4 <= admitted <= 4 + 3 * len(engines)
+    assert store.values["user"] == admitted
+
+
+def test_refund_gives_back_a_reservation():
+    store = Store()
+    engine = create_engine(store, allowance=0)
+    assert engine.reserve("user", limit=1) == 1
+    assert engine.reserve("user", limit=1) is None
+    engine.refund("user")
+
+    assert engine.reserve("user", limit=1) == 1
+
+
+def test_leased_refund_is_flushed_as_a_decrement():
+    store = Store()
+    engine = create_engine(store, allowance=5)
+    engine.reserve("user", limit=10)
+    engine.flush()
+    engine.refund("user")
+    engine.shutdown()
+
+    assert store.values["user"] == 0
@@ -0,0 +1,226 @@
+import gevent
+import pytest
+from gevent.event import Event
+
+from services.resilience import CLOSED, HALF_OPEN, OPEN, CircuitBreaker, Deadline, Hedger
+from utils.exceptions import DeadlineExceededError, UpstreamUnavailableError
+
+
+class Clock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+def create_breaker(clock, **kwargs):
+    options = dict(min_calls=4, failure_rate=0.5, open_duration=10, half_open_calls=2, timer=clock)
+    options.update(kwargs)
+    return CircuitBreaker("test", min_timeout=1, max_timeout=30, **options)
+
+
+def call(breaker, error=None):
+    with breaker.guard():
+        if error is not None:
+            raise error
+
+
+def open_breaker(breaker):
+    for _ in range(breaker.min_calls):
+        with pytest.raises(ValueError):
+            call(breaker, ValueError())
+    assert breaker.state == OPEN
+
+
+def test_breaker_opens_on_failures_and_rejects_calls():
+    breaker = create_breaker(Clock())
+    call(breaker)
+    call(breaker)
+    with pytest.raises(ValueError):
+        call(breaker, ValueError())
+    assert breaker.state == CLOSED
+
+    with pytest.raises(ValueError):
+        call(breaker, ValueError())
+    assert breaker.state == OPEN
+    with pytest.raises(UpstreamUnavailableError):
+        call(breaker)
+
+
+def test_ignored_errors_do_not_open_the_breaker():
+    breaker = create_breaker(Clock())
+    for _ in range(8):
+        with pytest.raises(KeyError):
+            with breaker.guard(ignore=(KeyError,)):
+                raise KeyError()
+
+    assert breaker.state == CLOSED
+
+
+def test_half_open_breaker_lets_a_limited_number_of_concurrent_probes_through():
+    clock = Clock()
+    breaker = create_breaker(clock)
+    open_breaker(breaker)
+    clock.now += 10
+
+    started = []
+    release = Event()
+
+    def probe():
+        with breaker.guard():
+            started.append(True)
+            release.wait()
+
+    probes = [gevent.spawn(probe) for _ in range(2)]
+    gevent.sleep(0)
+    assert breaker.state == HALF_OPEN
+    with pytest.raises(UpstreamUnavailableError):
+        call(breaker)
+
+    release.set()
+    gevent.joinall(probes, raise_error=True)
+    assert len(started) == 2
+    assert breaker.state == CLOSED
+    call(breaker)
+
+
+def test_cancelled_probe_frees_its_slot():
+    clock = Clock()
+    breaker = create_breaker(clock)
+    open_breaker(breaker)
+    clock.now += 10
+
+    def probe():
+        with breaker.guard():
+            gevent.sleep(10)
+
+    probes = [gevent.spawn(probe) for _ in range(2)]
+    gevent.sleep(0)
+    probes[0].kill()
+
+    call(breaker)
+    assert breaker.state == HALF_OPEN
+    gevent.killall(probes)
+
+
+def test_failed_probe_opens_the_breaker_again():
+    clock = Clock()
+    breaker = create_breaker(clock)
+    open_breaker(breaker)
+    clock.now += 10
+
+    with pytest.raises(ValueError):
+        call(breaker, ValueError())
+
+    assert breaker.state == OPEN
+    with pytest.raises(UpstreamUnavailableError):
+        call(breaker)
+
+
+def test_timeout_adapts_to_the_latencies_and_the_deadline():
+    clock = Clock()
+    breaker = create_breaker(clock)
+    assert breaker.timeout() == 30
+
+    for _ in range(4):
+        with breaker.guard():
+            clock.now += 2
+    assert breaker.timeout() == 6
+    assert breaker.timeout(Deadline(4, timer=clock)) == 4
+    with pytest.raises(DeadlineExceededError):
+        breaker.timeout(Deadline(0, timer=clock))
+
+
+def create_hedger():
+    hedger = Hedger("test", min_samples=1, min_delay=0.01)
+    hedger.call(lambda: None)
+    return hedger
+
+
+def test_slow_call_is_hedged_and_the_loser_is_killed():
+    hedger = create_hedger()
+    attempts = []
+    finished = []
+
+    def func():
+        attempt = len(attempts)
+        attempts.append(attempt)
+        if attempt == 0:
+            gevent.sleep(1)
+        finished.append(attempt)
+        return attempt
+
+    assert hedger.call(func) == 1
+    gevent.sleep(0)
+    assert finished == [1]
+    assert hedger.stats()["hedges_issued"] == 1
+    assert hedger.stats()["hedges_won"] == 1
+
+
+def test_hedged_call_succeeds_if_one_attempt_fails():
+    hedger = create_hedger()
+    attempts = []
+
+    def func():
+        attempts.append(True)
+        if len(attempts) == 1:
+            gevent.sleep(0.05)
+            return "first"
+        raise ValueError()
+
+    assert hedger.call(func) == "first"
+    assert hedger.stats().get("hedges_won", 0) == 0
+
+
+def test_hedged_call_raises_when_every_attempt_fails():
+    hedger = create_hedger()
+
+    def func():
+        gevent.sleep(0.02)
+        raise ValueError()
+
+    with pytest.raises(ValueError):
+        hedger.call(func)
+
+
+def test_losing_hedge_does_not_count_as_a_failure_of_the_upstream():
+    breaker = create_breaker(Clock(), min_calls=1)
+    hedger = create_hedger()
+    attempts = []
+
+    def func():
+        with breaker.guard():
+            attempts.append(True)
+            if len(attempts) == 1:
+                gevent.sleep(1)
+
+    hedger.call(func)
+    gevent.sleep(0)
+
+    assert breaker.state == CLOSED
+    assert breaker.stats()["calls"] == 1
+    assert breaker.stats()["failure_rate"] == 0
+
+
+def test_closed_generator_does_not_count_as_a_failure():
+    clock = Clock()
+    breaker = create_breaker(clock, min_calls=1)
+    open_breaker(breaker)
+    clock.now += 10
+
+    def stream():
+        with breaker.guard():
+            yield b"chunk"
+            yield b"chunk"
+
+    calls = breaker.stats()["calls"]
+    chunks = stream()
+    next(chunks)
+    chunks.close()
+
+    assert breaker.state == HALF_OPEN
+    assert breaker.stats()["calls"] == calls
+    call(breaker)
+    call(breaker)
+    assert breaker.state == CLOSED
@@ -0,0 +1,62 @@
+import threading
+
+import pytest
+
+from services.room_registry import InMemoryRoomRegistry, create_room_registry
+from utils.enum.role import AppRole
+
+
+def test_only_the_last_leave_returns_the_occupancy():
+    registry = InMemoryRoomRegistry()
+    registry.join(1, "user")
+    assert registry.join(1, "parent") == 2
+
+    assert registry.leave(1) is None
+    occupancy = registry.leave(1)
+
+    assert occupancy["role"] == "user"
+    assert occupancy["start_time"]
+    assert registry.leave(1) is None
+
+
+def test_concurrent_leaves_see_the_room_empty_once():
+    registry = InMemoryRoomRegistry()
+    for _ in range(50):
+        registry.join(1, "user")
+    results = []
+
+    def leave():
+        results.append(registry.leave(1))
+
+    threads = [threading.Thread(target=leave) for _ in range(50)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert sum(result is not None for result in results) == 1
+
+
+def test_registry_is_shared_only_through_redis_urls():
+    assert isinstance(create_room_registry(None), InMemoryRoomRegistry)
+    assert isinstance(create_room_registry("amqp://localhost"), InMemoryRoomRegistry)
+
+
+def test_redis_registries_share_the_rooms(monkeypatch):
+    fakeredis = pytest.importorskip("fakeredis")
+    pytest.importorskip("lupa")
+    import redis
+
+    server = fakeredis.FakeServer()
+    monkeypatch.setattr(redis.Redis, "from_url",
+                        lambda url, **kwargs: fakeredis.FakeRedis(server=server, **kwargs))
+    first, second = create_room_registry("redis://localhost"), create_room_registry("redis://localhost")
+
+    assert first.join(1, AppRole.USER) == 1
+    assert second.join(1, AppRole.PARENT) == 2
+    assert first.leave(1) is None
+    occupancy = second.leave(1)
+
+    assert occupancy["role"] == AppRole.USER.value
+    assert occupancy["start_time"]
+    assert first.leave(1) is None
@@ -0,0 +1,72 @@
+import threading
+
+import pytest
+from botocore.exceptions import ClientError
+
+from services.s3_upload import S3Uploader
+
+
+class Client:
+    def __init__(self, fail=False, blocked=(), release=None):
+        self.fail = fail
+        self.blocked = blocked
+        self.release = release
+        self.calls = []
+
+    def put_object(self, **kwargs):
+        if kwargs["Key"] in self.blocked:
+            self.release.wait(1)
+        if self.fail:
+            raise ClientError({"Error": {"Code": "500", "Message": "Internal"}}, "PutObject")
+        self.calls.append(("put_object", kwargs["Key"], kwargs.get("ContentType")))
+
+    def upload_fileobj(self, file, bucket, key, ExtraArgs=None, Config=None):
+        self.calls.append(("multipart", key, len(file.read())))
+
+
+def test_small_payloads_are_put_and_large_ones_are_multipart():
+    client = Client()
+    uploader = S3Uploader(lambda: client, multipart_threshold=10)
+
+    uploader.upload(b"small", "bucket", "a.jpg", "image/jpeg")
+    uploader.upload(b"x" * 10, "bucket", "b.jpg")
+
+    assert client.calls == [("put_object", "a.jpg", "image/jpeg"), ("multipart", "b.jpg", 10)]
+    assert uploader.stats()["bytes"] == 15
+
+
+def test_failed_upload_raises_connection_error():
+    uploader = S3Uploader(lambda: Client(fail=True))
+
+    with pytest.raises(ConnectionError):
+        uploader.upload(b"data", "bucket", "a.jpg")
+    assert uploader.stats()["failed"] == 1
+
+
+def test_failed_background_upload_is_reported():
+    uploader = S3Uploader(lambda: Client(fail=True))
+    reported = threading.Event()
+    errors = []
+
+    def on_error(key, error):
+        errors.append((key, error))
+        reported.set()
+
+    uploader.upload(b"data", "bucket", "a.jpg", wait=False, on_error=on_error)
+
+    assert reported.wait(1)
+    assert errors[0][0] == "a.jpg"
+    assert isinstance(errors[0][1], ConnectionError)
+
+
+def test_uploads_run_inline_when_the_background_is_full():
+    release = threading.Event()
+    background = Client(blocked=("a.jpg",), release=release)
+    uploader = S3Uploader(lambda: background, max_background=1)
+
+    uploader.upload(b"first", "bucket", "a.jpg", wait=False)
+    uploader.upload(b"second", "bucket", "b.jpg", wait=False)
+
+    assert uploader.stats()["background_full"] == 1
+    assert background.calls == [("put_object", "b.jpg", None)]
+    release.set()
@@ -0,0 +1,81 @@
+import os
+
+import gevent
+import pytest
+from gevent.event import Event
+
+pytest.importorskip("elevenlabs")
+os.environ.setdefault("ELEVENLABS_API_KEY", "test")
+
+from services import elevenlabs  # noqa: E402
+from services.elevenlabs import SentenceSpeechStream  # noqa: E402
+from services.resilience import CircuitBreaker  # noqa: E402
+
+
+@pytest.fixture
+def synthesized(monkeypatch):
+    sentences = []
+
+    def synthesize_sentence(sentence, voice, deadline=None):
+        if "fail" in sentence:
+            raise TimeoutError("Speech synthesis timed out")
+        sentences.append(sentence)
+        yield sentence.encode()
+
+    monkeypatch.setattr(elevenlabs, "synthesize_sentence", synthesize_sentence)
+    return sentences
+
+
+def test_sentences_are_synthesized_in_order(synthesized):
+    payloads = []
+    speech = SentenceSpeechStream("voice", lambda chunk, count: payloads.append((count, chunk)))
+
+    for delta in ["Hello there, how", " are you today? I am", " fine, thank you."]:
+        speech.feed(delta)
+
+    assert speech.close() == 2
+    assert synthesized == ["Hello there, how are you today?", "I am fine, thank you."]
+    assert payloads == [(0, b"Hello there, how are you today?"), (1, b"I am fine, thank you.")]
+    assert speech.error is None
+
+
+def test_synthesis_error_is_kept_instead_of_raised(synthesized):
+    payloads = []
+    speech = SentenceSpeechStream("voice", lambda chunk, count: payloads.append(chunk))
+
+    speech.feed("The first sentence works. Then it will fail here. ")
+
+    assert speech.close() == 1
+    assert isinstance(speech.error, TimeoutError)
+    assert payloads == [b"The first sentence works."]
+
+
+def test_abort_while_sending_audio_does_not_count_as_an_upstream_failure(monkeypatch):
+    breaker = CircuitBreaker("elevenlabs", min_timeout=1, max_timeout=30, min_calls=1)
+    monkeypatch.setattr(elevenlabs, "elevenlabs_breaker", breaker)
+    monkeypatch.setattr(elevenlabs, "voice_stream", lambda text, voice, stream_chunk_size: iter([b"a", b"b"]))
+    sending = Event()
+
+    def on_audio(chunk, count):
+        sending.set()
+        gevent.sleep(10)
+
+    speech = SentenceSpeechStream("voice", on_audio, chunks_per_payload=1)
+    speech.feed("The answer is being generated. ")
+    sending.wait(1)
+    speech.abort()
+    gevent.sleep(0)
+
+    assert breaker.stats()["calls"] == 0
+    assert breaker.state == "closed"
+
+
+def test_idle_timeout_is_reported_as_an_error(synthesized):
+    speech = SentenceSpeechStream("voice", lambda chunk, count: None, idle_timeout=0.01)
+    gevent.sleep(0.05)
+
+    speech.feed("This sentence arrives too late. ")
+
+    assert speech.close() == 0
+    assert isinstance(speech.error, TimeoutError)
+    assert synthesized == []
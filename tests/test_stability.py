@@ -0,0 +1,42 @@
+import gevent
+import pytest
+
+from services.stability import GenerationJob
+
+
+def generate(seconds, image=b"png"):
+    gevent.sleep(seconds)
+    return image
+
+
+def test_progress_is_reported_until_the_image_is_generated():
+    progress = []
+
+    image = GenerationJob(generate, 0.05).wait(progress.append, interval=0.01)
+
+    assert image == b"png"
+    assert progress[0]["status"] == "generating"
+    assert len(progress) >= 3
+    assert len({event["job"] for event in progress}) == 1
+
+
+def test_generation_error_is_raised_by_wait():
+    def fail():
+        raise ValueError("rejected prompt")
+
+    job = GenerationJob(fail)
+
+    with pytest.raises(ValueError, match="rejected prompt"):
+        job.wait()
+    assert job.status == "failed"
+
+
+def test_interrupted_wait_cancels_the_job():
+    job = GenerationJob(generate, 10)
+
+    with pytest.raises(gevent.Timeout):
+        with gevent.Timeout(0.01):
+            job.wait()
+    gevent.sleep(0)
+
+    assert job.status == "failed"
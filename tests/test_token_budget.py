@@ -0,0 +1,62 @@
+import pytest
+
+pytest.importorskip("tiktoken")
+
+from utils import token_budget  # noqa: E402
+from utils.token_budget import TokenCounter, longest_fitting_suffix  # noqa: E402
+
+
+class WordEncoding:
+    def __init__(self):
+        self.encoded = []
+
+    def encode(self, text):
+        self.encoded.append(text)
+        return text.split()
+
+
+@pytest.fixture
+def encoding(monkeypatch):
+    encoding = WordEncoding()
+    monkeypatch.setattr(token_budget, "get_encoding", lambda model: encoding)
+    return encoding
+
+
+def test_longest_fitting_suffix_stops_at_the_first_overflow():
+    assert longest_fitting_suffix([5, 1, 1, 3], budget=5, count=lambda item: item) == 1
+    assert longest_fitting_suffix([5, 1, 1, 3], budget=10, count=lambda item: item) == 0
+    assert longest_fitting_suffix([5, 1, 1, 3], budget=2, count=lambda item: item) == 4
+    assert longest_fitting_suffix([], budget=2, count=lambda item: item) == 0
+
+
+def test_only_the_suffix_is_counted():
+    counted = []
+
+    def count(item):
+        counted.append(item)
+        return item
+
+    longest_fitting_suffix([1, 1, 9, 1, 1], budget=3, count=count)
+
+    assert counted == [1, 1, 9]
+
+
+def test_message_counts_are_memoized(encoding):
+    counter = TokenCounter("model", maxsize=2)
+    message = {"role": "user", "content": "why is the sky blue"}
+
+    assert counter.count_message(message) == 4 + 1 + 5
+    assert counter.count_message(dict(message)) == 10
+    assert encoding.encoded == ["user", "why is the sky blue"]
+    assert counter.count_messages([message, {"role": "assistant", "name": "bot", "content": "hi"}]) == 10 + 6 + 2
+
+
+def test_memoized_counts_are_bounded(encoding):
+    counter = TokenCounter("model", maxsize=2)
+    for content in ["a", "b", "c"]:
+        counter.count_message({"role": "user", "content": content})
+    encoding.encoded.clear()
+
+    counter.count_message({"role": "user", "content": "a"})
+
+    assert encoding.encoded == ["user", "a"]
@@ -0,0 +1,57 @@
+from utils.cache import TTLCache
+
+
+class Clock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+def test_entries_expire_but_stay_revalidable():
+    clock = Clock()
+    cache = TTLCache(maxsize=4, ttl=10, timer=clock)
+    cache.set("key", "value")
+    clock.now = 10
+
+    assert cache.get("key") is None
+    assert "key" not in cache
+    assert cache.get_entry("key").value == "value"
+    assert cache.touch("key")
+    assert cache.get("key") == "value"
+
+
+def test_least_recently_used_entry_is_evicted():
+    cache = TTLCache(maxsize=2, ttl=10, timer=Clock())
+    cache.set("a", 1)
+    cache.set("b", 2)
+    cache.get("a")
+
+    cache.set("c", 3)
+
+    assert cache.get("b") is None
+    assert cache.get("a") == 1
+    assert cache.stats()["evictions"] == 1
+
+
+def test_entries_are_invalidated_by_predicate():
+    cache = TTLCache(maxsize=4, ttl=10, timer=Clock())
+    for key in [("prompt", 1), ("prompt", 2), ("other", 1)]:
+        cache.set(key, True)
+
+    assert cache.invalidate(lambda key: key[0] == "prompt") == 2
+    assert len(cache) == 1
+    assert cache.invalidate() == 1
+
+
+def test_entry_ttl_overrides_the_default():
+    clock = Clock()
+    cache = TTLCache(maxsize=4, ttl=10, timer=clock)
+    cache.set("short", 1, ttl=1)
+    cache.set("long", 2)
+    clock.now = 5
+
+    assert cache.get("short") is None
+    assert cache.get("long") == 2
+    assert cache.stats()["hit_rate"] == 0.5
@@ -0,0 +1,132 @@
+import json
+import os
+import threading
+
+from services.write_behind import WriteBehindQueue
+
+
+def key(record):
+    return record["id"]
+
+
+def create_queue(write_batch, tmp_path, **kwargs):
+    return WriteBehindQueue("test", write_batch, key, flush_interval=0.01,
+                            spill_path=str(tmp_path / "spill.jsonl"), **kwargs)
+
+
+def test_spill_path_is_per_process(tmp_path):
+    queue = create_queue(lambda batch: [], tmp_path)
+    assert queue.spill_path == str(tmp_path / "spill.{}.jsonl".format(os.getpid()))
+
+
+def test_recover_takes_over_the_files_of_dead_processes(tmp_path):
+    written = []
+    queue = create_queue(lambda batch: written.extend(batch) or [], tmp_path)
+    # A pid above the kernel maximum is never running
+    (tmp_path / "spill.4999999.jsonl").write_text(json.dumps({"id": 1}) + "\n")
+    (tmp_path / "spill.jsonl").write_text(json.dumps({"id": 2}) + "\n")
+    # The file of a running process is left to it
+    (tmp_path / "spill.1.jsonl").write_text(json.dumps({"id": 3}) + "\n")
+
+    assert queue.recover() == 2
+    queue.shutdown()
+
+    assert sorted(record["id"] for record in written) == [1, 2]
+    assert sorted(os.listdir(tmp_path)) == ["spill.1.jsonl"]
+
+
+def test_recover_skips_a_file_taken_by_another_worker(tmp_path, monkeypatch):
+    queue = create_queue(lambda batch: [], tmp_path)
+    (tmp_path / "spill.4999999.jsonl").write_text(json.dumps({"id": 1}) + "\n")
+    replace = os.replace
+
+    def replace_after_another_worker(source, destination):
+        # Another worker renames the file between the listing and the replace
+        replace(source, str(tmp_path / "taken"))
+        return replace(source, destination)
+
+    monkeypatch.setattr(os, "replace", replace_after_another_worker)
+
+    assert queue.recover() == 0
+
+
+def test_records_failing_every_attempt_are_spilled(tmp_path):
+    queue = create_queue(lambda batch: batch, tmp_path, max_attempts=2)
+    queue.put({"id": 1})
+    queue.shutdown()
+
+    with open(queue.spill_path) as file:
+        assert [json.loads(line) for line in file] == [{"id": 1}]
+
+
+def test_discarded_pending_record_is_not_written(tmp_path):
+    written = []
+    release = threading.Event()
+
+    def write_batch(batch):
+        release.wait(1)
+        written.extend(batch)
+        return []
+
+    queue = create_queue(write_batch, tmp_path, batch_size=1)
+    queue.put({"id": 1})
+    queue.put({"id": 2})
+    assert queue.discard(2)
+    release.set()
+    queue.shutdown()
+
+    assert [record["id"] for record in written] == [1]
+
+
+def test_record_deleted_while_its_batch_is_written_is_deleted_again(tmp_path):
+    table = {}
+    writing = threading.Event()
+    release = threading.Event()
+    deleted = []
+
+    def write_batch(batch):
+        writing.set()
+        release.wait(1)
+        for record in batch:
+            table[record["id"]] = record
+        return []
+
+    def delete(record_key):
+        deleted.append(record_key)
+        table.pop(record_key, None)
+
+    queue = create_queue(write_batch, tmp_path, delete=delete)
+    queue.put({"id": 1})
+    assert writing.wait(1)
+    # The caller deletes the record while the batch holding it is in flight
+    assert queue.discard(1)
+    table.pop(1, None)
+    release.set()
+    queue.shutdown()
+
+    assert deleted == [1]
+    assert table == {}
+
+
+def test_record_deleted_while_its_batch_fails_is_not_spilled(tmp_path):
+    writing = threading.Event()
+    release = threading.Event()
+
+    def write_batch(batch):
+        writing.set()
+        release.wait(1)
+        return batch
+
+    queue = create_queue(write_batch, tmp_path, max_attempts=1, delete=lambda record_key: None)
+    queue.put({"id": 1})
+    assert writing.wait(1)
+    assert queue.discard(1)
+    release.set()
+    queue.shutdown()
+
+    assert not os.path.exists(queue.spill_path)
+
+
+def test_discard_of_an_unknown_key_is_not_found(tmp_path):
+    queue = create_queue(lambda batch: [], tmp_path)
+    assert not queue.discard(1)
@@ -0,0 +1,329 @@
+"""In-process caches shared by the services"""
+import hashlib
+import json
+import logging
+import os
+import shutil
+import tempfile
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Callable, Dict, Hashable, Iterable, Optional, Tuple
+
+
+class CacheEntry:
+
+    def __init__(self, value: Any, expires_at: float):
+        self.value = value
+        self.expires_at = expires_at
+
+    def is_expired(self, now: float) -> bool:
+        return now >= self.expires_at
+
+
+class TTLCache:
+    """
+    Thread-safe in-memory cache bounded in size, whose entries expire after a time-to-live.
+
+    When the cache is full, the least recently used entry is evicted. Expired entries are not returned by `get`
+    but are kept until evicted, so that callers can revalidate them with `get_entry` (e.g. conditional requests
+    with an ETag) instead of reloading them.
+    """
+
+    def __init__(self, maxsize: int = 128, ttl: float = 300, timer: Callable[[], float] = time.monotonic):
+        """
+        Args:
+            maxsize (int): Maximum number of entries
+            ttl (float): Default time-to-live of an entry, in seconds
+            timer (Callable): Clock used for expiration, monotonic by default
+        """
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.timer = timer
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._entries: "OrderedDict[Hashable, CacheEntry]" = OrderedDict()
+        self._lock = threading.RLock()
+
+    def get(self, key: Hashable, default: Any = None) -> Any:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or entry.is_expired(self.timer()):
+                self.misses += 1
+                return default
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry.value
+
+    def get_entry(self, key: Hashable) -> Optional[CacheEntry]:
+        """Return the entry of a key even if it is expired, without counting a hit or a miss"""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                self._entries.move_to_end(key)
+            return entry
+
+    def set(self, key: Hashable, value: Any, ttl: Optional[float] = None):
+        with self._lock:
+            self._entries[key] = CacheEntry(value, self.timer() + (self.ttl if ttl is None else ttl))
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def touch(self, key: Hashable, ttl: Optional[float] = None) -> bool:
+        """Renew the time-to-live of an entry, e.g. after it has been revalidated"""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return False
+            entry.expires_at = self.timer() + (self.ttl if ttl is None else ttl)
+            self._entries.move_to_end(key)
+            return True
+
+    def pop(self, key: Hashable, default: Any = None) -> Any:
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            return default if entry is None else entry.value
+
+    def invalidate(self, predicate: Optional[Callable[[Hashable], bool]] = None) -> int:
+        """
+        Remove entries from the cache.
+
+        Args:
+            predicate (Callable, optional): Only keys for which the predicate is true are removed. All entries are
+                removed if None.
+
+        Returns:
+            Number of removed entries.
+        """
+        with self._lock:
+            if predicate is None:
+                count = len(self._entries)
+                self._entries.clear()
+                return count
+            keys = [key for key in self._entries if predicate(key)]
+            for key in keys:
+                del self._entries[key]
+            return len(keys)
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "size": len(self._entries),
+                "maxsize": self.maxsize,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "hit_rate": self.hits / lookups if lookups else 0.0,
+            }
+
+    def __contains__(self, key: Hashable) -> bool:
+        with self._lock:
+            entry = self._entries.get(key)
+            return entry is not None and not entry.is_expired(self.timer())
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+
+class DiskEntry:
+
+    def __init__(self, path: str, size: int, metadata: Dict[str, Any]):
+        self.path = path
+        self.size = size
+        self.metadata = metadata
+
+
+class DiskLRUCache:
+    """
+    Thread-safe cache of files bounded in total size, whose least recently used files are evicted first.
+
+    Values are written to disk chunk by chunk, so that caching and serving a file takes a constant amount of memory
+    whatever its size. The index is kept in memory, in a directory of the process that is emptied when the cache is
+    created. A file that is being read when it is evicted stays readable until it is closed.
+    """
+
+    def __init__(self, directory: str, max_bytes: int = 512 * 1024 * 1024):
+        """
+        Args:
+            directory (str): Parent directory of the cache files
+            max_bytes (int): Maximum total size of the files. The last file written is kept even if it is larger.
+        """
+        self.directory = os.path.join(directory, str(os.getpid()))
+        self.max_bytes = max_bytes
+        self.total_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._entries: "OrderedDict[Hashable, DiskEntry]" = OrderedDict()
+        self._loading: Dict[Hashable, threading.Lock] = {}
+        self._lock = threading.Lock()
+        shutil.rmtree(self.directory, ignore_errors=True)
+        os.makedirs(self.directory, exist_ok=True)
+
+    def get(self, key: Hashable) -> Optional[DiskEntry]:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            self._entries.move_to_end(key)
+            return entry
+
+    def get_or_load(self, key: Hashable,
+                    load: Callable[[], Tuple[Iterable[bytes], Dict[str, Any]]]) -> DiskEntry:
+        """
+        Return the entry of a key, writing it to disk on a miss. Concurrent misses of a key load it once.
+
+        Args:
+            key (Hashable): Key of the file
+            load (Callable): Returns the chunks of the file and its metadata
+        """
+        entry = self.get(key)
+        if entry is not None:
+            with self._lock:
+                self.hits += 1
+            return entry
+        with self._lock:
+            loading = self._loading.setdefault(key, threading.Lock())
+        with loading:
+            entry = self.get(key)
+            if entry is not None:
+                with self._lock:
+                    self.hits += 1
+                return entry
+            try:
+                entry = self._write(key, *load())
+            finally:
+                with self._lock:
+                    self._loading.pop(key, None)
+        return entry
+
+    def clear(self):
+        with self._lock:
+            entries = list(self._entries.values())
+            self._entries.clear()
+            self.total_bytes = 0
+        for entry in entries:
+            self._remove(entry.path)
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "size": len(self._entries),
+                "bytes": self.total_bytes,
+                "max_bytes": self.max_bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "hit_rate": self.hits / lookups if lookups else 0.0,
+            }
+
+    def _write(self, key: Hashable, chunks: Iterable[bytes], metadata: Dict[str, Any]) -> DiskEntry:
+        path = os.path.join(self.directory, hashlib.sha256(repr(key).encode()).hexdigest())
+        size = 0
+        with tempfile.NamedTemporaryFile(dir=self.directory, delete=False) as file:
+            try:
+                for chunk in chunks:
+                    file.write(chunk)
+                    size += len(chunk)
+            except BaseException:
+                file.close()
+                self._remove(file.name)
+                raise
+        os.replace(file.name, path)
+
+        entry = DiskEntry(path, size, metadata)
+        evicted = []
+        with self._lock:
+            self.misses += 1
+            previous = self._entries.pop(key, None)
+            if previous is not None:
+                self.total_bytes -= previous.size
+            self._entries[key] = entry
+            self.total_bytes += size
+            while self.total_bytes > self.max_bytes and len(self._entries) > 1:
+                _, oldest = self._entries.popitem(last=False)
+                self.total_bytes -= oldest.size
+                self.evictions += 1
+                evicted.append(oldest)
+        for oldest in evicted:
+            self._remove(oldest.path)
+        return entry
+
+    @staticmethod
+    def _remove(path: str):
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+
+
+class InvalidationChannel:
+    """
+    Redis Pub/Sub channel relaying the invalidations of a process-local cache to the other workers and nodes.
+
+    `publish` sends a JSON message that every subscribed process, the sender included, passes to `on_message`
+    from a background thread. A message sent while a process is reconnecting is lost, its entries are then only
+    dropped when they expire.
+    """
+
+    def __init__(self, url: str, channel: str, on_message: Callable[[Dict[str, Any]], None],
+                 reconnect_delay: float = 1):
+        """
+        Args:
+            url (str): Redis URL
+            channel (str): Name of the channel
+            on_message (Callable): Called with each message received on the channel
+            reconnect_delay (float): Seconds to wait before subscribing again after an error
+        """
+        # Optional dependency, only required when the channel is configured
+        import redis
+
+        self.redis = redis.Redis.from_url(url)
+        self.channel = channel
+        self.on_message = on_message
+        self.reconnect_delay = reconnect_delay
+        self._subscribed = threading.Event()
+        self._thread = threading.Thread(target=self._listen, name="invalidation-" + channel, daemon=True)
+        self._thread.start()
+
+    def publish(self, message: Dict[str, Any]):
+        try:
+            self.redis.publish(self.channel, json.dumps(message))
+        except Exception:
+            logging.exception("Fail to publish an invalidation on {}".format(self.channel))
+
+    def wait_subscribed(self, timeout: Optional[float] = None) -> bool:
+        return self._subscribed.wait(timeout)
+
+    def _listen(self):
+        while True:
+            try:
+                pubsub = self.redis.pubsub(ignore_subscribe_messages=True)
+                pubsub.subscribe(self.channel)
+                self._subscribed.set()
+                for message in pubsub.listen():
+                    if message["type"] == "message":
+                        self._handle(message["data"])
+            except Exception:
+                self._subscribed.clear()
+                logging.exception("Subscription to {} lost, subscribing again".format(self.channel))
+                time.sleep(self.reconnect_delay)
+
+    def _handle(self, data: bytes):
+        try:
+            self.on_message(json.loads(data))
+        except Exception:
+            logging.exception("Fail to apply an invalidation received on {}".format(self.channel))
+
+
+def create_invalidation_channel(url: Optional[str], channel: str,
+                                on_message: Callable[[Dict[str, Any]], None]) -> Optional[InvalidationChannel]:
+    """Create a channel if `url` is a Redis URL, None otherwise (the cache is then only invalidated locally)"""
+    if url and url.startswith(("redis://", "rediss://", "unix://")):
+        return InvalidationChannel(url, channel, on_message)
+    return None
@@ -1,10 +1,25 @@
-from typing import Union
+import os
+from typing import Optional, Union
+
+from sqlalchemy import and_
+from sqlalchemy.orm import Session, joinedload, selectinload
+
 from db.extension import db
-from db.models import User, PersonAIs, Parent, PackageGroup, Package
+from db.models import User, PersonAIs, Parent, PackageGroup, Package, Subscription, UserPersonAI, HistoryMessage
+from utils.cache import TTLCache, create_invalidation_channel
 from utils.enum.role import AppRole
-from utils.exceptions import ItemNotFoundError
+from utils.exceptions import ItemNotFoundError, ConversationNotFoundError
 from utils.time import calculate_age
 
+CHAT_CONFIG_CACHE_TTL = int(os.getenv("CHAT_CONFIG_CACHE_TTL", 30))
+CHAT_CONFIG_CACHE_SIZE = int(os.getenv("CHAT_CONFIG_CACHE_SIZE", 1024))
+
+# Redis URL relaying the invalidations of the snapshots to the other workers and nodes
+CHAT_CONFIG_INVALIDATION_URL = os.getenv("CHAT_CONFIG_INVALIDATION_URL", os.getenv("SOCKETIO_MESSAGE_QUEUE"))
+
+# Snapshots of the chatter, agent, package and conversation, keyed by (role, chatter id, person AI id)
+chat_config_cache = TTLCache(maxsize=CHAT_CONFIG_CACHE_SIZE, ttl=CHAT_CONFIG_CACHE_TTL)
+
 
 class ChatConfig:
 
@@ -22,29 +37,134 @@ class ChatConfig:
         self.uuid_request = uuid_request
         self.request_type = None
         self.request_count = None
+        self.quota_key = None
+        self.deadline = None
+
+    def set_deadline(self, deadline):
+        """Deadline of the message, bounding the timeouts of the calls made to answer it"""
+        self.deadline = deadline
 
     def set_request_type_and_count(self, request_type, request_count):
         self.request_type = request_type
         self.request_count = request_count
 
+    def set_quota_reservation(self, quota_key, request_count):
+        """Keep the counter charged for this request and its new count"""
+        self.quota_key = quota_key
+        self.request_count = request_count
+
+    def pop_quota_reservation(self):
+        """Key of the counter charged for this request, None if it is not charged (anymore)"""
+        quota_key, self.quota_key = self.quota_key, None
+        return quota_key
+
+
+class ChatSnapshot:
+    """Detached ORM objects required by a chat message, shared by the messages of a conversation"""
+
+    def __init__(self, chatter: Union[User, Parent], person_ai: PersonAIs, package_group: Optional[PackageGroup],
+                 package: Package, message_id: int):
+        self.chatter = chatter
+        self.person_ai = person_ai
+        self.package_group = package_group
+        self.package = package
+        self.message_id = message_id
+
+
+def get_chat_config(id, person_ai_id, role, uuid_request) -> ChatConfig:
+    """
+    Build the config of a chat message from the snapshot of the conversation, which is loaded at most once per
+    `CHAT_CONFIG_CACHE_TTL` seconds. The snapshot is detached from the session, attributes that were not eagerly
+    loaded cannot be accessed on it.
+
+    Raises:
+        ItemNotFoundError: The chatter or its package does not exist
+        ConversationNotFoundError: The chatter has no conversation with the person AI
+    """
+    # Ids sent by the socket may be strings, the key must match the ids given to `invalidate_chat_config`
+    id, person_ai_id = int(id), int(person_ai_id)
+    cache_key = (role, id, person_ai_id)
+    snapshot = chat_config_cache.get(cache_key)
+    if snapshot is None:
+        snapshot = load_chat_snapshot(id, person_ai_id, role)
+        chat_config_cache.set(cache_key, snapshot)
+
+    return ChatConfig(snapshot.chatter, snapshot.person_ai, snapshot.package_group, snapshot.package, role,
+                      snapshot.message_id, uuid_request)
+
+
+def load_chat_snapshot(id, person_ai_id, role) -> ChatSnapshot:
+    """
+    Load the chatter with its package group, subscription and package in one eager query, then the person AI
+    with the id of the conversation in a second one. The objects are loaded in their own session, so that the
+    commits of the request do not expire them.
+    """
+    chatter_model = User if role == AppRole.USER else Parent
+    owner_column = UserPersonAI.user_id if role == AppRole.USER else UserPersonAI.parent_id
+
+    with Session(db.engine) as session:
+        chatter = session.query(chatter_model) \
+            .options(
+                joinedload(chatter_model.package_group)
+                .joinedload(PackageGroup.subscription)
+                .joinedload(Subscription.package),
+                joinedload(chatter_model.package_group).selectinload(PackageGroup.users),
+                joinedload(chatter_model.package_group).selectinload(PackageGroup.parents)
+            ) \
+            .filter(chatter_model.id == id) \
+            .first()
+        if not chatter:
+            raise ItemNotFoundError("User or Parent not found")
+
+        package_group = chatter.package_group
+        if chatter.package_group_id:
+            package = package_group.subscription.package
+        else:
+            # Get free package
+            package = session.query(Package).filter(Package.monthly_pay_price == 0).first()
+        if not package:
+            raise ItemNotFoundError("Package not found")
+
+        conversation = session.query(PersonAIs, UserPersonAI.id, HistoryMessage.id) \
+            .outerjoin(UserPersonAI, and_(UserPersonAI.person_ai_id == PersonAIs.id, owner_column == id)) \
+            .outerjoin(HistoryMessage, HistoryMessage.user_person_ai_id == UserPersonAI.id) \
+            .filter(PersonAIs.id == person_ai_id) \
+            .first()
+        if not conversation or conversation[1] is None:
+            raise ConversationNotFoundError("Error while entering the chat (user-agent pair not found)")
+        person_ai, _, message_id = conversation
+        if message_id is None:
+            raise ConversationNotFoundError("Error while entering the chat (history message not found)")
+
+    return ChatSnapshot(chatter, person_ai, package_group, package, message_id)
+
+
+def invalidate_chat_config(role: Optional[str] = None, id: Optional[int] = None) -> int:
+    """
+    Drop the cached snapshots of a chatter, or every snapshot if no chatter is given (e.g. after a package group
+    has changed, which is shared by several chatters).
+
+    The invalidation is broadcast to the other processes when `CHAT_CONFIG_INVALIDATION_URL` is a Redis URL.
+    Otherwise, or if a process misses the broadcast, its snapshots stay stale for up to `CHAT_CONFIG_CACHE_TTL`
+    seconds.
+
+    Returns:
+        Number of snapshots removed from this process.
+    """
+    id = None if id is None else int(id)
+    if invalidation_channel is not None:
+        invalidation_channel.publish({"role": role, "id": id})
+    return drop_chat_config(role, id)
 
-def generate_config_object(id, message_id, person_ai_id, role, uuid_request):
-    if role == AppRole.USER:
-        chatter = db.session.get(User, id)
-    else:
-        chatter = db.session.get(Parent, id)
 
-    if not chatter:
-        raise ItemNotFoundError("User or Parent not found")
-    package_group = chatter.package_group
+def drop_chat_config(role: Optional[str] = None, id: Optional[int] = None) -> int:
+    """Drop cached snapshots of this process only, see `invalidate_chat_config`"""
+    if role is None or id is None:
+        return chat_config_cache.invalidate()
+    return chat_config_cache.invalidate(lambda key: key[0] == role and key[1] == id)
 
-    if role == AppRole.USER:
-        package = User.get_active_package(id)
-    else:
-        package = Parent.get_active_package(id)
-    if not package:
-        raise ItemNotFoundError("Package not found")
 
-    person_ai = db.session.get(PersonAIs, person_ai_id)
-    configs = ChatConfig(chatter, person_ai, package_group, package, role, message_id, uuid_request)
-    return configs
+invalidation_channel = create_invalidation_channel(
+    CHAT_CONFIG_INVALIDATION_URL, "chat-config-invalidation",
+    lambda message: drop_chat_config(message["role"], message["id"])
+)
@@ -143,6 +143,15 @@ class OutOfQuotaError(Exception):
     pass
 
 
+class ServiceOverloadedError(Exception):
+    """A request is rejected because its action is over capacity"""
+
+    def __init__(self, lane: str, reason: str):
+        super().__init__("Lane {} is over capacity ({})".format(lane, reason))
+        self.lane = lane
+        self.reason = reason
+
+
 class StripePaymentException(Exception):
     pass
 
@@ -151,6 +160,22 @@ class StabilityAIRequestError(Exception):
     pass
 
 
+class UpstreamUnavailableError(Exception):
+    """A call to a third-party service fails fast, because its circuit breaker is open"""
+
+    def __init__(self, upstream: str, reason: str = "circuit breaker is open"):
+        super().__init__("{} is unavailable ({})".format(upstream, reason))
+        self.upstream = upstream
+        self.reason = reason
+
+
+class DeadlineExceededError(UpstreamUnavailableError):
+    """A call to a third-party service is not made, because the deadline of the request has passed"""
+
+    def __init__(self, upstream: str):
+        super().__init__(upstream, "deadline exceeded")
+
+
 class LanguageIncompatibleError(Exception):
     pass
 
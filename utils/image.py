@@ -1,41 +1,112 @@
 """Utils corresponding to processing images"""
 import base64
 import io
+import logging
+import multiprocessing
+import os
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from typing import Dict, Optional, Tuple
 
 from PIL import Image
 
 from utils.exceptions import InvalidImageInput
 
 
-def choose_best_fit_size(input_size):
-    # Calculate the maximum possible size based on the input size
-    max_size = max(input_size)
-    max_possible_size = min(((max_size - 1) // 64 + 1) * 64, 1024)
-
-    # Generate a list of valid sizes that are multiples of 64
+# Number of worker processes resizing the uploaded images, 0 resizes them in the calling greenlet
+IMAGE_WORKERS = int(os.getenv("IMAGE_WORKERS", 2))
+# Downscaling by more than this factor first reduces the image by an integer factor, which is much faster
+REDUCING_GAP = 3.0
+
+
+class ImageEncoding:
+    """Format in which an image is stored, with its encoder settings"""
+
+    CONTENT_TYPES = {"JPEG": "image/jpeg", "WEBP": "image/webp", "PNG": "image/png"}
+    EXTENSIONS = {"JPEG": "jpg", "WEBP": "webp", "PNG": "png"}
+
+    def __init__(self, format: str, quality: int = 85, progressive: bool = False):
+        """
+        Args:
+            format (str): One of `JPEG`, `WEBP` and `PNG`
+            quality (int): Quality of the lossy formats, from 1 to 100
+            progressive (bool): Whether a JPEG is progressive, i.e. shows a coarse image before it is fully loaded
+        """
+        self.format = format.upper()
+        if self.format not in self.CONTENT_TYPES:
+            raise ValueError("Unsupported image format, {} found".format(format))
+        self.quality = quality
+        self.progressive = progressive
+
+    @property
+    def content_type(self) -> str:
+        return self.CONTENT_TYPES[self.format]
+
+    @property
+    def extension(self) -> str:
+        return self.EXTENSIONS[self.format]
+
+    def save_options(self) -> Dict:
+        if self.format == "JPEG":
+            return {"quality": self.quality, "progressive": self.progressive, "optimize": True}
+        if self.format == "WEBP":
+            return {"quality": self.quality, "method": 4}
+        return {"optimize": False}
+
+    @classmethod
+    def from_env(cls, destination: str, format: str, quality: int, progressive: bool) -> "ImageEncoding":
+        """Encoding of a destination, overridden by `<DESTINATION>_IMAGE_FORMAT`, `_QUALITY` and `_PROGRESSIVE`"""
+        prefix = destination.upper() + "_IMAGE_"
+        return cls(
+            os.getenv(prefix + "FORMAT", format),
+            int(os.getenv(prefix + "QUALITY", quality)),
+            os.getenv(prefix + "PROGRESSIVE", str(progressive)).lower() == "true",
+        )
+
+
+# Encoding of the stored images, by destination of `aws_service.register_image`
+IMAGE_ENCODINGS = {
+    "chat_history": ImageEncoding.from_env("chat_history", "JPEG", 85, True),
+    # Opaque avatars only, transparent ones are kept as PNG, see `TRANSPARENT_DESTINATIONS`
+    "user_avatar": ImageEncoding.from_env("user_avatar", "JPEG", 85, True),
+    "parent_avatar": ImageEncoding.from_env("parent_avatar", "JPEG", 85, True),
+    # Reports are mostly screenshots, whose text needs a higher quality
+    "app_report": ImageEncoding.from_env("app_report", "JPEG", 92, False),
+}
+# Destinations whose images keep their transparency, shown over the background of the app
+TRANSPARENT_DESTINATIONS = {"user_avatar", "parent_avatar"}
+
+
+def _build_size_table(max_possible_size: int) -> Tuple[Tuple[float, Tuple[int, int]], ...]:
+    # Valid sizes are multiples of 64, listed from the last to the first so that ties keep the last size
     valid_sizes = []
     for width in range(128, max_possible_size + 1, 64):
         for height in range(128, max_possible_size + 1, 64):
             if (896 >= height >= 512 >= width) or (896 >= width >= 512 >= height):
                 valid_sizes.append((width, height))
+    return tuple((size[0] / size[1], size) for size in valid_sizes[::-1])
 
-    # If there are no valid sizes, raise an error
-    if not valid_sizes:
-        raise InvalidImageInput("Size of image is too small")
 
-    # Among valid sizes, find the size with the best ratio match
-    input_ratio = input_size[0] / input_size[1]
-    best_fit_size = None
-    best_fit_ratio_diff = float("inf")
+# Valid sizes and their ratios, by maximum possible size
+SIZE_TABLES: Dict[int, Tuple[Tuple[float, Tuple[int, int]], ...]] = {
+    max_possible_size: _build_size_table(max_possible_size) for max_possible_size in range(64, 1025, 64)
+}
 
-    for size in valid_sizes[::-1]:
-        size_ratio = size[0] / size[1]
-        ratio_diff = abs(input_ratio - size_ratio)
 
-        if ratio_diff < best_fit_ratio_diff:
-            best_fit_size = size
-            best_fit_ratio_diff = ratio_diff
+def choose_best_fit_size(input_size):
+    # Calculate the maximum possible size based on the input size
+    max_size = max(input_size)
+    max_possible_size = min(((max_size - 1) // 64 + 1) * 64, 1024)
 
+    # If there are no valid sizes, raise an error
+    size_table = SIZE_TABLES.get(max_possible_size)
+    if not size_table:
+        raise InvalidImageInput("Size of image is too small")
+
+    # Among valid sizes, find the size with the best ratio match, the first one on ties
+    input_ratio = input_size[0] / input_size[1]
+    _, best_fit_size = min(size_table, key=lambda entry: abs(input_ratio - entry[0]))
     return best_fit_size
 
 
@@ -48,30 +119,120 @@ def crop_and_resize_image(image):
     if input_ratio > target_ratio:
         new_width = int(height * target_ratio)
         left = (width - new_width) // 2
-        right = left + new_width
-        image = image.crop((left, 0, right, height))
+        box = (left, 0, left + new_width, height)
     else:
         new_height = int(width / target_ratio)
         top = (height - new_height) // 2
-        bottom = top + new_height
-        image = image.crop((0, top, width, bottom))
+        box = (0, top, width, top + new_height)
 
-    resized_image = image.resize(target_size)
+    # A JPEG can be decoded at 1/2, 1/4 or 1/8 of its size, as long as the cropped area stays larger than the target
+    scale = min((box[2] - box[0]) / target_size[0], (box[3] - box[1]) / target_size[1])
+    if image.format == "JPEG" and scale >= 2:
+        image.draft(image.mode, (int(width / scale) + 1, int(height / scale) + 1))
+        x_scale, y_scale = image.size[0] / width, image.size[1] / height
+        box = (box[0] * x_scale, box[1] * y_scale, box[2] * x_scale, box[3] * y_scale)
+
+    resized_image = image.resize(target_size, box=box, reducing_gap=REDUCING_GAP)
     return resized_image
 
 
-def image_to_bytes(image):
+def image_to_bytes(image, encoding: Optional[ImageEncoding] = None):
+    """Encode an image, as PNG if `encoding` is not set"""
+    encoding = encoding or ImageEncoding("PNG")
+    if encoding.format == "JPEG" and image.mode not in ("RGB", "L"):
+        # JPEG has no transparency, transparent areas become white
+        image = image.convert("RGBA")
+        background = Image.new("RGB", image.size, (255, 255, 255))
+        background.paste(image, mask=image.getchannel("A"))
+        image = background
     byte_stream = io.BytesIO()
-    image.save(byte_stream, format='PNG')
-    byte_stream.seek(0)
-    image_bytes = byte_stream.read()
-    return image_bytes
-
-
-def resize_image(image_str: str):
+    image.save(byte_stream, format=encoding.format, **encoding.save_options())
+    return byte_stream.getvalue()
+
+
+def has_transparency(image) -> bool:
+    """Whether an image has transparent pixels"""
+    if "transparency" in image.info:
+        return True
+    if image.mode in ("RGBA", "LA", "PA"):
+        return image.getchannel("A").getextrema()[0] < 255
+    return False
+
+
+def encode_image(image_data: bytes, des: str) -> Tuple[bytes, ImageEncoding]:
+    """
+    Encode an image in the format of its destination. An image already in that format is kept as is, so that a
+    JPEG is not compressed twice. A transparent image of a destination of `TRANSPARENT_DESTINATIONS` is kept as a
+    PNG instead of being flattened.
+
+    Returns:
+        Tuple: the encoded image and its encoding
+
+    Raises:
+        PIL.UnidentifiedImageError: The image cannot be read
+    """
+    encoding = IMAGE_ENCODINGS[des]
+    image = Image.open(io.BytesIO(image_data))
+    if encoding.format == "JPEG" and des in TRANSPARENT_DESTINATIONS and has_transparency(image):
+        encoding = ImageEncoding("PNG")
+    if image.format == encoding.format:
+        return image_data, encoding
+    return image_to_bytes(image, encoding), encoding
+
+
+def resize_image(image_str: str, des: str = "chat_history"):
+    """Resize an uploaded base64 image to a size accepted by Stability AI, encoded for its destination"""
     image_bytes = base64.b64decode(image_str)
     image_stream = io.BytesIO(image_bytes)
     image = Image.open(image_stream)
     image_resized = crop_and_resize_image(image)
-    image_resized_bytes = image_to_bytes(image_resized)
+    image_resized_bytes = image_to_bytes(image_resized, IMAGE_ENCODINGS[des])
     return image_resized_bytes
+
+
+class ImageEngine:
+    """
+    Resize the uploaded images in worker processes, so that decoding and resampling them does not block the other
+    greenlets of the worker. The caller waits for the result cooperatively.
+    """
+
+    def __init__(self, workers: int = IMAGE_WORKERS):
+        """
+        Args:
+            workers (int): Number of worker processes, 0 resizes the images in the calling greenlet
+        """
+        self.workers = workers
+        self._executor: Optional[ProcessPoolExecutor] = None
+        self._lock = threading.Lock()
+
+    def resize_image(self, image_str: str, des: str = "chat_history") -> bytes:
+        """Same as `resize_image`, run in a worker process"""
+        if not self.workers:
+            return resize_image(image_str, des)
+        executor = self._get_executor()
+        try:
+            return executor.submit(resize_image, image_str, des).result()
+        except BrokenProcessPool:
+            # A worker died, e.g. killed for its memory, the next image gets a new pool
+            logging.exception("Image worker process terminated abruptly")
+            self._reset(executor)
+            raise
+
+    def shutdown(self):
+        with self._lock:
+            executor, self._executor = self._executor, None
+        if executor is not None:
+            executor.shutdown(wait=False, cancel_futures=True)
+
+    def _get_executor(self) -> ProcessPoolExecutor:
+        with self._lock:
+            if self._executor is None:
+                # Forked workers inherit the loaded modules, and the results are awaited through the patched pipes
+                self._executor = ProcessPoolExecutor(self.workers, mp_context=multiprocessing.get_context("fork"))
+            return self._executor
+
+    def _reset(self, executor: ProcessPoolExecutor):
+        with self._lock:
+            if self._executor is executor:
+                self._executor = None
+        executor.shutdown(wait=False)
@@ -0,0 +1,170 @@
+"""Utils corresponding to parsing JSON objects that arrive in chunks, e.g. streamed OpenAI function call arguments"""
+import json
+from typing import Any, Dict, Iterable, List, Tuple
+
+# Parser states
+_EXPECT_OBJECT = 0
+_EXPECT_KEY = 1
+_IN_KEY = 2
+_EXPECT_COLON = 3
+_EXPECT_VALUE = 4
+_IN_STRING = 5
+_IN_RAW = 6
+_DONE = 7
+
+_WHITESPACE = " \t\r\n"
+
+# Events
+STRING_DELTA = "delta"
+FIELD = "field"
+
+
+class JSONObjectStreamParser:
+    """
+    Incremental parser of a flat JSON object whose text arrives in chunks.
+
+    Every call to `feed` returns the events that became available with the new chunk:
+
+        ("delta", key, text): Newly decoded characters of a string value, only for keys in `stream_keys`.
+
+        ("field", key, value): A top-level value has been fully parsed.
+
+    Nested values (arrays, objects) are buffered and decoded once they are complete.
+    """
+
+    def __init__(self, stream_keys: Iterable[str] = ()):
+        self.stream_keys = set(stream_keys)
+        self.result: Dict[str, Any] = {}
+        self._state = _EXPECT_OBJECT
+        self._key = None
+        self._buffer: List[str] = []
+        self._segment: List[str] = []
+        self._escape = False
+        self._escape_start = None
+        self._in_string = False
+        self._depth = 0
+
+    @property
+    def is_done(self) -> bool:
+        return self._state == _DONE
+
+    def feed(self, chunk: str) -> List[Tuple]:
+        events = []
+        for char in chunk:
+            self._consume(char, events)
+        if self._state == _IN_STRING and self._key in self.stream_keys:
+            self._flush_segment(events, final=False)
+        return events
+
+    def _consume(self, char: str, events: List[Tuple]):
+        state = self._state
+        if state == _EXPECT_OBJECT:
+            if char == "{":
+                self._state = _EXPECT_KEY
+        elif state == _EXPECT_KEY:
+            if char == '"':
+                self._state = _IN_KEY
+                self._buffer = []
+            elif char == "}":
+                self._state = _DONE
+        elif state == _IN_KEY:
+            if self._escape:
+                self._buffer.append(char)
+                self._escape = False
+            elif char == "\\":
+                self._buffer.append(char)
+                self._escape = True
+            elif char == '"':
+                self._key = json.loads('"' + "".join(self._buffer) + '"')
+                self._state = _EXPECT_COLON
+            else:
+                self._buffer.append(char)
+        elif state == _EXPECT_COLON:
+            if char == ":":
+                self._state = _EXPECT_VALUE
+        elif state == _EXPECT_VALUE:
+            if char in _WHITESPACE:
+                return
+            self._buffer = []
+            if char == '"':
+                self._state = _IN_STRING
+                self._segment = []
+                self._escape_start = None
+            else:
+                self._state = _IN_RAW
+                self._depth = 0
+                self._in_string = False
+                self._consume_raw(char, events)
+        elif state == _IN_STRING:
+            if self._escape:
+                self._segment.append(char)
+                self._escape = False
+            elif char == "\\":
+                self._escape_start = len(self._segment)
+                self._segment.append(char)
+                self._escape = True
+            elif char == '"':
+                self._flush_segment(events, final=True)
+                self._complete_field(json.loads('"' + "".join(self._buffer) + '"'), events)
+            else:
+                self._segment.append(char)
+        elif state == _IN_RAW:
+            self._consume_raw(char, events)
+
+    def _consume_raw(self, char: str, events: List[Tuple]):
+        if self._in_string:
+            self._buffer.append(char)
+            if self._escape:
+                self._escape = False
+            elif char == "\\":
+                self._escape = True
+            elif char == '"':
+                self._in_string = False
+            return
+
+        if self._depth == 0 and (char in ",}" or char in _WHITESPACE):
+            # End of a scalar value (number, true, false, null)
+            self._complete_field(json.loads("".join(self._buffer)), events)
+            if char == "}":
+                self._state = _DONE
+            return
+
+        self._buffer.append(char)
+        if char == '"':
+            self._in_string = True
+        elif char in "[{":
+            self._depth += 1
+        elif char in "]}":
+            self._depth -= 1
+            if self._depth == 0:
+                self._complete_field(json.loads("".join(self._buffer)), events)
+
+    def _flush_segment(self, events: List[Tuple], final: bool):
+        """Decode the raw characters of the current string value received so far, keeping back an incomplete
+        escape sequence (or the high half of a surrogate pair) until the next chunk arrives."""
+        segment = "".join(self._segment)
+        cut = len(segment)
+        if not final and self._escape_start is not None:
+            escape = segment[self._escape_start:]
+            if self._escape or (escape.startswith("\\u") and len(escape) < 6):
+                cut = self._escape_start
+
+        text = json.loads('"' + segment[:cut] + '"')
+        if not final and text and 0xD800 <= ord(text[-1]) <= 0xDBFF:
+            # A high surrogate can only come from a `\uXXXX` escape, wait for the low surrogate
+            cut -= 6
+            text = text[:-1]
+        if cut == 0:
+            return
+        self._buffer.append(segment[:cut])
+        self._segment = list(segment[cut:])
+        self._escape_start = 0 if self._segment else None
+        if text and self._key in self.stream_keys:
+            events.append((STRING_DELTA, self._key, text))
+
+    def _complete_field(self, value: Any, events: List[Tuple]):
+        self.result[self._key] = value
+        events.append((FIELD, self._key, value))
+        self._key = None
+        self._buffer = []
+        self._state = _EXPECT_KEY
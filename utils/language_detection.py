@@ -0,0 +1,166 @@
+"""Language detection with a local classifier and a cache in front of a remote detector"""
+import hashlib
+import logging
+import re
+import threading
+import unicodedata
+from collections import Counter, defaultdict
+from typing import Callable, Dict, List, Optional, Tuple
+
+from utils.cache import TTLCache
+from utils.enum.language import Language
+
+# Frequent function words of each language. A word shared by several languages counts for all of them, split
+# evenly.
+STOPWORDS = {
+    Language.ENGLISH: """the and is are am you i what how why who where when of to in it that this was for with do
+        does can my me your be have has not about tell please hello hi thanks thank yes no there they we an""",
+    Language.SPANISH: """el la los las que de y es en un una por para con no qué cómo quién eres tú yo mi me hola
+        gracias cuál dónde está son del al muy pero sí también puedes cuéntame""",
+    Language.FRENCH: """le la les et est un une des que qui je tu vous il elle ne pas de du en pour avec bonjour
+        merci comment pourquoi quoi suis es ce mon ton sur dans oui au aux peux""",
+    Language.ITALIAN: """il lo la gli le che di e è un una per con non sono sei io tu ciao grazie come perché chi
+        cosa mi del della nel questo anche puoi sì ho hai""",
+    Language.GERMAN: """der die das und ist ich du sie er nicht ein eine zu mit was wie warum wer bist hallo danke
+        auf für den dem es mir mich ja nein auch kannst bitte""",
+    Language.POLISH: """i w na z nie jest to się że co jak dlaczego kto ty ja mi czy do od cześć dziękuję jesteś
+        mnie po tak ale o możesz proszę""",
+    Language.PORTUGUESE: """o a os as que de e é um uma para com não você eu tu olá obrigado obrigada como porque
+        quem do da dos das em no na meu minha está são sim pode""",
+}
+
+# Letters that only occur in some of the languages
+MARKERS = {
+    Language.SPANISH: "ñ¿¡áíóú",
+    Language.FRENCH: "çèêâîôûëïœà",
+    Language.ITALIAN: "àèìòù",
+    Language.GERMAN: "ßäöü",
+    Language.POLISH: "ąćęłńśźż",
+    Language.PORTUGUESE: "ãõçâêôáíóú",
+}
+
+# Evidence (in matched words) required for a full confidence
+MIN_EVIDENCE = 2.0
+# Share of letters required to decide on the script alone
+SCRIPT_SHARE = 0.9
+
+WORD_PATTERN = re.compile(r"[^\W\d_]+")
+
+
+def _weights(table: Dict[Language, str], split: Callable[[str], List[str]]) -> Dict[str, Dict[Language, float]]:
+    owners = defaultdict(set)
+    for language, items in table.items():
+        for item in split(items):
+            owners[item].add(language)
+    return {item: {language: 1 / len(languages) for language in languages} for item, languages in owners.items()}
+
+
+WORD_WEIGHTS = _weights(STOPWORDS, str.split)
+MARKER_WEIGHTS = _weights(MARKERS, list)
+
+
+def normalize_text(text: str) -> str:
+    """Lowercase NFC text with collapsed whitespace, so that trivially different messages share a cache entry"""
+    return " ".join(unicodedata.normalize("NFC", text).lower().split())
+
+
+def classify_language(text: str) -> Tuple[Optional[Language], float]:
+    """
+    Guess the language of a normalized text among `Language`, from its script, its function words and its
+    language-specific letters.
+
+    Returns:
+        Tuple: the most likely language, None if there is no evidence, and a confidence between 0 and 1
+    """
+    letters = [char for char in text if char.isalpha()]
+    if not letters:
+        return None, 0.0
+    devanagari = sum(1 for char in letters if "\u0900" <= char <= "\u097f")
+    latin = sum(1 for char in letters if char <= "\u024f")
+    if devanagari / len(letters) >= SCRIPT_SHARE:
+        return Language.HINDI, devanagari / len(letters)
+    if latin / len(letters) < SCRIPT_SHARE:
+        # Other scripts, or a mix of them, are left to the remote detector
+        return None, 0.0
+
+    scores = Counter()
+    for word in WORD_PATTERN.findall(text):
+        for language, weight in WORD_WEIGHTS.get(word, {}).items():
+            scores[language] += weight
+    for char in letters:
+        for language, weight in MARKER_WEIGHTS.get(char, {}).items():
+            scores[language] += weight
+    if not scores:
+        return None, 0.0
+
+    ranked = scores.most_common(2)
+    best_language, best = ranked[0]
+    second = ranked[1][1] if len(ranked) > 1 else 0.0
+    confidence = (best - second) / best * min(1.0, best / MIN_EVIDENCE)
+    return best_language, confidence
+
+
+class LanguageDetector:
+    """
+    Detect the languages of a message, returning language codes like Amazon Comprehend.
+
+    Results are cached by the hash of the normalized text. On a miss, the local classifier answers when its
+    confidence reaches `threshold`, and the remote `fallback` is only called otherwise.
+    """
+
+    def __init__(self, fallback: Callable[[str], List[str]], threshold: float = 0.8, cache_size: int = 4096,
+                 cache_ttl: float = 86400, report_every: int = 1000):
+        """
+        Args:
+            fallback (Callable): Remote detector, returns the language codes of a text
+            threshold (float): Minimum confidence of the local classifier to skip the fallback
+            cache_size (int): Maximum number of cached texts
+            cache_ttl (float): Time-to-live of a cached result, in seconds
+            report_every (int): Number of detections between two logs of the hit and fallback rates
+        """
+        self.fallback = fallback
+        self.threshold = threshold
+        self.cache = TTLCache(maxsize=cache_size, ttl=cache_ttl)
+        self.report_every = report_every
+        self.counters = Counter()
+        self._lock = threading.Lock()
+
+    def detect(self, text: str) -> List[str]:
+        normalized = normalize_text(text)
+        key = hashlib.blake2b(normalized.encode(), digest_size=16).digest()
+        languages = self.cache.get(key)
+        if languages is not None:
+            self._count("cache_hits")
+            return languages
+
+        language, confidence = classify_language(normalized)
+        if language is not None and confidence >= self.threshold:
+            languages = [language.value]
+            self._count("local")
+        else:
+            languages = self.fallback(text)
+            self._count("fallback")
+        self.cache.set(key, languages)
+        return languages
+
+    def stats(self) -> Dict[str, float]:
+        with self._lock:
+            counters = dict(self.counters)
+        total = sum(counters.values())
+        return {
+            **counters,
+            "detections": total,
+            "cache_hit_rate": counters.get("cache_hits", 0) / total if total else 0.0,
+            "local_rate": counters.get("local", 0) / total if total else 0.0,
+            "fallback_rate": counters.get("fallback", 0) / total if total else 0.0,
+        }
+
+    def _count(self, name: str):
+        with self._lock:
+            self.counters[name] += 1
+            report = sum(self.counters.values()) % self.report_every == 0
+        if report:
+            stats = self.stats()
+            logging.info("Language detection: {} detections, {:.1%} cached, {:.1%} local, {:.1%} sent to the "
+                         "fallback".format(stats["detections"], stats["cache_hit_rate"], stats["local_rate"],
+                                           stats["fallback_rate"]))
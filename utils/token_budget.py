@@ -0,0 +1,106 @@
+"""Token counting of chat messages, with the encoder loaded once and the count of each message memoized"""
+import hashlib
+import threading
+from collections import OrderedDict
+from functools import lru_cache
+from typing import Callable, Dict, Sequence, TypeVar
+
+import tiktoken
+
+# Every message follows <im_start>{role/name}\n{content}<im_end>\n
+TOKENS_PER_MESSAGE = 4
+# Every reply is primed with <im_start>assistant
+TOKENS_PER_REPLY = 2
+
+T = TypeVar("T")
+
+
+@lru_cache(maxsize=None)
+def get_encoding(model: str) -> tiktoken.Encoding:
+    """Load the encoding of a model once per process, loading it reads and parses the whole BPE ranks file"""
+    try:
+        return tiktoken.encoding_for_model(model)
+    except KeyError:
+        return tiktoken.get_encoding("cl100k_base")
+
+
+class TokenCounter:
+    """
+    Count the tokens of chat messages for a model.
+
+    The count of each message is memoized by the hash of its fields, so a message of the history is only encoded
+    on the first turn that sends it.
+    """
+
+    def __init__(self, model: str, maxsize: int = 4096):
+        """
+        Args:
+            model (str): Name of the OpenAI model
+            maxsize (int): Maximum number of memoized messages
+        """
+        self.model = model
+        self.maxsize = maxsize
+        self._counts: "OrderedDict[bytes, int]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    @property
+    def encoding(self) -> tiktoken.Encoding:
+        return get_encoding(self.model)
+
+    def count_message(self, message: Dict[str, str]) -> int:
+        """Tokens of one message, including its framing"""
+        key = self._hash(message)
+        with self._lock:
+            count = self._counts.get(key)
+            if count is not None:
+                self._counts.move_to_end(key)
+                return count
+
+        count = TOKENS_PER_MESSAGE
+        for field, value in message.items():
+            count += len(self.encoding.encode(value))
+            if field == "name":  # if there's a name, the role is omitted
+                count -= 1  # role is always required and always 1 token
+
+        with self._lock:
+            self._counts[key] = count
+            if len(self._counts) > self.maxsize:
+                self._counts.popitem(last=False)
+        return count
+
+    def count_messages(self, messages: Sequence[Dict[str, str]]) -> int:
+        """Tokens of a prompt, including the priming of the reply"""
+        return sum(self.count_message(message) for message in messages) + TOKENS_PER_REPLY
+
+    @staticmethod
+    def _hash(message: Dict[str, str]) -> bytes:
+        digest = hashlib.blake2b(digest_size=16)
+        for field, value in message.items():
+            digest.update(field.encode())
+            digest.update(b"\0")
+            digest.update(value.encode())
+            digest.update(b"\0")
+        return digest.digest()
+
+
+def longest_fitting_suffix(items: Sequence[T], budget: int, count: Callable[[T], int]) -> int:
+    """
+    Find the longest suffix whose total number of tokens is within the budget, with one reverse pass. The items
+    before the suffix are not counted.
+
+    Args:
+        items (Sequence): Messages, oldest first
+        budget (int): Maximum number of tokens of the suffix
+        count (Callable): Number of tokens of an item
+
+    Returns:
+        int: Start index of the suffix, `len(items)` if even the last item does not fit
+    """
+    total = 0
+    start = len(items)
+    for index in range(len(items) - 1, -1, -1):
+        total += count(items[index])
+        if total > budget:
+            break
+        start = index
+    return start